@@ -7,219 +7,659 @@
 #######################################
 
 import os, sys
+import json
+import hashlib
 from osgeo import ogr, gdal
 from osgeo.gdalconst import *
 import numpy
 import pandas as pd
-from datetime import datetime, timedelta
-import joblib
+from datetime import datetime, date, timedelta
 import requests
 from dateutil.relativedelta import relativedelta
+from cache import parse_size, cache_get, cache_link, cache_find, cache_put, cache_entry
+from download import make_session, download_all
+from ncwriter import write_nc
+from precstore import day_index, store_create, store_append, store_open, store_move
+import checkpoint
+import chirpsindex
+from metrics import count
 
 # register all of the GDAL drivers
 gdal.AllRegister()
 
 #####Download CHIRPS data
-#Corrected data
-def get_correc_nc(dt_s, dt_e, out_cor_nc):
-    s = requests.Session()
-    s.mount("https://data.chc.ucsb.edu", requests.adapters.HTTPAdapter(max_retries=10))
+#The files are kept in the persistent cache (see cache.py) and linked into the working directories.
+#Several files are downloaded at the same time (see download.py).
+#The server can be changed with the NASAPCHIRPS_CHIRPS_URL environment variable (e.g. a mirror or bench/mockserver.py).
+CHIRPS_URL = os.environ.get('NASAPCHIRPS_CHIRPS_URL', 'https://data.chc.ucsb.edu/products/CHIRPS-2.0')
 
-    diff_month = (dt_e.year - dt_s.year) * 12 + (dt_e.month - dt_s.month)
-    for n in range(diff_month+1):
-        yymm = dt_s + relativedelta(months=+n)
-        yy = yymm.strftime("%Y")
-        mm = yymm.strftime("%m")
-
-        try:
-            #Monthly basis
-            response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/netcdf/p05/by_month/chirps-v2.0.'
-                + yy + '.' + mm + '.days_p05.nc', timeout=80)
-            #Yearly basis
-    #        response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/netcdf/p05/chirps-v2.0.'
-    #                         + dt_st_y + '.days_p05.nc', timeout=80)
-            response.raise_for_status()
-
-            if response.ok:
-                # Create target Directory if it doesn't exist.
-                if not os.path.exists(out_cor_nc):
-                    os.mkdir(out_cor_nc)
-                open(out_cor_nc + '/corr_chirps_' + yy + mm + '.nc', 'wb').write(response.content)
-                print('corr_chirps_' + yy + mm + ".nc file downloaded.")
-    #            open(out_cor_nc + '/corr_chirps_' + dt_st_y + '.nc', 'wb').write(response.content)
-    #            print('corr_chirps_' + dt_st_y + ".nc file downloaded.")
-
-        except requests.exceptions.HTTPError as err:
-            pass
-#            raise SystemExit(err)
-
-        response.close() #Close the connection with the server.
+#To warn that a CHIRPS file chosen for the run could not be downloaded (see download.py), so its days have no CHIRPS
+#rain in the WTH files of this run.
+def warn_missing(name):
+    count('chirps_missing')
+    print('Warning:', name, 'could not be downloaded. Its days have no CHIRPS data in this run.')
+
+#Corrected data
+#months (YYYYMM list) limits the download to some of the months of the range (see get_correc).
+def get_correc_nc(dt_s, dt_e, out_cor_nc, months=None):
+    s = make_session(CHIRPS_URL)
+
+    if months is None:
+        diff_month = (dt_e.year - dt_s.year) * 12 + (dt_e.month - dt_s.month)
+        months = [(dt_s + relativedelta(months=+n)).strftime("%Y%m") for n in range(diff_month+1)]
+    months = [x for x in months if not checkpoint.done('chirps_download', 'corrected/' + x)]
+
+    for yymm, path in zip(months, download_all(lambda yymm: get_month(s, yymm), months)):
+        if path is None:
+            warn_missing('corr_chirps_' + yymm + '.nc')
+            continue
+        cache_link(path, out_cor_nc + '/corr_chirps_' + yymm + '.nc')
+        checkpoint.record('chirps_download', 'corrected/' + yymm, [out_cor_nc + '/corr_chirps_' + yymm + '.nc'])
+        print('corr_chirps_' + yymm + ".nc file ready.")
+
+#Monthly basis. Corrected months do not change once they are published.
+def get_month(s, yymm):
+    nc_name = 'chirps-v2.0.' + yymm[:4] + '.' + yymm[4:] + '.days_p05.nc'
+    return cache_get(s, CHIRPS_URL + '/global_daily/netcdf/p05/by_month/' + nc_name,
+                     'chirps/by_month/' + nc_name, immutable=True)
 
 #Preliminary data
-def get_prelim_nc(dt_s, dt_e, out_pre_nc):
-    s = requests.Session()
-    s.mount("https://data.chc.ucsb.edu", requests.adapters.HTTPAdapter(max_retries=10))
-
-    for y in range(dt_e.year - dt_s.year + 1):
-        single_y = str(dt_s.year + y)
-
-        try:
-            response = s.get('https://data.chc.ucsb.edu/products/CHIRPS-2.0/prelim/global_daily/fixed/netcdf/chirps-v2.0.'
-                             + single_y + '.days_p05.nc', timeout=80)
-            response.raise_for_status()
-
-            if response.ok:
-                # Create target Directory if it doesn't exist.
-                if not os.path.exists(out_pre_nc):
-                    os.mkdir(out_pre_nc)
-                open(out_pre_nc  + '/prelim_nc_' + single_y + '.nc', 'wb').write(response.content)
-                print('prelim_nc_' + single_y + ".nc file downloaded.")
-        except requests.exceptions.HTTPError as err:
-            pass
-    #        raise SystemExit(err)
-        response.close()  # Close the connection with the server.
-
-#To read corrected and preliminary data and then merge them properly.
-def precpkl(outdir_prec):
-    df1 = joblib.load(outdir_prec + '/prec_corr.pkl')
-    df2 = joblib.load(outdir_prec + '/prec_prelim.pkl')
-    last_dt_corr = df1.columns[-1]
-    dt_s_pre = datetime.strptime(last_dt_corr, '%Y%j') + timedelta(days=1)
-    dt_st_p = dt_s_pre.strftime('%Y%j')
-    df3 = df2.loc[:, dt_st_p:]
-    result = pd.concat([df1, df3], axis=1)
-    joblib.dump(result, outdir_prec + '/prec.pkl')
-
-#Intended for long time series but few points (<10000)
-def chirps1(in_file, in_nc_dir, outprec_file):
-    nc_lst = os.listdir(in_nc_dir)  # To list all .sol files in the input folder.
-    nc_lst.sort()  # Sort the files in a sequential date
-    df_chirps = pd.DataFrame()
+#years (YYYY list) limits the download to some of the years of the range (see get_prelim).
+def get_prelim_nc(dt_s, dt_e, out_pre_nc, years=None):
+    s = make_session(CHIRPS_URL)
+
+    if years is None:
+        years = [str(dt_s.year + y) for y in range(dt_e.year - dt_s.year + 1)]
+    years = [x for x in years if not checkpoint.done('chirps_download', 'preliminary/' + x)]
+
+    #Yearly files are refreshed only when the server copy changed.
+    def get_year(single_y):
+        nc_name = 'chirps-v2.0.' + single_y + '.days_p05.nc'
+        return cache_get(s, CHIRPS_URL + '/prelim/global_daily/fixed/netcdf/' + nc_name,
+                         'chirps/prelim/' + nc_name)
+
+    for single_y, path in zip(years, download_all(get_year, years)):
+        if path is None:
+            warn_missing('prelim_nc_' + single_y + '.nc')
+            continue
+        cache_link(path, out_pre_nc + '/prelim_nc_' + single_y + '.nc')
+        checkpoint.record('chirps_download', 'preliminary/' + single_y, [out_pre_nc + '/prelim_nc_' + single_y + '.nc'])
+        print('prelim_nc_' + single_y + ".nc file ready.")
+
+#####Spatial subsets of CHIRPS
+#Instead of the global files, only the pixels around the points are read from the daily cloud-optimized GeoTIFFs of
+#CHIRPS. GDAL reads them through /vsicurl/ with HTTP range requests, so only the header and the tiles of the window are
+#transferred. The days are written as NetCDF files with the layout of the CHIRPS files (see ncwriter.py), so the
+#extraction (chirps_auto) is the same as with the global files.
+COG_URL = CHIRPS_URL + '/global_daily/cogs/p05/'
+PRELIM_TIF_URL = CHIRPS_URL + '/prelim/global_daily/tifs/p05/'
+CHIRPS_ORIGIN = datetime(1980, 1, 1)
+gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')  # Do not list the server folder on each open.
+
+def cog_url(day):
+    return COG_URL + day.strftime('%Y') + '/chirps-v2.0.' + day.strftime('%Y.%m.%d') + '.cog'
+
+def prelim_tif_url(day):
+    return PRELIM_TIF_URL + day.strftime('%Y') + '/chirps-v2.0.' + day.strftime('%Y.%m.%d') + '.tif'
+
+#To get the GDAL path of a GeoTIFF: a file of the server is read through /vsicurl/, a file of the cache directly.
+def tif_path(url):
+    return url if os.path.exists(url) else '/vsicurl/' + url
+
+#To get the pixel window (x0, y0, x1, y1) of a raster that covers all the points of in_file plus a margin of pixels.
+def points_window(in_file, gt, xsize, ysize, margin=1):
+    pt = pd.read_csv(in_file)
+    px = ((pt['Longitude'].to_numpy() - gt[0]) / gt[1]).astype(int)
+    py = ((pt['Latitude'].to_numpy() - gt[3]) / gt[5]).astype(int)
+    return (int(max(px.min() - margin, 0)), int(max(py.min() - margin, 0)),
+            int(min(px.max() + 1 + margin, xsize)), int(min(py.max() + 1 + margin, ysize)))
+
+#To get the geotransform and the points window from the first of the GeoTIFFs (urls) found on the server.
+#Only the header of the file is read. It returns (None, None) when none of them is available.
+def subset_window(urls, in_file):
+    for url in urls:
+        dsi = gdal.Open(tif_path(url), GA_ReadOnly)
+        if dsi is not None:
+            gt = dsi.GetGeoTransform()
+            window = points_window(in_file, gt, dsi.RasterXSize, dsi.RasterYSize)
+            dsi = None
+            return gt, window
+    return None, None
+
+#To read the window of a daily GeoTIFF. It returns None when the day is not on the server.
+def read_window(url, window):
+    dsi = gdal.Open(tif_path(url), GA_ReadOnly)
+    if dsi is None:
+        return None
+    x0, y0, x1, y1 = window
+    values = dsi.GetRasterBand(1).ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    dsi = None
+    return values
+
+#To write the days (datetime list) and their windows (rows from north to south) as a CHIRPS-like NetCDF file.
+def write_subset(path, days, values, gt, window):
+    x0, y0, x1, y1 = window
+    lat = gt[3] + gt[5] * (numpy.arange(y0, y1) + 0.5)
+    lon = gt[0] + gt[1] * (numpy.arange(x0, x1) + 0.5)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    times = [(day - CHIRPS_ORIGIN).days for day in days]
+    write_nc(path, times, lat[::-1], lon, (v[::-1] for v in values), coord_type='d')  # Latitude ascending as in CHIRPS
+
+#To get the name in the cache of the corrected month (YYYYMM) of a window.
+def subset_name(gt, window, yymm):
+    key = hashlib.sha1(repr((gt, window)).encode()).hexdigest()[:16]
+    return 'chirps/subset/' + key + '/corr_chirps_' + yymm + '.nc'
+
+#Corrected data of the points of in_file. Each month is written as corr_chirps_YYYYMM.nc when all its days are on the
+#server. Complete months do not change, so they are kept in the cache under the window they cover.
+#months (YYYYMM list) limits the download to some of the months of the range (see get_correc).
+def get_correc_subset(dt_s, dt_e, out_cor_nc, in_file, months=None):
+    diff_month = (dt_e.year - dt_s.year) * 12 + (dt_e.month - dt_s.month)
+    months = [x for x in [(dt_s + relativedelta(months=+n)).replace(day=1) for n in range(diff_month+1)]
+              if months is None or x.strftime('%Y%m') in months]
+    gt, window = subset_window([cog_url(m) for m in months], in_file)
+    if window is None:
+        return
+
+    for month in months:
+        yymm = month.strftime('%Y%m')
+        if checkpoint.done('chirps_download', 'corrected/' + yymm):
+            continue
+        name = subset_name(gt, window, yymm)
+        path = cache_find(name)
+        if path is None:
+            days = [month + timedelta(days=d) for d in range((month + relativedelta(months=+1) - month).days)]
+            values = download_all(lambda day: read_window(cog_url(day), window), days)
+            if any(v is None for v in values):
+                warn_missing('corr_chirps_' + yymm + '.nc')
+                continue
+            write_subset(out_cor_nc + '/corr_chirps_' + yymm + '.nc.part', days, values, gt, window)
+            path = cache_put(out_cor_nc + '/corr_chirps_' + yymm + '.nc.part', name)
+        cache_link(path, out_cor_nc + '/corr_chirps_' + yymm + '.nc')
+        checkpoint.record('chirps_download', 'corrected/' + yymm, [out_cor_nc + '/corr_chirps_' + yymm + '.nc'])
+        print('corr_chirps_' + yymm + ".nc file ready.")
+
+#Preliminary data of the points of in_file from dt_s up to dt_e or the last day on the server, written by year as
+#prelim_nc_YYYY.nc. Preliminary days can still change, so they are not cached.
+#years (list of years) limits the download to some of the years of the range (see get_prelim).
+def get_prelim_subset(dt_s, dt_e, out_pre_nc, in_file, years=None):
+    days = [dt_s + timedelta(days=d) for d in range((dt_e - dt_s).days + 1)]
+    days = [x for x in days if (years is None or x.year in years) and
+            not checkpoint.done('chirps_download', 'preliminary/' + str(x.year))]
+    gt, window = subset_window([prelim_tif_url(day) for day in days[:1]], in_file)
+    if window is None:
+        return
+    values = download_all(lambda day: read_window(prelim_tif_url(day), window), days)
+    if any(v is None for v in values):
+        n = [v is None for v in values].index(True)  # Days up to the first one missing
+        days, values = days[:n], values[:n]
+
+    for year in sorted(set(day.year for day in days)):
+        sel = [i for i, day in enumerate(days) if day.year == year]
+        write_subset(out_pre_nc + '/prelim_nc_' + str(year) + '.nc', [days[i] for i in sel], [values[i] for i in sel],
+                     gt, window)
+        checkpoint.record('chirps_download', 'preliminary/' + str(year), [out_pre_nc + '/prelim_nc_' + str(year) + '.nc'])
+        print('prelim_nc_' + str(year) + ".nc file ready.")
+
+#####Choice of the CHIRPS files
+#The same days can be read from several CHIRPS products: the monthly (corrected) or yearly (preliminary) global NetCDF
+#files, or the daily GeoTIFFs, downloaded whole or, with subset, read by the tiles of the points window. For each month
+#of corrected data and each year of preliminary data, get_correc/get_prelim estimate the bytes each product would
+#transfer (the sizes given by the server, nothing for the files in the cache that are still valid) and download the
+#cheapest one. Ties go to the NetCDF files. The corrected data always come first: the preliminary days only fill the
+#days after the last corrected day (see precmerge). The choice and the estimates are printed and counted in the metrics
+#as chirps_expected_bytes.
+DAY_OVERHEAD = 16384  # Bytes of the header of a daily GeoTIFF and of the HTTP exchanges to read a window.
+
+#To get the size and the ETag of a file on the server (HEAD request). It returns (None, None) when it is not available.
+def head(s, url):
+    try:
+        response = s.head(url, timeout=30, allow_redirects=True)
+    except requests.exceptions.RequestException:
+        return None, None
+    response.close()
+    if response.status_code != 200:
+        return None, None
+    return int(response.headers.get('Content-Length', 0)), response.headers.get('ETag')
+
+#To get the share of the tiles of a GeoTIFF (url) covered by the window (x0, y0, x1, y1), i.e. the share of the file
+#read for the window.
+def tile_share(url, window):
+    dsi = gdal.Open(tif_path(url), GA_ReadOnly)
+    if dsi is None:
+        return 1.0
+    bx, by = dsi.GetRasterBand(1).GetBlockSize()
+    x0, y0, x1, y1 = window
+    tiles = (-(-x1 // bx) - x0 // bx) * (-(-y1 // by) - y0 // by)
+    share = tiles / ((-(-dsi.RasterXSize // bx)) * (-(-dsi.RasterYSize // by)))
+    dsi = None
+    return min(share, 1.0)
+
+def mb(size):
+    return str(round(size / 1024 ** 2, 1)) + ' MB'
+
+#To choose the product with the lowest expected bytes. costs is {product: bytes or None when it is not on the server},
+#the first product wins ties. It prints the choice and returns the product (None when none is available).
+def choose(data, n, costs):
+    available = [(cost, i, product) for i, (product, cost) in enumerate(costs.items()) if cost is not None]
+    if not available:
+        print('CHIRPS source for', data, '(' + str(n), 'days): not available on the server.')
+        return None
+    cost, _, product = min(available)
+    others = ', '.join(x + ': ' + mb(y) for x, y in costs.items() if x != product and y is not None)
+    print('CHIRPS source for', data, '(' + str(n), 'days):', product + ',', mb(cost), '(' + others + ')' if others else '')
+    count('chirps_expected_bytes', cost)
+    return product
+
+#To get the days (datetime list) from first to last.
+def day_range(first, last):
+    return [first + timedelta(days=d) for d in range((last - first).days + 1)]
+
+#To get a whole daily GeoTIFF (url) through the cache, under the folders of its year. It returns the path or None.
+def get_tif(s, url, folder, immutable):
+    return cache_get(s, url, folder + url.split('/')[-2] + '/' + url.split('/')[-1], immutable=immutable)
+
+#To write the days (datetime list) of whole daily GeoTIFFs of the cache (paths) as a CHIRPS-like NetCDF file with the
+#window of the points of in_file.
+def write_days(path, days, paths, in_file):
+    gt, window = subset_window(paths[:1], in_file)
+    write_subset(path, days, [read_window(x, window) for x in paths], gt, window)
+
+#To add the monthly NetCDF files (months, YYYYMM list) of out_cor_nc to the CHIRPS index for the tiles of the points.
+def index_months(out_cor_nc, months, lat, lon):
+    for yymm in months:
+        nc_file = out_cor_nc + '/corr_chirps_' + yymm + '.nc'
+        dsi = gdal.Open(nc_file, GA_ReadOnly) if os.path.exists(nc_file) else None
+        if dsi is None:
+            continue
+        tiles = chirpsindex.add_month(dsi, day_index(nc_dates(dsi)), yymm, lat, lon)
+        dsi = None
+        if tiles:
+            print('corr_chirps_' + yymm + '.nc added to the CHIRPS index (' + str(tiles), 'tiles).')
+
+#To write the runs of consecutive months (datetime list) read from the CHIRPS index as .idx files of out_cor_nc (one
+#per run, named after its first month) with the first and last day index of the run. The extraction reads them from
+#the index instead of a NetCDF file (see index_values).
+def write_idx(out_cor_nc, months):
+    runs = []
+    for month in months:
+        if runs and runs[-1][-1] + relativedelta(months=+1) == month:
+            runs[-1].append(month)
+        else:
+            runs.append([month])
+    os.makedirs(out_cor_nc, exist_ok=True)
+    for run in runs:
+        path = out_cor_nc + '/corr_chirps_' + run[0].strftime('%Y%m') + '.idx'
+        end = run[-1] + relativedelta(months=+1) - timedelta(days=1)
+        first, last = day_index([run[0].strftime('%Y%j'), end.strftime('%Y%j')])
+        with open(path, 'w') as f:
+            json.dump({'first': int(first), 'last': int(last), 'months': [x.strftime('%Y%m') for x in run]}, f)
+        for month in run:
+            checkpoint.record('chirps_download', 'corrected/' + month.strftime('%Y%m'), [path])
+        print(os.path.basename(path), 'file ready (' + str(len(run)), 'months of the CHIRPS index).')
+
+#Corrected data of the range from the cheapest product for each month (see above): the monthly NetCDF files, the daily
+#cloud-optimized GeoTIFFs (whole, kept in the cache) or, with subset, their windows (see get_correc_subset).
+#With index, the months already in the CHIRPS index for all the points are read from it (see chirpsindex.py) and the
+#monthly NetCDF files downloaded are added to it. The index is not used with subset.
+def get_correc(dt_s, dt_e, out_cor_nc, in_file, subset=False, index=False):
+    s = make_session(CHIRPS_URL)
+    diff_month = (dt_e.year - dt_s.year) * 12 + (dt_e.month - dt_s.month)
+    months = [(dt_s + relativedelta(months=+n)).replace(day=1) for n in range(diff_month+1)]
+    months = [x for x in months if not checkpoint.done('chirps_download', 'corrected/' + x.strftime('%Y%m'))]
+    if not months:
+        return
+    if subset:
+        gt, window = subset_window([cog_url(m) for m in months], in_file)
+        share = tile_share(cog_url(months[0]), window) if window is not None else None
+    index = index and not subset
+    if index:
+        pt = pd.read_csv(in_file, float_precision='round_trip')
+        lat, lon = pt['Latitude'].to_numpy(), pt['Longitude'].to_numpy()
+        indexed = set(chirpsindex.indexed_months(lat, lon, [x.strftime('%Y%m') for x in months]))
+
+    def costs(month):
+        yymm = month.strftime('%Y%m')
+        end = month + relativedelta(months=+1) - timedelta(days=1)
+        days = day_range(month, end) if subset else day_range(max(month, dt_s), min(end, dt_e))  # Subsets are whole months
+        if index and yymm in indexed:
+            return days, {'CHIRPS index': 0}
+        nc_name = 'chirps-v2.0.' + yymm[:4] + '.' + yymm[4:] + '.days_p05.nc'
+        nc = 0 if cache_entry('chirps/by_month/' + nc_name) is not None else \
+            head(s, CHIRPS_URL + '/global_daily/netcdf/p05/by_month/' + nc_name)[0]
+        if subset and window is not None and cache_entry(subset_name(gt, window, yymm)) is not None:
+            tif = 0
+        elif subset and window is None:
+            tif = None
+        else:
+            size = head(s, cog_url(end))[0]  # The month is published when its last day is.
+            if size is not None and subset:
+                tif = len(days) * int(DAY_OVERHEAD + size * share)
+            elif size is not None:
+                tif = size * sum(1 for day in days if cache_entry('chirps/cogs/' + day.strftime('%Y/') +
+                                                                  cog_url(day).split('/')[-1]) is None)
+            else:
+                tif = None
+        return days, {'monthly NetCDF': nc, 'daily GeoTIFF windows' if subset else 'daily GeoTIFFs': tif}
+
+    idx_months, nc_months, tif_months = [], [], []
+    for month, (days, cost) in zip(months, download_all(costs, months)):
+        product = choose('corrected ' + month.strftime('%Y-%m'), len(days), cost)
+        if product == 'CHIRPS index':
+            idx_months.append(month)
+        elif product == 'monthly NetCDF':
+            nc_months.append(month.strftime('%Y%m'))
+        elif product is not None:
+            tif_months.append((month, days))
+
+    if idx_months:
+        chirpsindex.pin_months(lat, lon, [x.strftime('%Y%m') for x in idx_months])  # Before the downloads below
+        write_idx(out_cor_nc, idx_months)
+    if nc_months:
+        get_correc_nc(dt_s, dt_e, out_cor_nc, nc_months)
+        if index:
+            index_months(out_cor_nc, nc_months, lat, lon)
+    if subset and tif_months:
+        get_correc_subset(dt_s, dt_e, out_cor_nc, in_file, [x.strftime('%Y%m') for x, _ in tif_months])
+        return
+    for month, days in tif_months:
+        yymm = month.strftime('%Y%m')
+        paths = download_all(lambda day: get_tif(s, cog_url(day), 'chirps/cogs/', True), days)
+        if any(x is None for x in paths):
+            warn_missing('corr_chirps_' + yymm + '.nc')
+            continue
+        write_days(out_cor_nc + '/corr_chirps_' + yymm + '.nc', days, paths, in_file)
+        checkpoint.record('chirps_download', 'corrected/' + yymm, [out_cor_nc + '/corr_chirps_' + yymm + '.nc'])
+        print('corr_chirps_' + yymm + ".nc file ready.")
+
+#Preliminary data of the range from the cheapest product for each year (see above): the yearly NetCDF files, the daily
+#GeoTIFFs (whole, kept in the cache and revalidated as the yearly files) or, with subset, their windows (see
+#get_prelim_subset). The daily GeoTIFFs give the days up to the first one missing on the server.
+def get_prelim(dt_s, dt_e, out_pre_nc, in_file, subset=False):
+    s = make_session(CHIRPS_URL)
+    years = [dt_s.year + y for y in range(dt_e.year - dt_s.year + 1)]
+    years = [x for x in years if not checkpoint.done('chirps_download', 'preliminary/' + str(x))]
+    if not years or dt_s > dt_e:
+        return
+    first = max(dt_s, datetime(years[0], 1, 1))
+    if subset:
+        gt, window = subset_window([prelim_tif_url(first)], in_file)
+        share = tile_share(prelim_tif_url(first), window) if window is not None else None
+
+    def costs(year):
+        days = day_range(max(dt_s, datetime(year, 1, 1)), min(dt_e, datetime(year, 12, 31)))
+        nc_name = 'chirps-v2.0.' + str(year) + '.days_p05.nc'
+        size, etag = head(s, CHIRPS_URL + '/prelim/global_daily/fixed/netcdf/' + nc_name)
+        entry = cache_entry('chirps/prelim/' + nc_name)
+        nc = 0 if size is not None and entry is not None and etag and entry.get('etag') == etag else size
+        size = head(s, prelim_tif_url(days[0]))[0]
+        if size is None or (subset and window is None):
+            tif = None
+        elif subset:
+            tif = len(days) * int(DAY_OVERHEAD + size * share)
+        else:
+            tif = size * sum(1 for day in days if cache_entry('chirps/prelim_tifs/' + day.strftime('%Y/') +
+                                                              prelim_tif_url(day).split('/')[-1]) is None)
+        return days, {'yearly NetCDF': nc, 'daily GeoTIFF windows' if subset else 'daily GeoTIFFs': tif}
+
+    nc_years, tif_days = [], []
+    for year, (days, cost) in zip(years, download_all(costs, years)):
+        product = choose('preliminary ' + str(year), len(days), cost)
+        if product == 'yearly NetCDF':
+            nc_years.append(str(year))
+        elif product is not None:
+            tif_days += days
+
+    if nc_years:
+        get_prelim_nc(dt_s, dt_e, out_pre_nc, nc_years)
+    if not tif_days:
+        return
+    if subset:
+        get_prelim_subset(tif_days[0], tif_days[-1], out_pre_nc, in_file, sorted(set(x.year for x in tif_days)))
+        return
+    paths = download_all(lambda day: get_tif(s, prelim_tif_url(day), 'chirps/prelim_tifs/', False), tif_days)
+    if any(x is None for x in paths):
+        n = [x is None for x in paths].index(True)  # Days up to the first one missing
+        tif_days, paths = tif_days[:n], paths[:n]
+    for year in sorted(set(day.year for day in tif_days)):
+        sel = [i for i, day in enumerate(tif_days) if day.year == year]
+        write_days(out_pre_nc + '/prelim_nc_' + str(year) + '.nc', [tif_days[i] for i in sel], [paths[i] for i in sel],
+                   in_file)
+        checkpoint.record('chirps_download', 'preliminary/' + str(year), [out_pre_nc + '/prelim_nc_' + str(year) + '.nc'])
+        print('prelim_nc_' + str(year) + ".nc file ready.")
+
+#To merge corrected and preliminary data properly. The preliminary days after the last corrected day are appended to
+#the corrected store, which becomes the "prec" store. It can be run again after an interruption.
+def precmerge(outdir_prec):
+    if os.path.exists(outdir_prec + '/prec_corr'):  # Not moved yet
+        store_move(outdir_prec + '/prec_corr', outdir_prec + '/prec')
+    ids1 = numpy.load(outdir_prec + '/prec/ids.npy')
+    pixel1 = numpy.load(outdir_prec + '/prec/pixel.npy')
+    ids2, pixel2, days2, prec2 = store_open(outdir_prec + '/prec_prelim')
+    if not numpy.array_equal(ids1, ids2):
+        print('Corrected and preliminary precipitation data have different points.')
+        sys.exit(1)
+    first = numpy.unique(pixel1, return_index=True)[1]  # One point of each column of the corrected store
+    store_append(outdir_prec + '/prec', days2, prec2[pixel2[first]].T)
+
+#To list the NetCDF files (and the .idx files of the months read from the CHIRPS index, see write_idx) of a folder
+#sorted by date (empty when the folder does not exist).
+def nc_files(in_nc_dir):
+    if not os.path.exists(in_nc_dir):
+        return []
+    return sorted([x for x in os.listdir(in_nc_dir) if x.endswith(".nc") or x.endswith(".idx")])
+
+#To replace the .idx files of a folder whose months are not all in the CHIRPS index anymore for the points (lat, lon)
+#(e.g. tiles removed from the cache by another process) with the monthly NetCDF files of their months, so their days
+#are read from CHIRPS instead of being missing.
+def check_idx(in_nc_dir, lat, lon):
+    s = None
+    for nc_file in [x for x in nc_files(in_nc_dir) if x.endswith('.idx')]:
+        with open(in_nc_dir + "/" + nc_file, 'r') as f:
+            months = json.load(f)['months']
+        if chirpsindex.indexed_months(lat, lon, months) == months:
+            continue
+        print(nc_file, 'is not in the CHIRPS index anymore. Getting the monthly NetCDF files instead.')
+        s = s or make_session(CHIRPS_URL)
+        os.remove(in_nc_dir + "/" + nc_file)
+        for yymm, path in zip(months, download_all(lambda yymm: get_month(s, yymm), months)):
+            if path is None:
+                warn_missing('corr_chirps_' + yymm + '.nc')
+                continue
+            cache_link(path, in_nc_dir + '/corr_chirps_' + yymm + '.nc')
+            checkpoint.record('chirps_download', 'corrected/' + yymm, [in_nc_dir + '/corr_chirps_' + yymm + '.nc'])
+            print('corr_chirps_' + yymm + ".nc file ready.")
+
+#To read the days of an .idx file (see write_idx) from the CHIRPS index for the points (lat, lon). It returns the day
+#index of the days and the values with shape (days, points).
+def index_values(idx_file, lat, lon):
+    with open(idx_file, 'r') as f:
+        run = json.load(f)
+    return chirpsindex.read(lat, lon, run['first'], run['last'])
+
+#To group the points by CHIRPS pixel (px, py). It returns the index of one point of each pixel and the pixel of each
+#point, so every pixel is read once and its series is shared by all its points. px and py may have one row per grid
+#(ngrids x points): the points are then grouped only when they are in the same pixel of every grid.
+def unique_pixels(px, py):
+    first, pixel = numpy.unique(numpy.vstack([py, px]), axis=1, return_index=True, return_inverse=True)[1:]
+    return first, pixel.reshape(-1)
+
+#To get the pixel (px, py) of the points (lat, lon) in the grid of a geotransform.
+def grid_pixels(gt, lat, lon):
+    return ((lon - gt[0]) / gt[1]).astype(int), ((lat - gt[3]) / gt[5]).astype(int)
+
+#To get the geotransform of each file of nc_lst (the grid of the CHIRPS index for the .idx files), reading only the
+#header of the NetCDF files.
+def file_grids(in_nc_dir, nc_lst):
+    grids = {}
+    for nc_file in nc_lst:
+        if nc_file.endswith('.idx'):
+            grids[nc_file] = tuple(chirpsindex.read_meta()['gt'])
+            continue
+        dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
+        if dsi is None:
+            print('Could not open NetCDF file')
+            sys.exit(1)
+        grids[nc_file] = tuple(dsi.GetGeoTransform())
+        dsi = None
+    return grids
+
+#To get the date of each band of a CHIRPS NetCDF file in DSSAT format ('%Y%j').
+def nc_dates(dsi):
+    meta_nc = dsi.GetMetadata()  # To get metadata of the file
+    date_start = meta_nc['time#units'][-14:]  # The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
+    datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
+    bands_time = meta_nc['NETCDF_DIM_time_VALUES'].strip('{}').split(',')  # "{t1,t2,...}", without braces for a single day
+    bands_time = list(map(int, bands_time))  # Convert all strings in a list of integers.
+    return [(datetime_st + timedelta(days=t)).strftime('%Y%j') for t in bands_time[:dsi.RasterCount]]
+
+#To read the pixels (px, py) from every band of an open NetCDF file in one batched read per band.
+#Each band is read as the bounding window of all the points (or the given window as (x0, y0, x1, y1)) and the values
+#are gathered with NumPy indexing. When max_bytes is given, the window is read in strips of rows so a single read
+#never holds more than max_bytes. Points outside of the raster get -9999.0. It returns an array with shape (bands, points).
+def read_points(dsi, px, py, window=None, max_bytes=None):
+    bands = dsi.RasterCount
+    values = numpy.full((bands, len(px)), -9999.0)
+    inside = (px >= 0) & (px < dsi.RasterXSize) & (py >= 0) & (py < dsi.RasterYSize)
+    if not inside.any():
+        return values
+
+    if window is None:
+        # Bounding window of all the points inside the raster
+        window = (px[inside].min(), py[inside].min(), px[inside].max() + 1, py[inside].max() + 1)
+    x0, y0, x1, y1 = map(int, window)
+    strip = y1 - y0
+    if max_bytes is not None:
+        strip = max(1, min(strip, int(max_bytes // ((x1 - x0) * 4))))
+
+    for ys in range(y0, y1, strip):
+        ye = min(ys + strip, y1)
+        sel = numpy.flatnonzero(inside & (py >= ys) & (py < ye))
+        if len(sel) == 0:
+            continue
+        col = px[sel] - x0
+        row = py[sel] - ys
+        for i in range(1, bands + 1):
+            win = dsi.GetRasterBand(i).ReadAsArray(x0, ys, x1 - x0, ye - ys)
+            values[i - 1, sel] = win[row, col]
+            win = None  # Drop the raster right after sampling it
+
+    return values
+
+#To extract the CHIRPS precipitation of the points of in_file from the files of in_nc_dir to the store outprec.
+#Each NetCDF file is opened only once and all the points are read from each band at the same time (see read_points):
+#the window (x0, y0, x1, y1) of the rasters, by default the bounding window of the points in each file (the files of a
+#folder may have different grids, see get_correc), is read in strips of at most max_bytes and every band is dropped
+#right after sampling it, so the memory used does not depend on the time range.
+def chirps_extract(in_file, in_nc_dir, outprec, max_bytes=None, window=None):
+    nc_lst = nc_files(in_nc_dir)  # To list all .nc files in the input folder sorted by date.
+    start2 = datetime.now()
 
     # To read the input CSV file
-    with open(in_file, "r") as f1:
-        in_pt = [line for line in f1.readlines() if line.strip()]
-
-        for row in in_pt[1:]:
-            id = int(row.split(',')[0])
-            lat = float(row.split(',')[1])
-            lon = float(row.split(',')[2])
-            time_lst = []
-            precval = []
-
-            for nc_file in nc_lst:
-                if nc_file.endswith(".nc"):
-                    # open the image file
-                    dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
-
-                    if dsi is None:
-                        print('Could not open NetCDF file')
-                        sys.exit(1)
-
-                    meta_nc = dsi.GetMetadata()  # To get metadata of the file
-                    date_start = meta_nc['time#units'][
-                                 -14:]  # The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
-                    datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
-                    bands_time = meta_nc['NETCDF_DIM_time_VALUES'][1:-1].split(
-                        ',')  # Get the band timestamp point of the file. "[1:-1]" removes the first and last character
-                    bands_time = list(map(int, bands_time))  # Convert all strings in a list of integers.
-
-                    # Geotransformation
-                    gt = dsi.GetGeoTransform()
-                    px = int((lon - gt[0]) / gt[1])
-                    py = int((lat - gt[3]) / gt[5])
-
-                    # get image size
-                    #rowsY = dsi.RasterYSize
-                    #colsX = dsi.RasterXSize
-                    bands = dsi.RasterCount
-
-                    for i in range(1, bands + 1):
-                        d = dsi.GetRasterBand(i).ReadAsArray(px, py, 1, 1)
-                        dt_st = datetime_st + timedelta(days=bands_time[i - 1])  # Get the band timestamp in date format
-                        band_t = dt_st.strftime('%Y%j')  #strftime() to reformat the date to DSSAT format.
-                        time_lst.append(band_t)
-
-                        if d is None:
-                            d = numpy.float32([[-9999.0]])
-
-                        precval.append(d[0][0])
-
-            df_chirps[id] = precval
-
-    df_chirps = df_chirps.T  # Array transpose
-    df_chirps.index.name = 'ID'  # Set an index name
-    df_chirps.columns = time_lst  # Set column names as actual dates.
-
-    if not os.path.exists(os.path.dirname(outprec_file)):
-        os.mkdir(os.path.dirname(outprec_file))
-    joblib.dump(df_chirps, outprec_file)
-
-#Intended for short time series (< 2 years) but many points. It requires more RAM memory available.
-def chirps2(in_file, in_nc_dir, outprec_file):
-
-    nc_lst = os.listdir(in_nc_dir) #To list all .sol files in the input folder.
-    nc_lst.sort() #Sort the files in a sequential date
-    data = {}
-    time_lst = []
-    start2 = datetime.now()
+    pt = pd.read_csv(in_file, float_precision='round_trip')
+    id = pt['ID'].to_numpy().astype(int)
+    lon = pt['Longitude'].to_numpy()
+    lat = pt['Latitude'].to_numpy()
+    ck_stage = 'chirps_extract/' + os.path.basename(outprec)  # Checkpoints of the store and of each file extracted
+    resumed = checkpoint.done(ck_stage, 'store')
+
+    #The files may have different grids (e.g. subsets and global files, see get_correc), so a column of the store is a
+    #pixel of every grid: the points of a column are in the same pixel of all the files.
+    grids = file_grids(in_nc_dir, nc_lst)
+    pixels = {gt: grid_pixels(gt, lat, lon) for gt in sorted(set(grids.values()))}
+    if pixels:
+        first, pixel = unique_pixels([x[0] for x in pixels.values()], [x[1] for x in pixels.values()])
+    else:
+        first, pixel = numpy.arange(len(id)), None
+    if not resumed:
+        store_create(outprec, id, pixel)
+        checkpoint.record(ck_stage, 'store', [outprec + '/ids.npy', outprec + '/pixel.npy'])
 
     #Loop through dates
     for nc_file in nc_lst:
-        if nc_file.endswith(".nc"):
-            start3 = datetime.now()
+        if resumed and checkpoint.done(ck_stage, nc_file):
+            continue
+        start3 = datetime.now()
+        px, py = pixels[grids[nc_file]]
+        if nc_file.endswith('.idx'):  # Months of the CHIRPS index
+            dsi = None
+        else:
             # open the image file
             dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
-            print(nc_file)
             if dsi is None:
                 print('Could not open NetCDF file')
                 sys.exit(1)
 
-            meta_nc = dsi.GetMetadata() #To get metadata of the file
-            date_start = meta_nc['time#units'][-14:] #The origin date of the file (For CHIRPS '1980-1-1 0:0:0')
-            datetime_st = datetime.strptime(date_start, '%Y-%m-%d %H:%M:%S')
-            bands_time = meta_nc['NETCDF_DIM_time_VALUES'][1:-1].split(',') #Get the band timestamp point of the file. "[1:-1]" removes the first and last character
-            bands_time = list(map(int, bands_time)) #Convert all strings in a list of integers.
-
-            #Geotransformation data
-            gt = dsi.GetGeoTransform()
-
-            # get image size
-            rowsY = dsi.RasterYSize
-            colsX = dsi.RasterXSize
-            bands = dsi.RasterCount
-
-            for i in range(1, bands+1):
-                dt_st = datetime_st + timedelta(days=bands_time[i-1]) #Get the band timestamp in date format
-                band_t = dt_st.strftime('%Y%j')  # we use strftime() to reformat the date to DSSAT format.
-                data[band_t] = dsi.GetRasterBand(i).ReadAsArray(0, 0, colsX, rowsY)
-                time_lst.append(band_t)
-
-            end3 = datetime.now()
-            print("Time of execution for", nc_file, "is:", str(end3-start3))
-
-    #Reads an input CSV file as an array.
-    pt = pd.read_csv(in_file)
-    id = pt['ID'].to_numpy()
-    lon = pt['Longitude'].to_numpy()
-    lat = pt['Latitude'].to_numpy()
-
-    px = ((lon - gt[0]) / gt[1]).astype(int)
-    py = ((lat - gt[3]) / gt[5]).astype(int)
-
-    df_chirps = pd.DataFrame()
-    df_chirps['ID'] = id
-    df_chirps = df_chirps.set_index('ID')
-
-    for t in time_lst:
-        prec_val = data[t][py, px]
-        df_chirps[t] = prec_val
-
-    if not os.path.exists(os.path.dirname(outprec_file)):
-        os.mkdir(os.path.dirname(outprec_file))
-
-    joblib.dump(df_chirps, outprec_file)
-
-    end2 = datetime.now()
-    print("Time of execution for reading the netCDF file: ", str(end2-start2))
-
+        if dsi is None:
+            days, values = index_values(in_nc_dir + "/" + nc_file, lat[first], lon[first])
+            store_append(outprec, days, values)
+        else:
+            store_append(outprec, day_index(nc_dates(dsi)), read_points(dsi, px[first], py[first], window, max_bytes))
+        checkpoint.record(ck_stage, nc_file, [in_nc_dir + "/" + nc_file])
+        dsi = None  # Close the file
+        print("Time of execution for", nc_file, "is:", str(datetime.now() - start3))
+
+    print("Time of execution for reading the CHIRPS files: ", str(datetime.now() - start2))
+
+#Default memory budget for the CHIRPS extraction (bytes).
+DEFAULT_MEMORY_BUDGET = 2 * 1024 ** 3
+
+#To plan the CHIRPS extraction of the points (see chirps_extract) with the memory budget. There is a single strategy:
+#reading the full rasters (the old chirps2) never read less than the bounding window of the points (the old chirps1),
+#so the plan does not choose between them anymore. Every file is read once and only the bounding window of the points,
+#so the budget sets the size of the strips of rows read at a time: what is left once the values of one file (pixels x
+#days of the file) are in memory. The time span does not change the memory used.
+#It returns the maximum bytes allowed for a single raster read.
+def chirps_plan(in_file, in_nc_dir, memory_budget=None):
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+
+    nc_lst = nc_files(in_nc_dir)
+    pt = pd.read_csv(in_file, float_precision='round_trip')
+    n_pt = len(pt)
+
+    days = 0
+    max_bands = 0
+    for nc_file in nc_lst:
+        if nc_file.endswith('.idx'):  # Read from the CHIRPS index, one contiguous series per pixel and year
+            with open(in_nc_dir + "/" + nc_file, 'r') as f:
+                run = json.load(f)
+            days += run['last'] - run['first'] + 1
+            continue
+        dsi = gdal.Open(in_nc_dir + "/" + nc_file, GA_ReadOnly)
+        if dsi is None:
+            print('Could not open NetCDF file')
+            sys.exit(1)
+        days += dsi.RasterCount
+        max_bands = max(max_bands, dsi.RasterCount)
+        gt = dsi.GetGeoTransform()
+        colsX = dsi.RasterXSize
+        rowsY = dsi.RasterYSize
+        dsi = None
+
+    if not [x for x in nc_lst if x.endswith('.nc')]:
+        return memory_budget
+
+    px = ((pt['Longitude'].to_numpy() - gt[0]) / gt[1]).astype(int)
+    py = ((pt['Latitude'].to_numpy() - gt[3]) / gt[5]).astype(int)
+    n_px = len(unique_pixels(px, py)[0])  # Points in the same pixel are read once.
+    px = px.clip(0, colsX - 1)
+    py = py.clip(0, rowsY - 1)
+    window = (px.min(), py.min(), px.max() + 1, py.max() + 1)
+    size = (window[2] - window[0]) * (window[3] - window[1])
+
+    out_bytes = n_px * max_bands * 8  # The values of one file in memory before they go to the store (pixels x bands)
+    max_bytes = max(memory_budget - out_bytes, (window[2] - window[0]) * 4)  # At least one row of the window
+    if out_bytes > memory_budget:
+        print('Warning: the values of one file (', out_bytes // 1024 ** 2, 'MB) are larger than the memory budget.')
+
+    print('CHIRPS extraction plan: | points:', n_pt, '| pixels:', n_px, '| days:', days, '| pixels read per band:', size,
+          'of', colsX * rowsY, '| max read:', min(max_bytes, size * 4) // 1024 ** 2, 'MB')
+    return max_bytes
+
+#To extract the CHIRPS precipitation within the memory budget.
+def chirps_auto(in_file, in_nc_dir, outprec, memory_budget=None):
+    pt = pd.read_csv(in_file, float_precision='round_trip')
+    check_idx(in_nc_dir, pt['Latitude'].to_numpy(), pt['Longitude'].to_numpy())
+    chirps_extract(in_file, in_nc_dir, outprec, chirps_plan(in_file, in_nc_dir, memory_budget))
@@ -9,65 +9,103 @@
 import os, sys
 import argparse
 import shutil
+import queue
+import threading
 import pandas as pd
 from datetime import datetime, date, timedelta
 from chirps import *
-import joblib
-from getnasap import nasa, nasachirps
+from precstore import store_last_date, store_move, store_files
+from getnasap import nasa, nasachirps_stream, STREAM_QUEUE
+from metrics import stage
+from pipeline import run_graph
+import checkpoint
 
-def dssat_wth(in_file, startDate, endDate, out_dir):
+#Each step is measured as a stage (see metrics.py). The NASA POWER and the CHIRPS branches do not depend on each other
+#and run at the same time (see pipeline.py). Once the CHIRPS data are ready, the WTH files of each nasapid are built as
+#soon as its NASA POWER data arrive (see nasachirps_stream).
+#With resume=True, an interrupted run with the same inputs continues from its last checkpoint (see checkpoint.py).
+#With store=True, the WTH files are written to a single store in out_dir (see wthstore.py).
+#With index=True, the corrected CHIRPS months are read from the CHIRPS index of the cache (see chirpsindex.py).
+def dssat_wth(in_file, startDate, endDate, out_dir, memory_budget=None, workers=None, regional=False, subset=False,
+              resume=False, store=False, index=False):
     s1 = datetime.now()
+    n_pt = len(pd.read_csv(in_file))
+    dt_s = datetime.strptime(str(startDate), '%Y%m%d')
+    dt_e = datetime.strptime(str(endDate), '%Y%m%d')
 
-    os.chdir(os.path.dirname(in_file))
-    tempdir = os.path.dirname(in_file) + '/temp'
-    if os.path.exists(tempdir):
-        shutil.rmtree(tempdir)
-        os.mkdir(tempdir)
-    else:
-        os.mkdir(tempdir)
+    with stage('get', points=n_pt, days=(dt_e - dt_s).days + 1):
+        os.chdir(os.path.dirname(in_file))
+        tempdir = os.path.dirname(in_file) + '/temp'
+        key = {'mode': 'get', 'in_file': checkpoint.checksum(in_file), 'start': str(startDate), 'end': str(endDate),
+               'out_dir': os.path.abspath(out_dir), 'regional': regional, 'subset': subset, 'store': store,
+               'index': index}
+        checkpoint.start(tempdir, key, resume)
+        nasa_outdir = tempdir + '/nasap'
+        out_cor_nc = tempdir + '/in_nc_cor'
+        out_pre_nc = tempdir + '/in_nc_pre'
+        outdir_prec = tempdir + '/prec'
+        ready = queue.Queue(maxsize=STREAM_QUEUE)  # nasapids with their NASA POWER file written
+        chirps_ready = threading.Event()
 
-    print('Getting NASA POWER data...')
-    nasa_outdir = tempdir + '/nasap'
-    #Getting NASA POWER data for the update period
-    nasa(in_file, str(startDate), str(endDate), nasa_outdir)
+        #Getting NASA POWER data for the update period
+        def nasa_branch():
+            print('Getting NASA POWER data...')
+            with stage('nasa_fetch', points=n_pt):
+                nasa(in_file, str(startDate), str(endDate), nasa_outdir, regional, ready.put)
+            ready.put(None)
 
-    #Getting corrected data
-    print('Getting corrected data from CHIRPS server...')
-    out_cor_nc = tempdir + '/in_nc_cor'
-    dt_s = datetime.strptime(str(startDate), '%Y%m%d')
-    dt_e = datetime.strptime(str(endDate), '%Y%m%d')
-    get_correc_nc(dt_s, dt_e, out_cor_nc)
+        #Getting and processing corrected data
+        def chirps_corrected():
+            if checkpoint.done('chirps'):
+                return
+            print('Getting corrected data from CHIRPS server...')
+            with stage('chirps_download', dataset='corrected'):
+                get_correc(dt_s, dt_e, out_cor_nc, in_file, subset, index)
 
-    #Run chirps for corrected data
-    outdir_prec = tempdir + '/prec_pkl'
-    print('Processing CHIRPS data...')
-    chirps1(in_file, out_cor_nc, outdir_prec + '/prec_corr.pkl')
+            print('Processing CHIRPS data...')
+            with stage('chirps_extract', dataset='corrected', points=n_pt):
+                chirps_auto(in_file, out_cor_nc, outdir_prec + '/prec_corr', memory_budget)
 
-    #Getting the latest day available in prec corrected data.
-    df = joblib.load(outdir_prec + '/prec_corr.pkl')
-    lastday_corr = df.columns[-1]
-    dt_s_p = datetime.strptime(lastday_corr, '%Y%j') + timedelta(days=1)
+        #Getting and processing preliminary data after the latest day available in prec corrected data.
+        def chirps_preliminary():
+            if checkpoint.done('chirps'):
+                chirps_ready.set()
+                return
+            lastday_corr = store_last_date(outdir_prec + '/prec_corr')
+            dt_s_p = dt_s if lastday_corr is None else lastday_corr + timedelta(days=1)
 
-    if dt_s_p < dt_e:
-        #Getting preliminary data
-        print('Getting preliminary data from CHIRPS server...')
-        out_pre_nc = tempdir + '/in_nc_pre'
-        get_prelim_nc(dt_s_p, dt_e, out_pre_nc)
-        print('CHIRPS netCDF files in disk.')
+            if dt_s_p < dt_e:
+                print('Getting preliminary data from CHIRPS server...')
+                with stage('chirps_download', dataset='preliminary'):
+                    get_prelim(dt_s_p, dt_e, out_pre_nc, in_file, subset)
+                print('CHIRPS netCDF files in disk.')
+
+                with stage('chirps_extract', dataset='preliminary', points=n_pt):
+                    chirps_auto(in_file, out_pre_nc, outdir_prec + '/prec_prelim', memory_budget)
 
-        #Run chirps for preliminary data
-        chirps1(in_file, out_pre_nc, outdir_prec + '/prec_prelim.pkl')
+                #Merging corrected and preliminary precipitation data.
+                with stage('prec_merge', points=n_pt):
+                    precmerge(outdir_prec)
+                print('CHIRPS processing data are complete.')
 
-        #Merging corrected and preliminary precipitation data.
-        precpkl(outdir_prec)
-        print('CHIRPS processing data are complete.')
+            else:
+                store_move(outdir_prec + '/prec_corr', outdir_prec + '/prec')
+            checkpoint.record('chirps', files=store_files(outdir_prec + '/prec'))
+            chirps_ready.set()
 
-    else:
-        os.rename(outdir_prec + '/prec_corr.pkl', outdir_prec + '/prec.pkl')
+        #Fusing NASA POWER and CHIRPS with QC on SRAD, point by point.
+        def wth_build():
+            print('Building the WTH files...')
+            with stage('wth_build', points=n_pt):
+                nasachirps_stream(in_file, nasa_outdir, outdir_prec + '/prec', out_dir, ready, chirps_ready, workers, store)
 
-    #Fusing NASA POWER and CHIRPS with QC on SRAD.
-    print('Building the WTH files...')
-    nasachirps(in_file, nasa_outdir, outdir_prec + '/prec.pkl', out_dir)
+        try:
+            run_graph({'nasa': (nasa_branch, []),
+                       'chirps_corrected': (chirps_corrected, []),
+                       'chirps_preliminary': (chirps_preliminary, ['chirps_corrected']),
+                       'wth_build': (wth_build, [])})
+        finally:
+            checkpoint.finish()
 
     e1 = datetime.now()
     print("Time for execution is: ", str(e1-s1))
@@ -10,12 +10,24 @@ import sys
 import argparse
 from dssat_wth import dssat_wth
 from update_wth import update_wth
+from cache import parse_size, set_cache
+from download import set_workers
+from metrics import set_metrics, STAGES
+from shard import parse_shard, plan, run_shard, merge
+from wthstore import export
+from serve import serve
+from getnasap import NasaPowerError
+import pandas as pd
 
 def main():
     parser = argparse.ArgumentParser()
     subparser = parser.add_subparsers(dest='command')
     getwth = subparser.add_parser('get')
     updatewth = subparser.add_parser('update')
+    planwth = subparser.add_parser('plan', help='Split the points into shards that can run on different machines.')
+    mergewth = subparser.add_parser('merge', help='Merge the WTH files of the shards of a sharded run.')
+    exportwth = subparser.add_parser('export', help='Write the WTH files of a store (see --store) as standard WTH files.')
+    servewth = subparser.add_parser('serve', help='Run a local HTTP service that returns the WTH file of a point (GET /wth?lat=..&lon=..&start=YYYYMMDD&end=YYYYMMDD).')
 
     getwth.add_argument('in_file', type=str, help='CSV file with the points required. It must contain ID, Latitude, Longitude, nasapid, LatNP, LonNP columns.')
     getwth.add_argument('startDate', type=int, help='Start date with format YYYYMMDD (e.g. 19841224)')
@@ -26,12 +38,68 @@ def main():
     updatewth.add_argument('in_dir', type=str, help='Path directory of current WTH files to update.')
     updatewth.add_argument('out_dir', type=str, help='Path of output directory for the new WTH files.')
 
+    planwth.add_argument('in_file', type=str, help='CSV file with the points required. It must contain ID, Latitude, Longitude, nasapid, LatNP, LonNP columns.')
+    planwth.add_argument('shards', type=int, help='Number of shards.')
+    mergewth.add_argument('out_dir', type=str, help='Output directory of the sharded run (the one given to get/update with --shard).')
+    exportwth.add_argument('store_dir', type=str, help='Directory of the store (the out_dir of a run with --store).')
+    exportwth.add_argument('out_dir', type=str, help='Path of output directory for the WTH files.')
+    exportwth.add_argument('--in-file', type=str, default=None, help='CSV file with an ID column: only the WTH files of these IDs are written. Default: all.')
+
+    servewth.add_argument('--host', type=str, default='127.0.0.1', help='Address of the service. Default: 127.0.0.1 (this machine only).')
+    servewth.add_argument('--port', type=int, default=8080, help='Port of the service. Default: 8080.')
+    servewth.add_argument('--power-cache', type=int, default=None, help='NASA POWER cells kept in memory. Default: 1024.')
+    servewth.add_argument('--raster-cache', type=int, default=None, help='CHIRPS files kept open. Default: 512.')
+
+    for sub in [getwth, updatewth, servewth]:
+        sub.add_argument('--cache-dir', type=str, default=None, help='Directory of the persistent download cache. Default: $NASAPCHIRPS_CACHE or ~/.cache/nasapchirps_dssat.')
+        sub.add_argument('--cache-size', type=parse_size, default=None, help='Maximum size of the download cache (e.g. 100G). Default: $NASAPCHIRPS_CACHE_SIZE or 50G.')
+        sub.add_argument('--download-workers', type=int, default=None, help='Number of CHIRPS files downloaded at the same time. Default: $NASAPCHIRPS_DOWNLOAD_WORKERS or 4.')
+
+    for sub in [getwth, updatewth]:
+        sub.add_argument('--shard', type=parse_shard, default=None, help='Run only the shard i of N of the points (e.g. 3/16) and write its WTH files to out_dir/shard_III_of_NNN. Merge the shards with the merge command.')
+        sub.add_argument('--memory-budget', type=parse_size, default=None, help='Memory available for the CHIRPS extraction (e.g. 512M, 4G). Default: 2G.')
+        sub.add_argument('--workers', type=int, default=None, help='Number of processes building the WTH files. Default: number of CPUs.')
+        sub.add_argument('--regional', action='store_true', help='Request neighbouring NASA POWER cells together through the regional endpoint.')
+        sub.add_argument('--subset', action='store_true', help='Read only the CHIRPS pixels around the points from the daily cloud-optimized GeoTIFFs instead of downloading the global files.')
+        sub.add_argument('--index', action='store_true', help='Read the corrected CHIRPS months from a pixel-major index kept in the cache instead of the NetCDF files, adding the monthly files downloaded to it. Not used with --subset.')
+        sub.add_argument('--store', action='store_true', help='Write the WTH files to a single store (out_dir/WTH.db) instead of one file per point. An update of a store always writes a store.')
+        sub.add_argument('--resume', action='store_true', help='Continue an interrupted run with the same inputs from its last checkpoint instead of starting again.')
+        sub.add_argument('--metrics', type=str, default=None, help='JSON lines file where the metrics of every stage are appended.')
+        sub.add_argument('--profile', type=str, nargs='?', const='all', default=None, help='Run the stages (comma separated: ' + ', '.join(STAGES) + ', get, update; default: all) under cProfile.')
+        sub.add_argument('--profile-dir', type=str, default=None, help='Directory of the cProfile files. Default: the folder of the metrics file or the current folder.')
+
     args = parser.parse_args()
+    set_cache(getattr(args, 'cache_dir', None), getattr(args, 'cache_size', None))
+    set_workers(getattr(args, 'download_workers', None))
+    set_metrics(getattr(args, 'metrics', None), getattr(args, 'profile', None), getattr(args, 'profile_dir', None))
 
     if args.command == 'get':
-        dssat_wth(args.in_file, args.startDate, args.endDate, args.out_dir)
+        def run(in_file, out_dir):
+            dssat_wth(in_file, args.startDate, args.endDate, out_dir, args.memory_budget, args.workers, args.regional, args.subset, args.resume, args.store, args.index)
+        if args.shard is None:
+            run(args.in_file, args.out_dir)
+        else:
+            run_shard(run, args.in_file, args.out_dir, args.shard, mode='get', start=str(args.startDate), end=str(args.endDate))
     elif args.command == 'update':
-        update_wth(args.in_file, args.in_dir, args.out_dir)
+        def run(in_file, out_dir):
+            update_wth(in_file, args.in_dir, out_dir, args.memory_budget, args.workers, args.regional, args.subset, args.resume, args.store, args.index)
+        if args.shard is None:
+            run(args.in_file, args.out_dir)
+        else:
+            run_shard(run, args.in_file, args.out_dir, args.shard, mode='update')
+    elif args.command == 'plan':
+        plan(args.in_file, args.shards)
+    elif args.command == 'merge':
+        merge(args.out_dir)
+    elif args.command == 'export':
+        ids = None if args.in_file is None else pd.read_csv(args.in_file)['ID'].astype(str).tolist()
+        export(args.store_dir, args.out_dir, ids)
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.power_cache, args.raster_cache)
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    try:
+        sys.exit(main())
+    except NasaPowerError as err:  # The NASA POWER data of some points are missing (see getnasap.nasa).
+        print(err)
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import os, sys
+import re
+import json
+import time
+import math
+import random
+import argparse
+import threading
+from datetime import date, datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy
+from synth import write_chirps, write_chirps_tif, power_values
+
+#Local stand-in for the CHIRPS and NASAPOWER servers used by the benchmarks. It serves:
+# - <url>/products/CHIRPS-2.0/global_daily/netcdf/p05/by_month/chirps-v2.0.YYYY.MM.days_p05.nc (corrected months),
+# - <url>/products/CHIRPS-2.0/prelim/global_daily/fixed/netcdf/chirps-v2.0.YYYY.days_p05.nc (preliminary years),
+# - <url>/products/CHIRPS-2.0/global_daily/cogs/p05/YYYY/chirps-v2.0.YYYY.MM.DD.cog (corrected days) and
+#   <url>/products/CHIRPS-2.0/prelim/global_daily/tifs/p05/YYYY/chirps-v2.0.YYYY.MM.DD.tif (preliminary days),
+# - <url>/api/temporal/daily/point (ICASA) and <url>/api/temporal/daily/regional (GeoJSON).
+#CHIRPS files are synthetic (see synth.py), written on the first request and served with an ETag and HTTP range
+#requests (Range header, also used by GDAL /vsicurl/ to read parts of the GeoTIFFs). Corrected months
+#are available up to the end of the month before last; preliminary data and SRAD end a few days before today.
+#NASAPOWER requests wait a random latency and fail with 429/503 at the given error rate.
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        cfg = self.server.cfg
+        kind = url.path.split('/')[-1] if url.path.startswith('/api/') else url.path.split('/')[-4] if url.path.endswith(('.cog', '.tif')) \
+            else 'prelim' if '/prelim/' in url.path else 'by_month'
+        with self.server.lock:
+            self.server.counts[kind] = self.server.counts.get(kind, 0) + 1
+
+        if url.path.startswith('/api/'):
+            time.sleep(cfg['latency'] * random.uniform(0.5, 1.5))
+            if random.random() < cfg['error_rate']:
+                return self.send(random.choice([429, 503]), b'Too many requests', {'Retry-After': '1'})
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith('/point'):
+                return self.send(200, power_point(query, cfg).encode(), {'Content-Type': 'text/plain'})
+            if url.path.endswith('/regional'):
+                return self.send(200, json.dumps(power_regional(query, cfg)).encode(), {'Content-Type': 'application/json'})
+
+        self.send_file(url.path)
+
+    def do_HEAD(self):
+        self.send_file(urlparse(self.path).path, head=True)
+
+    #To send a CHIRPS file, or the byte range of the Range header.
+    def send_file(self, url_path, head=False):
+        path = chirps_file(url_path, self.server.cfg)
+        if path is None:
+            return self.send(404, b'Not found')
+        size = os.path.getsize(path)
+        etag = '"' + str(size) + '-' + str(int(os.path.getmtime(path))) + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, b'', {'ETag': etag})
+
+        start, end = 0, size - 1
+        m = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if m and (self.headers.get('If-Range') in (None, etag)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(0, size - int(m.group(2)))
+            if start >= size:
+                return self.send(416, b'', {'Content-Range': 'bytes */' + str(size)})
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if head:
+            return
+        with self.server.lock:
+            self.server.counts['bytes_sent'] = self.server.counts.get('bytes_sent', 0) + end - start + 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(left, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                left -= len(chunk)
+
+#To get the path of a CHIRPS file, writing it on the first request. It returns None when the file is not available.
+def chirps_file(path, cfg):
+    m = re.search(r'chirps-v2\.0\.(\d{4})\.(\d{2})\.(\d{2})\.(cog|tif)$', path)
+    if m is not None:
+        day = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        if day > cfg['prelim_until' if '/prelim/' in path else 'corrected_until']:
+            return None
+        out = cfg['data_dir'] + '/' + path.strip('/').replace('/', '_')
+        with file_lock(out):
+            if not os.path.exists(out):
+                write_chirps_tif(out, day, cfg['grid'], cfg['seed'])
+        return out
+
+    m = re.search(r'chirps-v2\.0\.(\d{4})(?:\.(\d{2}))?\.days_p05\.nc$', path)
+    if m is None:
+        return None
+    year = int(m.group(1))
+    if '/by_month/' in path and m.group(2):
+        first = date(year, int(m.group(2)), 1)
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        if last > cfg['corrected_until']:
+            return None
+    elif '/prelim/' in path and not m.group(2):
+        first = date(year, 1, 1)
+        last = min(date(year, 12, 31), cfg['prelim_until'])
+        if last < first:
+            return None
+    else:
+        return None
+
+    out = cfg['data_dir'] + '/' + path.strip('/').replace('/', '_')
+    with file_lock(out):
+        if not os.path.exists(out):
+            write_chirps(out, first, last, cfg['grid'], cfg['seed'])
+    return out
+
+locks = {}
+locks_lock = threading.Lock()
+
+def file_lock(name):
+    with locks_lock:
+        return locks.setdefault(name, threading.Lock())
+
+def power_dates(query, cfg):
+    dt_s = datetime.strptime(query['start'], '%Y%m%d').date()
+    dt_e = min(datetime.strptime(query['end'], '%Y%m%d').date(), cfg['power_until'])
+    return [dt_s + timedelta(days=k) for k in range((dt_e - dt_s).days + 1)]
+
+#Parameters of the columns of the ICASA responses (DATE T2M TMIN TMAX TDEW RH2M RAIN WIND SRAD).
+POINT_PARAMETERS = ['T2M', 'T2M_MIN', 'T2M_MAX', 'T2MDEW', 'RH2M', 'PRECTOTCORR', 'WS2M', 'ALLSKY_SFC_SW_DWN']
+
+#To answer a point request with an ICASA text as the NASAPOWER server writes it. TAV and AMP (mean temperature and
+#range of the monthly mean temperatures) are the ones of the requested days.
+def power_point(query, cfg):
+    lat = float(query['latitude'])
+    lon = float(query['longitude'])
+    dates = power_dates(query, cfg)
+    values = power_values(lat, lon, dates, cfg['srad_until'])
+    t2m = numpy.array([values['T2M'][d.strftime('%Y%m%d')] for d in dates])
+    months = numpy.array([d.month for d in dates])
+    monthly = [t2m[months == m].mean() for m in numpy.unique(months)]
+    tav, amp = (t2m.mean(), max(monthly) - min(monthly)) if len(t2m) else (-99.0, -99.0)
+    lines = ['$WEATHER DATA : NASA LaRC POWER Daily Data',
+             '! Location: Latitude {:.4f} Longitude {:.4f} Elevation 100.0 meters'.format(lat, lon),
+             '! Dates (UTC): ' + query['start'] + ' - ' + query['end'],
+             '! Parameters: ' + ' '.join(POINT_PARAMETERS),
+             '! Value for missing model data cannot be computed or out of model availability range: -99',
+             '!',
+             '@ INSI   WTHLAT  WTHLONG  WELEV   TAV   AMP  REFHT  WNDHT',
+             '  NASA {:>8.3f} {:>8.3f} {:>6.1f} {:>5.1f} {:>5.1f} {:>6.1f} {:>6.1f}'.format(lat, lon, 100.0, tav, amp, 2.0, 2.0),
+             '@  DATE     T2M    TMIN    TMAX    TDEW    RH2M    RAIN    WIND    SRAD']
+    for d in dates:
+        row = [v[d.strftime('%Y%m%d')] for v in (values[p] for p in POINT_PARAMETERS)]
+        lines.append(d.strftime('%Y%j') + ''.join('{:>8}'.format('-99' if v == -999.0 else '{:.1f}'.format(v)) for v in row))
+    return '\n'.join(lines) + '\n'
+
+#To answer a regional request with a GeoJSON of the grid points (0.5 x 0.625 degrees) of the box.
+def power_regional(query, cfg):
+    dates = power_dates(query, cfg)
+    parameters = query['parameters'].split(',')
+    lats = [i * 0.5 for i in range(math.ceil(float(query['latitude-min']) / 0.5),
+                                   math.floor(float(query['latitude-max']) / 0.5) + 1)]
+    lons = [j * 0.625 for j in range(math.ceil(float(query['longitude-min']) / 0.625),
+                                     math.floor(float(query['longitude-max']) / 0.625) + 1)]
+    features = []
+    for lat in lats:
+        for lon in lons:
+            values = power_values(lat, lon, dates, cfg['srad_until'])
+            features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat, 100.0]},
+                             'properties': {'parameter': {p: values[p] for p in parameters}}})
+    return {'type': 'FeatureCollection', 'header': {'fill_value': -999.0}, 'features': features}
+
+#To start the server in a background thread. It returns the server; its URL is server.url.
+def start_server(data_dir, grid, latency=0.0, error_rate=0.0, seed=0, port=0, today=None):
+    today = today or date.today()
+    month = today.replace(day=1)
+    cfg = {'data_dir': data_dir, 'grid': grid, 'latency': latency, 'error_rate': error_rate, 'seed': seed,
+           'corrected_until': (month - timedelta(days=1)).replace(day=1) - timedelta(days=1),
+           'prelim_until': today - timedelta(days=2), 'power_until': today - timedelta(days=1),
+           'srad_until': today - timedelta(days=5)}
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.cfg = cfg
+    server.lock = threading.Lock()
+    server.counts = {}
+    server.url = 'http://127.0.0.1:' + str(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#To get the environment variables that point the tool to the server.
+def server_env(url):
+    return {'NASAPCHIRPS_CHIRPS_URL': url + '/products/CHIRPS-2.0',
+            'NASAPCHIRPS_NASA_URL': url + '/api/temporal/daily/point',
+            'NASAPCHIRPS_REGIONAL_URL': url + '/api/temporal/daily/regional'}
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock CHIRPS and NASA POWER server for the benchmarks.')
+    parser.add_argument('data_dir', type=str, help='Directory of the synthetic CHIRPS files.')
+    parser.add_argument('--port', type=int, default=0, help='Port of the server. Default: any free port.')
+    parser.add_argument('--grid', type=str, default='-5,30,200,200', help='lat0,lon0,nrows,ncols of the CHIRPS grid (0.05 degrees).')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean latency of the NASA POWER requests (seconds).')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of NASA POWER requests answered with 429/503.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    lat0, lon0, nrows, ncols = args.grid.split(',')
+    grid = {'lat0': float(lat0), 'lon0': float(lon0), 'nrows': int(nrows), 'ncols': int(ncols)}
+    server = start_server(args.data_dir, grid, args.latency, args.error_rate, args.seed, args.port)
+    print(server.url, flush=True)
+    for k, v in server_env(server.url).items():
+        print(k + '=' + v, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import os, sys
+import json
+import glob
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import importlib
+import subprocess
+from datetime import datetime, timedelta
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+from synth import make_points
+from scenarios import SCENARIOS
+from mockserver import start_server, server_env
+import wthstore
+
+#Offline benchmarks. For every scenario the runner starts the mock server (see mockserver.py) and runs the "get" or
+#"update" entry point from start to finish in a separate process, pointed to the server through the
+#NASAPCHIRPS_*_URL variables and with its own cache directory. Runs after the first one reuse the cache.
+#Each run records the wall time of every stage, the peak RSS of the process (and of its worker processes), the
+#throughput and the metrics records of the tool. The results of a commit are written to a JSON file and two files are compared with the "compare" command.
+
+#Functions of dssat_wth/update_wth timed as stages.
+STAGES = ['nasa', 'get_correc', 'get_prelim', 'chirps_auto', 'precmerge', 'nasachirps_stream', 'sel_wthfiles', 'mergeWTH']
+
+#To get the peak RSS (MB) of the process and of its finished child processes.
+def peak_rss():
+    import resource
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and in KB on Linux.
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+def dir_size(path):
+    if not os.path.exists(path):
+        return 0
+    return sum(os.path.getsize(path + '/' + x) for x in os.listdir(path) if os.path.isfile(path + '/' + x))
+
+#To get the dates of a run: [start, end] for "get", the history for the "update" setup and the update period.
+def run_dates(sc, phase):
+    if sc['mode'] == 'get':
+        return sc['start'], sc['end']
+    end = datetime.today() - timedelta(days=4)  # Last day of an update (see update_wth)
+    hist_end = end - timedelta(days=sc['update_days'])
+    if phase == 'setup':
+        return (hist_end - timedelta(days=sc['history_days'] - 1)).strftime('%Y%m%d'), hist_end.strftime('%Y%m%d')
+    return (hist_end + timedelta(days=1)).strftime('%Y%m%d'), end.strftime('%Y%m%d')
+
+#To make the historical WTH files end on different days: file k (in name order) loses its last lags[k % len(lags)] rows.
+def stagger(history_dir, lags):
+    for k, name in enumerate(sorted(x for x in os.listdir(history_dir) if x.endswith('.WTH'))):
+        lag = lags[k % len(lags)]
+        if lag:
+            with open(history_dir + '/' + name, 'rb') as f:
+                lines = f.read().splitlines(True)
+            with open(history_dir + '/' + name, 'wb') as f:
+                f.writelines(lines[:-lag])
+
+#To run one phase of a scenario in this process, timing the stages. The result is written to out_json.
+def worker(name, phase, workdir, out_json):
+    sc = SCENARIOS[name]
+    calls = []
+
+    def timed(stage, func):
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                calls.append([stage, round(time.time() - t0, 3)])
+        return wrapper
+
+    mod_get = importlib.import_module('dssat_wth')
+    mod_update = importlib.import_module('update_wth')
+    metrics_file = workdir + '/' + phase + '_metrics.jsonl'
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    importlib.import_module('metrics').set_metrics(metrics_file)
+    for mod in [mod_get, mod_update]:
+        for stage in STAGES:
+            if hasattr(mod, stage):
+                setattr(mod, stage, timed(stage, getattr(mod, stage)))
+
+    in_file = workdir + '/points.csv'
+    start, end = run_dates(sc, phase)
+    t0 = time.time()
+    if phase == 'setup':
+        mod_get.dssat_wth(in_file, int(start), int(end), workdir + '/history', **sc['options'])
+        if sc.get('lags'):
+            stagger(workdir + '/history', sc['lags'])
+    elif sc['mode'] == 'get':
+        mod_get.dssat_wth(in_file, int(start), int(end), workdir + '/out', **sc['options'])
+    else:
+        mod_update.update_wth(in_file, workdir + '/history', workdir + '/out', **sc['options'])
+    total = time.time() - t0
+
+    stages = {}
+    for stage, seconds in calls:
+        stages[stage] = round(stages.get(stage, 0) + seconds, 3)
+    rss, rss_children = peak_rss()
+    days = (datetime.strptime(end, '%Y%m%d') - datetime.strptime(start, '%Y%m%d')).days + 1
+    requests_csvs = glob.glob(workdir + '/temp/**/nasap/requests.csv', recursive=True)  # An update has one per cohort
+    result = {'phase': phase, 'start': start, 'end': end, 'total_seconds': round(total, 3), 'stages': stages,
+              'calls': calls, 'peak_rss_mb': rss, 'peak_rss_children_mb': rss_children,
+              'points': sc['points'], 'days': days, 'point_days_per_s': round(sc['points'] * days / max(total, 1e-6), 1),
+              'wth_files': wth_files(workdir + '/out') if phase != 'setup' else None,
+              'nasa_requests': sum(sum(1 for _ in open(x)) - 1 for x in requests_csvs),
+              'chirps_mb': round(sum(dir_size(x) for x in glob.glob(workdir + '/temp/**/in_nc_*', recursive=True)) / 1024 ** 2, 1)}
+    with open(metrics_file, 'r') as f:
+        result['metrics'] = [json.loads(line) for line in f]  # Records of the stages (see metrics.py)
+    with open(out_json, 'w') as f:
+        json.dump(result, f, indent=1)
+
+#To count the WTH files of an output folder (WTH files or a store, see wthstore.py).
+def wth_files(out_dir):
+    if wthstore.is_store(out_dir):
+        con = wthstore.connect(out_dir)
+        n = len(wthstore.last_dates(con))
+        con.close()
+        return n
+    return len([x for x in os.listdir(out_dir) if x.endswith('.WTH')])
+
+#To run a phase of a scenario in a new process. The output of the tool goes to "<workdir>/<phase>.log".
+def spawn(name, phase, workdir, env):
+    out_json = workdir + '/' + phase + '.json'
+    with open(workdir + '/' + phase + '.log', 'w') as log:
+        code = subprocess.call([sys.executable, os.path.abspath(__file__), 'worker', name, phase, workdir, out_json],
+                               stdout=log, stderr=subprocess.STDOUT, env=env, cwd=workdir)
+    if code != 0 or not os.path.exists(out_json):
+        print(name, phase, 'failed. See', workdir + '/' + phase + '.log')
+        return None
+    with open(out_json, 'r') as f:
+        return json.load(f)
+
+#To run a scenario "repeat" times (the first run starts with an empty cache).
+def run_scenario(name, workdir, repeat=2):
+    sc = SCENARIOS[name]
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    make_points(workdir + '/points.csv', sc['points'], sc.get('points_grid', sc['grid']))
+
+    server = start_server(workdir + '/server', sc['grid'], sc['latency'], sc['error_rate'])
+    pythonpath = os.pathsep.join([PACKAGE_DIR] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else []))
+    env = dict(os.environ, NASAPCHIRPS_CACHE=workdir + '/cache', PYTHONPATH=pythonpath, **server_env(server.url))
+    runs = []
+    try:
+        if sc['mode'] == 'update':
+            print(name, ': building the WTH files to update...')
+            if spawn(name, 'setup', workdir, env) is None:
+                return runs
+        for i in range(repeat):
+            counts = dict(server.counts)
+            if os.path.exists(workdir + '/out'):
+                shutil.rmtree(workdir + '/out')
+            result = spawn(name, 'run', workdir, env)
+            if result is None:
+                break
+            result['cache'] = 'cold' if i == 0 else 'warm'
+            result['server_requests'] = {k: v - counts.get(k, 0) for k, v in server.counts.items() if v > counts.get(k, 0)}
+            runs.append(result)
+            print(name, result['cache'], ':', result['total_seconds'], 's |', result['point_days_per_s'], 'point-days/s |',
+                  'peak RSS', result['peak_rss_mb'], 'MB (workers', result['peak_rss_children_mb'], 'MB)')
+    finally:
+        server.shutdown()
+    return runs
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PACKAGE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#To print the time and memory of the runs of two result files, scenario by scenario and stage by stage.
+def compare(old_json, new_json):
+    with open(old_json, 'r') as f:
+        old = json.load(f)
+    with open(new_json, 'r') as f:
+        new = json.load(f)
+    print('{:<28} {:<6} {:<16} {:>10} {:>10} {:>8}'.format('scenario', 'cache', 'stage', old['commit'], new['commit'], 'ratio'))
+    for name in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        for r1, r2 in zip(old['scenarios'][name], new['scenarios'][name]):
+            rows = [('total', r1['total_seconds'], r2['total_seconds'])]
+            rows += [(k, r1['stages'].get(k, 0), r2['stages'].get(k, 0)) for k in STAGES if k in r1['stages'] or k in r2['stages']]
+            rows += [('peak_rss_mb', r1['peak_rss_mb'], r2['peak_rss_mb'])]
+            for stage, a, b in rows:
+                ratio = round(b / a, 2) if a else float('nan')
+                print('{:<28} {:<6} {:<16} {:>10} {:>10} {:>8}'.format(name, r2['cache'], stage, a, b, ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of nasapchirps_dssat.')
+    subparser = parser.add_subparsers(dest='command')
+    run = subparser.add_parser('run')
+    subparser.add_parser('list')
+    comp = subparser.add_parser('compare')
+    work = subparser.add_parser('worker')
+
+    run.add_argument('scenarios', type=str, nargs='*', help='Scenarios to run. Default: all.')
+    run.add_argument('--out', type=str, default='bench_results.json', help='JSON file with the results.')
+    run.add_argument('--workdir', type=str, default=None, help='Working directory. Default: a temporary directory.')
+    run.add_argument('--repeat', type=int, default=2, help='Runs of each scenario (the first one with an empty cache).')
+    run.add_argument('--keep', action='store_true', help='Keep the working directory.')
+
+    comp.add_argument('old_json', type=str)
+    comp.add_argument('new_json', type=str)
+
+    for arg in ['name', 'phase', 'workdir', 'out_json']:
+        work.add_argument(arg, type=str)
+
+    args = parser.parse_args()
+    if args.command == 'list':
+        for name, sc in SCENARIOS.items():
+            print(name, sc)
+    elif args.command == 'compare':
+        compare(args.old_json, args.new_json)
+    elif args.command == 'worker':
+        worker(args.name, args.phase, args.workdir, args.out_json)
+    elif args.command == 'run':
+        names = args.scenarios or list(SCENARIOS)
+        for name in names:
+            if name not in SCENARIOS:
+                print('Unknown scenario:', name)
+                sys.exit(1)
+        workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='nasapchirps_bench_'))
+        results = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+                   'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                   'scenarios': {}}
+        try:
+            for name in names:
+                results['scenarios'][name] = run_scenario(name, workdir + '/' + name, args.repeat)
+                with open(args.out, 'w') as f:
+                    json.dump(results, f, indent=1)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        print('Results written to', args.out)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+#Benchmark scenarios. Each scenario runs the "get" mode (dssat_wth) for [start, end] or the "update" mode (update_wth)
+#on WTH files built first for the history_days ending update_days before the end of the update.
+# - points: number of random points inside the CHIRPS grid (see synth.make_points),
+# - grid: synthetic CHIRPS grid (south-west corner and size in 0.05 degree pixels),
+# - points_grid: part of the grid where the points are (default: the whole grid),
+# - latency, error_rate: NASAPOWER mock server behaviour (see mockserver.py),
+# - lags: days removed from the end of the historical WTH files in turn, so they end on different days (update mode),
+# - options: keyword arguments of dssat_wth/update_wth (memory_budget, workers, regional, subset, store,
+#   index).
+SMALL_GRID = {'lat0': -5.0, 'lon0': 30.0, 'nrows': 100, 'ncols': 100}
+LARGE_GRID = {'lat0': -5.0, 'lon0': 30.0, 'nrows': 200, 'ncols': 200}
+DISTRICT = {'lat0': -3.0, 'lon0': 33.0, 'nrows': 20, 'ncols': 20}  # 1 x 1 degree inside LARGE_GRID
+
+SCENARIOS = {
+    'few_points_long_span': {'mode': 'get', 'points': 20, 'start': '20150101', 'end': '20201231',
+                             'grid': SMALL_GRID, 'latency': 0.2, 'error_rate': 0.0, 'options': {}},
+    'few_points_index': {'mode': 'get', 'points': 20, 'start': '20150101', 'end': '20201231',
+                         'grid': SMALL_GRID, 'latency': 0.2, 'error_rate': 0.0, 'options': {'index': True}},
+    'many_points_short_span': {'mode': 'get', 'points': 5000, 'start': '20200601', 'end': '20200731',
+                               'grid': LARGE_GRID, 'latency': 0.05, 'error_rate': 0.02, 'options': {}},
+    'many_points_regional': {'mode': 'get', 'points': 5000, 'start': '20200601', 'end': '20200731',
+                             'grid': LARGE_GRID, 'latency': 0.05, 'error_rate': 0.02, 'options': {'regional': True}},
+    'district': {'mode': 'get', 'points': 200, 'start': '20200101', 'end': '20200630', 'grid': LARGE_GRID,
+                 'points_grid': DISTRICT, 'latency': 0.05, 'error_rate': 0.0, 'options': {}},
+    'district_subset': {'mode': 'get', 'points': 200, 'start': '20200101', 'end': '20200630', 'grid': LARGE_GRID,
+                        'points_grid': DISTRICT, 'latency': 0.05, 'error_rate': 0.0, 'options': {'subset': True}},
+    'update': {'mode': 'update', 'points': 500, 'history_days': 365, 'update_days': 45,
+               'grid': LARGE_GRID, 'latency': 0.05, 'error_rate': 0.02, 'options': {}},
+    'update_staggered': {'mode': 'update', 'points': 500, 'history_days': 365, 'update_days': 45, 'lags': [0, 10, 60, 200],
+                         'grid': LARGE_GRID, 'latency': 0.05, 'error_rate': 0.02, 'options': {}},
+    'update_store': {'mode': 'update', 'points': 500, 'history_days': 365, 'update_days': 45,
+                     'grid': LARGE_GRID, 'latency': 0.05, 'error_rate': 0.02, 'options': {'store': True}},
+}
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os, sys
+import struct
+import argparse
+import numpy
+import pandas as pd
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ncwriter import write_nc
+
+#Synthetic inputs for the benchmarks: CHIRPS NetCDF files with the metadata read by chirps_extract
+#("time#units" and "NETCDF_DIM_time_VALUES"), the daily series of the NASAPOWER mock server and the CSV of points.
+#A grid is a dict {'lat0', 'lon0', 'nrows', 'ncols', 'res'}: south-west corner (degrees), size (pixels) and pixel size.
+CHIRPS_ORIGIN = date(1980, 1, 1)
+
+#To get the synthetic rain of one day: about 30% of wet pixels with a skewed amount.
+def synth_rain(day, grid, seed=0):
+    rnd = numpy.random.RandomState((seed * 100003 + day) % 2 ** 32)
+    shape = (grid['nrows'], grid['ncols'])
+    wet = rnd.random_sample(shape) < 0.3
+    return numpy.where(wet, rnd.gamma(0.8, 8.0, shape), 0.0).astype(numpy.float32)
+
+#To write a synthetic CHIRPS file with the days [first, last] (dates) of a grid.
+def write_chirps(path, first, last, grid, seed=0):
+    res = grid.get('res', 0.05)
+    lat = grid['lat0'] + res * (numpy.arange(grid['nrows']) + 0.5)
+    lon = grid['lon0'] + res * (numpy.arange(grid['ncols']) + 0.5)
+    times = numpy.arange((first - CHIRPS_ORIGIN).days, (last - CHIRPS_ORIGIN).days + 1)
+    write_nc(path, times, lat, lon, (synth_rain(int(t), grid, seed) for t in times), title='Synthetic CHIRPS')
+
+#To write a tiled GeoTIFF (float32, uncompressed, EPSG:4326) with the image directory at the start of the file, like
+#a cloud-optimized GeoTIFF: a reader with HTTP range requests gets the header first and then only the tiles it needs.
+#band has the rows from north to south; (x0, y0) is the north-west corner.
+def write_tif(path, band, x0, y0, res, tile=256, nodata=-9999.0):
+    height, width = band.shape
+    across = -(-width // tile)
+    down = -(-height // tile)
+    padded = numpy.full((down * tile, across * tile), nodata, dtype='<f4')
+    padded[:height, :width] = band
+    nodata = (repr(float(nodata)).rstrip('0').rstrip('.') + '\0').encode()
+    geokeys = [1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1, 2048, 0, 1, 4326]
+    n_tiles = across * down
+    tags = [(256, 4, [width]), (257, 4, [height]), (258, 3, [32]), (259, 3, [1]), (262, 3, [1]), (277, 3, [1]),
+            (284, 3, [1]), (322, 3, [tile]), (323, 3, [tile]), (324, 4, [0] * n_tiles), (325, 4, [tile * tile * 4] * n_tiles),
+            (339, 3, [3]), (33550, 12, [res, res, 0.0]), (33922, 12, [0.0, 0.0, 0.0, x0, y0, 0.0]),
+            (34735, 3, geokeys), (42113, 2, nodata)]
+    formats = {2: 'c', 3: 'H', 4: 'I', 12: 'd'}
+
+    def pack(t, values):
+        if t == 2:
+            return values
+        return struct.pack('<' + formats[t] * len(values), *values)
+
+    extra_start = 8 + 2 + 12 * len(tags) + 4
+    extra_size = sum(len(pack(t, v)) + len(pack(t, v)) % 2 for _, t, v in tags if len(pack(t, v)) > 4)
+    data_start = extra_start + extra_size
+    tags[9] = (324, 4, [data_start + i * tile * tile * 4 for i in range(n_tiles)])
+
+    ifd = struct.pack('<H', len(tags))
+    extra = b''
+    for tag, t, values in tags:
+        data = pack(t, values)
+        if len(data) <= 4:
+            ifd += struct.pack('<HHI', tag, t, len(values)) + data + b'\0' * (4 - len(data))
+        else:
+            ifd += struct.pack('<HHII', tag, t, len(values), extra_start + len(extra))
+            extra += data + b'\0' * (len(data) % 2)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(b'II*\0' + struct.pack('<I', 8) + ifd + struct.pack('<I', 0) + extra)
+        for i in range(down):
+            for j in range(across):
+                f.write(padded[i * tile:(i + 1) * tile, j * tile:(j + 1) * tile].tobytes())
+    os.replace(path + '.tmp', path)
+
+#To write the synthetic CHIRPS day (date) of a grid as a tiled GeoTIFF.
+def write_chirps_tif(path, day, grid, seed=0, tile=32):
+    res = grid.get('res', 0.05)
+    band = synth_rain((day - CHIRPS_ORIGIN).days, grid, seed)[::-1]  # North to south
+    write_tif(path, band, grid['lon0'], grid['lat0'] + grid['nrows'] * res, res, tile)
+
+#To get a deterministic pseudo-random value in [0, 1) for each day index and cell.
+def noise(days, key):
+    x = numpy.sin(numpy.asarray(days, dtype=float) * 12.9898 + key * 78.233) * 43758.5453
+    return x - numpy.floor(x)
+
+#To get the synthetic NASAPOWER daily values of the cell (lat, lon) for the dates (datetime.date list) as
+#{parameter: {YYYYMMDD: value}}. The values depend only on the cell and the day, so point and regional responses
+#and requests of different ranges agree. SRAD is missing (fill_value) for the days after srad_until.
+def power_values(lat, lon, dates, srad_until=None, fill_value=-999.0):
+    days = numpy.array([(d - CHIRPS_ORIGIN).days for d in dates])
+    doy = numpy.array([d.timetuple().tm_yday for d in dates])
+    key = round(lat * 8) * 3001 + round(lon * 8)
+    season = numpy.sin(2 * numpy.pi * (doy - 80) / 365.25) * (1 if lat >= 0 else -1)
+    t2m = 25 - abs(lat) * 0.3 + 6 * season + 3 * (noise(days, key) - 0.5)
+    rain = numpy.where(noise(days, key + 1) < 0.3, 20 * noise(days, key + 2) ** 2, 0.0)
+    srad = 18 + 6 * season + 4 * (noise(days, key + 3) - 0.5)
+    if srad_until is not None:
+        srad[numpy.array([d > srad_until for d in dates], dtype=bool)] = fill_value
+    columns = {'T2M': t2m, 'T2M_MIN': t2m - 5 - 2 * noise(days, key + 4), 'T2M_MAX': t2m + 5 + 2 * noise(days, key + 5),
+               'T2MDEW': t2m - 4 - 3 * noise(days, key + 6), 'RH2M': 60 + 30 * noise(days, key + 7),
+               'PRECTOTCORR': rain, 'WS2M': 1 + 3 * noise(days, key + 8), 'ALLSKY_SFC_SW_DWN': srad}
+    keys = [d.strftime('%Y%m%d') for d in dates]
+    return {p: dict(zip(keys, numpy.round(v, 2).tolist())) for p, v in columns.items()}
+
+#To write a CSV of n random points inside a grid with the columns required by the tool. The nasapid, LatNP and
+#LonNP columns follow the NASAPOWER (MERRA-2) grid of 0.5 x 0.625 degrees.
+def make_points(path, n, grid, seed=0):
+    res = grid.get('res', 0.05)
+    rnd = numpy.random.RandomState(seed)
+    lat = numpy.round(grid['lat0'] + rnd.uniform(0.01, 0.99, n) * grid['nrows'] * res, 5)
+    lon = numpy.round(grid['lon0'] + rnd.uniform(0.01, 0.99, n) * grid['ncols'] * res, 5)
+    row = numpy.round(lat / 0.5).astype(int)
+    col = numpy.round(lon / 0.625).astype(int)
+    pt = pd.DataFrame({'ID': numpy.arange(1, n + 1), 'Latitude': lat, 'Longitude': lon,
+                       'nasapid': (row + 180) * 576 + (col + 288) + 1, 'LatNP': row * 0.5, 'LonNP': col * 0.625})
+    pt.to_csv(path, index=False)
+    return pt
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic CHIRPS NetCDF file.')
+    parser.add_argument('out_file', type=str, help='Path of the NetCDF file.')
+    parser.add_argument('first', type=str, help='First day with format YYYYMMDD.')
+    parser.add_argument('last', type=str, help='Last day with format YYYYMMDD.')
+    parser.add_argument('--grid', type=str, default='-5,30,200,200', help='lat0,lon0,nrows,ncols of the grid (0.05 degrees).')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    lat0, lon0, nrows, ncols = args.grid.split(',')
+    grid = {'lat0': float(lat0), 'lon0': float(lon0), 'nrows': int(nrows), 'ncols': int(ncols)}
+    write_chirps(args.out_file, datetime.strptime(args.first, '%Y%m%d').date(),
+                 datetime.strptime(args.last, '%Y%m%d').date(), grid, args.seed)
+
+if __name__ == "__main__":
+    sys.exit(main())
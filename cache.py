@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import socket
+import shutil
+import threading
+from contextlib import contextmanager
+from download import download
+from metrics import count
+
+#Persistent cache of downloaded files shared across runs. The location and the maximum size can be set with the
+#NASAPCHIRPS_CACHE and NASAPCHIRPS_CACHE_SIZE environment variables or with set_cache().
+#The cache can be shared by several processes (e.g. the shards of a run, see shard.py): the index and every download
+#are protected by lock files.
+CACHE_DIR = os.environ.get('NASAPCHIRPS_CACHE', os.path.expanduser('~/.cache/nasapchirps_dssat'))
+LOCK_STALE = 600  # Seconds without changes after which the lock of another process is taken as abandoned.
+lock = threading.Lock()
+pinned = set()  # Files that this process still needs (see pin)
+
+#To convert a size such as '512M', '4G' or '1000000' into bytes.
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+CACHE_SIZE = parse_size(os.environ.get('NASAPCHIRPS_CACHE_SIZE', '50G'))
+
+#To change the cache directory and its maximum size (bytes).
+def set_cache(cache_dir=None, cache_size=None):
+    global CACHE_DIR, CACHE_SIZE
+    if cache_dir is not None:
+        CACHE_DIR = os.path.abspath(cache_dir)
+    if cache_size is not None:
+        CACHE_SIZE = cache_size
+
+#To hold the lock of a file against other processes. The lock is the file "<path>.lock", created only when it does not
+#exist. When neither the lock nor the partial download "<path>.part" changed for LOCK_STALE seconds, the process that
+#held it is taken as dead and the lock is removed; so is the lock of a process of this machine that is not running.
+@contextmanager
+def file_lock(path):
+    lock_file = path + '.lock'
+    while True:
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                changed = max(os.path.getmtime(x) for x in [lock_file, path + '.part'] if os.path.exists(x))
+                if time.time() - changed > LOCK_STALE or lock_abandoned(lock_file):
+                    print('Removing the abandoned lock', lock_file)
+                    os.remove(lock_file)
+            except (OSError, ValueError):  # The lock was released in the meantime.
+                pass
+            time.sleep(0.1)
+    try:
+        os.write(fd, (socket.gethostname() + ' ' + str(os.getpid())).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_file)
+
+#To know if a lock was left by a process of this machine that is not running anymore (e.g. a run that was killed).
+def lock_abandoned(lock_file):
+    try:
+        with open(lock_file, 'r') as f:
+            host, pid = f.read().split()
+    except (OSError, ValueError):  # Released, or not written yet
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+#To hold the lock of the index of the cache against the other threads and processes.
+@contextmanager
+def index_lock(cache_dir):
+    with lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        with file_lock(cache_dir + '/index.json'):
+            yield
+
+#The index keeps for each cached file its URL, ETag, Last-Modified, size and last access time.
+def read_index(cache_dir):
+    try:
+        with open(cache_dir + '/index.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_index(cache_dir, index):
+    with open(cache_dir + '/index.json.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(cache_dir + '/index.json.tmp', cache_dir + '/index.json')
+
+#To remove the least recently used files until the cache fits in max_size. The files in keep and the pinned files
+#are never removed.
+def evict(cache_dir, index, max_size, keep=()):
+    total = sum(e['size'] for e in index.values())
+    for name in sorted(index, key=lambda x: index[x]['atime']):
+        if total <= max_size:
+            break
+        if name in keep or name in pinned:
+            continue
+        try:
+            os.remove(cache_dir + '/' + name)
+        except OSError:
+            pass
+        total -= index.pop(name)['size']
+        print(name, 'removed from the cache.')
+
+#To get a file from the cache, downloading it only when it is missing or, for mutable files, when the server copy
+#changed (ETag/Last-Modified conditional request). Immutable files are never revalidated.
+#It returns the path of the cached file or None when the server does not have the file.
+def cache_get(s, url, name, immutable=False, timeout=80):
+    path = CACHE_DIR + '/' + name
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock(path):  # Another process may be downloading the same file.
+        return fetch(s, url, name, immutable, timeout)
+
+def fetch(s, url, name, immutable, timeout):
+    cache_dir = CACHE_DIR
+    path = cache_dir + '/' + name
+    with index_lock(cache_dir):
+        entry = read_index(cache_dir).get(name)
+
+    if entry is not None and not os.path.exists(path):
+        entry = None
+
+    headers = {}
+    if entry is not None:
+        if immutable:
+            touch(name)
+            count('cache_hits')
+            print(name, 'found in the cache.')
+            return path
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = download(s, url, path, headers, timeout)
+    if response is None:
+        return None
+
+    if response.status_code == 304:
+        touch(name)
+        count('cache_hits')
+        print(name, 'not modified on the server, using the cached copy.')
+        return path
+
+    register(cache_dir, name, {'url': url, 'etag': response.headers.get('ETag'),
+                               'last_modified': response.headers.get('Last-Modified'), 'immutable': immutable})
+    return path
+
+#To add a file of the cache directory to the index and make room for it.
+def register(cache_dir, name, entry):
+    with index_lock(cache_dir):
+        index = read_index(cache_dir)
+        entry.update({'size': os.path.getsize(cache_dir + '/' + name), 'atime': time.time()})
+        index[name] = entry
+        evict(cache_dir, index, CACHE_SIZE, keep=[name])
+        write_index(cache_dir, index)
+
+#To get a file made by the tool (e.g. a CHIRPS subset) from the cache. It returns its path or None when it is missing.
+def cache_find(name):
+    path = CACHE_DIR + '/' + name
+    with index_lock(CACHE_DIR):
+        entry = read_index(CACHE_DIR).get(name)
+    if entry is None or not os.path.exists(path):
+        return None
+    touch(name)
+    count('cache_hits')
+    print(name, 'found in the cache.')
+    return path
+
+#To get the entry of the index of a cached file (None when it is not in the cache) without marking it as used, e.g. to
+#know what a download would cost.
+def cache_entry(name):
+    with index_lock(CACHE_DIR):
+        entry = read_index(CACHE_DIR).get(name)
+    if entry is None or not os.path.exists(CACHE_DIR + '/' + name):
+        return None
+    return entry
+
+#To move a file made by the tool into the cache. It returns the path of the cached file.
+def cache_put(path, name):
+    cache_dir = CACHE_DIR
+    os.makedirs(os.path.dirname(cache_dir + '/' + name), exist_ok=True)
+    shutil.move(path, cache_dir + '/' + name)
+    register(cache_dir, name, {'url': None, 'etag': None, 'last_modified': None, 'immutable': True})
+    return cache_dir + '/' + name
+
+#To mark a cached file as recently used.
+def touch(name):
+    with index_lock(CACHE_DIR):
+        index = read_index(CACHE_DIR)
+        if name in index:
+            index[name]['atime'] = time.time()
+            write_index(CACHE_DIR, index)
+
+#To mark cached files as recently used and keep them in the cache while this process runs, e.g. the files chosen for
+#a run that are read after other files are downloaded.
+def pin(names):
+    with index_lock(CACHE_DIR):
+        index = read_index(CACHE_DIR)
+        for name in names:
+            pinned.add(name)
+            if name in index:
+                index[name]['atime'] = time.time()
+        write_index(CACHE_DIR, index)
+
+#To place a cached file in a working directory without copying its content when the filesystem allows it.
+def cache_link(path, out_path):
+    if not os.path.exists(os.path.dirname(out_path)):
+        os.makedirs(os.path.dirname(out_path))
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    try:
+        os.link(path, out_path)
+    except OSError:
+        shutil.copy2(path, out_path)
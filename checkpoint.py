@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os
+import json
+import zlib
+import shutil
+import threading
+from datetime import datetime
+from metrics import count
+
+#Checkpoints of the get/update pipelines. The workspace (the "temp" folder) keeps a manifest, checkpoint.jsonl, with
+#one JSON line per completed stage or unit of work (a CHIRPS month or year downloaded, a CHIRPS file extracted, a
+#nasapid fetched, the WTH files of a nasapid written...) and the size and checksum of the files it produced.
+#A run started with resume=True keeps the workspace when its key (the inputs and options of the run) is the one of the
+#manifest, and done() tells which units are complete and still valid, so they are skipped. Otherwise the workspace is
+#cleaned as before. Nothing is recorded when no run is started.
+MANIFEST = 'checkpoint.jsonl'
+CHECKSUM_LIMIT = 64 * 1024 ** 2  # Larger files are checked by size and by the checksum of their first and last MB.
+lock = threading.Lock()
+state = {'path': None, 'done': {}, 'valid': {}, 'scope': ''}
+
+#To get the checksum (CRC32) of a file. It reads the whole file up to CHECKSUM_LIMIT bytes, otherwise its first and
+#last MB, so the large CHIRPS files are not read again.
+def checksum(path):
+    size = os.path.getsize(path)
+    crc = 0
+    with open(path, 'rb') as f:
+        if size <= CHECKSUM_LIMIT:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                crc = zlib.crc32(chunk, crc)
+        else:
+            crc = zlib.crc32(f.read(1024 * 1024), crc)
+            f.seek(size - 1024 * 1024)
+            crc = zlib.crc32(f.read(), crc)
+    return '{:08x}'.format(crc)
+
+def file_entry(path):
+    return {'file': os.path.abspath(path), 'size': os.path.getsize(path), 'crc32': checksum(path)}
+
+def read_manifest(path):
+    records = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # The last line was not complete.
+    return records
+
+#To start a run in the workspace. key identifies the run (inputs and options) and info (e.g. the dates of an update)
+#is kept with it. With resume=True and the same key, the workspace and the completed units are kept and the info of
+#the first run is returned; otherwise the workspace is emptied and info is returned.
+def start(workspace, key, resume=False, **info):
+    path = workspace + '/' + MANIFEST
+    records = read_manifest(path) if resume else []
+    with lock:
+        state['done'] = {}
+        state['valid'] = {}
+        if records and records[0].get('key') == key:
+            info = records[0]['info']
+            for r in records[1:]:
+                state['done'][(r['stage'], r['unit'])] = r
+            print('Resuming the run of', records[0]['started'] + ':', len(state['done']), 'completed units recorded.')
+        else:
+            if resume:
+                print('No run to resume in', workspace + '. Starting a new run.')
+            if os.path.exists(workspace):
+                shutil.rmtree(workspace)
+            os.makedirs(workspace)
+            with open(path, 'w') as f:
+                f.write(json.dumps({'key': key, 'info': info, 'started': datetime.now().isoformat(timespec='seconds')}) + '\n')
+        state['path'] = path
+        state['scope'] = ''
+    return info
+
+#To set the scope of the units checked and recorded from now on (e.g. the cohort of an update), so the same stages can
+#run more than once in a run with different inputs. The scope is a prefix of the stage names.
+def scope(name=''):
+    with lock:
+        state['scope'] = name
+
+#To end the run (no more units are recorded).
+def finish():
+    with lock:
+        state['path'] = None
+        state['done'] = {}
+        state['valid'] = {}
+        state['scope'] = ''
+
+#To know if a unit of a stage is complete: it was recorded and its files did not change.
+def done(stage, unit=''):
+    with lock:
+        stage = state['scope'] + stage
+        record = state['done'].get((stage, unit))
+        if record is None:
+            return False
+        valid = state['valid'].get((stage, unit))
+    if valid is None:
+        valid = True
+        for entry in record['files']:
+            try:
+                if os.path.getsize(entry['file']) != entry['size'] or checksum(entry['file']) != entry['crc32']:
+                    valid = False
+            except OSError:
+                valid = False
+            if not valid:
+                print('Checkpoint of', stage, unit, 'not valid anymore:', entry['file'], 'changed.')
+                break
+        with lock:
+            first = (stage, unit) not in state['valid']
+            state['valid'][(stage, unit)] = valid
+        if valid and first:  # Each unit is counted once, however many times it is checked.
+            count('resumed_units')
+    return valid
+
+#To record a unit of a stage as complete with the files it produced.
+def record(stage, unit='', files=()):
+    if state['path'] is None:
+        return
+    line = json.dumps({'stage': state['scope'] + stage, 'unit': unit, 'files': [file_entry(x) for x in files]}) + '\n'
+    with lock:
+        if state['path'] is None:
+            return
+        with open(state['path'], 'a') as f:
+            f.write(line)
+            f.flush()
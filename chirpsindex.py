@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import numpy
+import cache
+from precstore import day_index
+
+#Pixel-major index of the corrected CHIRPS data, kept in the download cache ("<cache dir>/chirps/index/p05"):
+# - meta.json: the geotransform and the size of the CHIRPS grid and the size of the tiles (TILE x TILE pixels),
+# - <year>/<tile row>_<tile col>.f32: the float32 values of the pixels of a tile for the days of a year, one row of
+#   YEAR_DAYS days per pixel (row by row of the tile). The series of a pixel for a year is contiguous,
+# - <year>/<tile row>_<tile col>.json: the months (YYYYMM) already in the .f32 file.
+#The global monthly files are converted once, for the tiles of the points of the runs (see add_month), and the tiles are
+#extended as new months are downloaded. The series of a point is then read with one contiguous read per year (see read)
+#instead of one read per day of the NetCDF files. The tiles of the months chosen for a run are pinned in the cache
+#(see pin_months), and a tile missing when it is read is an error, not missing days. The values are kept as float32,
+#as in the NetCDF files, so the WTH files are the same with and without the index.
+INDEX_NAME = 'chirps/index/p05'
+TILE = 32
+YEAR_DAYS = 366
+
+def index_dir():
+    return cache.CACHE_DIR + '/' + INDEX_NAME
+
+def read_meta():
+    try:
+        with open(index_dir() + '/meta.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+#To get the name of a tile of a year in the cache (without the extension).
+def tile_name(year, row, col):
+    return INDEX_NAME + '/' + str(year) + '/' + str(row) + '_' + str(col)
+
+def tile_path(year, row, col):
+    return cache.CACHE_DIR + '/' + tile_name(year, row, col)
+
+#To get the tile (row, col) of the points (lat, lon) and the position of their pixel in the tile. Points outside of the
+#grid are not in any tile (inside is False).
+def point_tiles(meta, lat, lon):
+    gt = meta['gt']
+    px = ((numpy.asarray(lon, dtype=float) - gt[0]) / gt[1]).astype(int)  # As in the extraction (see CHIRPS.py)
+    py = ((numpy.asarray(lat, dtype=float) - gt[3]) / gt[5]).astype(int)
+    inside = (px >= 0) & (px < meta['xsize']) & (py >= 0) & (py < meta['ysize'])
+    return inside, py // TILE, px // TILE, (py % TILE) * TILE + px % TILE
+
+#To get the months of a tile (none when its file is missing, e.g. removed from the cache).
+def tile_months(path):
+    if not os.path.exists(path + '.f32'):
+        return []
+    try:
+        with open(path + '.json', 'r') as f:
+            return json.load(f)['months']
+    except (OSError, ValueError):
+        return []
+
+#To get the months (YYYYMM list) of months that the index has for the tiles of all the points (lat, lon).
+def indexed_months(lat, lon, months):
+    meta = read_meta()
+    if meta is None:
+        return []
+    inside, rows, cols, pos = point_tiles(meta, lat, lon)
+    tiles = set(zip(rows[inside].tolist(), cols[inside].tolist()))
+    found = {}
+    result = []
+    for yymm in months:
+        year = yymm[:4]
+        if year not in found:
+            found[year] = [set(tile_months(tile_path(year, r, c))) for r, c in tiles]
+        if all(yymm in x for x in found[year]):
+            result.append(yymm)
+    return result
+
+#To pin the tiles of the points (lat, lon) for the months (YYYYMM list) in the cache (see cache.pin), so the files
+#downloaded later in the run do not remove them before they are read.
+def pin_months(lat, lon, months):
+    meta = read_meta()
+    if meta is None:
+        return
+    inside, rows, cols, pos = point_tiles(meta, lat, lon)
+    tiles = set(zip(rows[inside].tolist(), cols[inside].tolist()))
+    cache.pin([tile_name(year, r, c) + '.f32' for year in sorted(set(x[:4] for x in months)) for r, c in tiles])
+
+#To add a month (YYYYMM) of an open CHIRPS file (dsi, with the day index of its bands) to the tiles of the points (lat,
+#lon). The index is started (or started again when the grid is not the one of the index) with the grid of the file.
+#It returns the number of tiles written.
+def add_month(dsi, days, yymm, lat, lon):
+    grid = {'gt': list(dsi.GetGeoTransform()), 'xsize': dsi.RasterXSize, 'ysize': dsi.RasterYSize, 'tile': TILE}
+    meta = read_meta()
+    if meta != grid:
+        if meta is not None:
+            print('The CHIRPS grid changed. The CHIRPS index is started again.')
+            shutil.rmtree(index_dir())
+        os.makedirs(index_dir(), exist_ok=True)
+        with open(index_dir() + '/meta.json.tmp', 'w') as f:
+            json.dump(grid, f)
+        os.replace(index_dir() + '/meta.json.tmp', index_dir() + '/meta.json')
+        meta = grid
+
+    year = yymm[:4]
+    doy = numpy.asarray(days, dtype=numpy.int64) - int(day_index([int(year) * 1000 + 1])[0])
+    inside, rows, cols, pos = point_tiles(meta, lat, lon)
+    written = 0
+    for r, c in sorted(set(zip(rows[inside].tolist(), cols[inside].tolist()))):
+        path = tile_path(year, r, c)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with cache.file_lock(path):  # Other processes (e.g. shards) share the index.
+            months = tile_months(path)
+            if yymm in months:
+                continue
+            x0, y0 = c * TILE, r * TILE
+            w, h = min(TILE, meta['xsize'] - x0), min(TILE, meta['ysize'] - y0)
+            block = numpy.full((len(doy), TILE, TILE), -9999.0, dtype=numpy.float32)
+            for i in range(len(doy)):
+                block[i, :h, :w] = dsi.GetRasterBand(i + 1).ReadAsArray(x0, y0, w, h)
+
+            if not months:
+                numpy.full((TILE * TILE, YEAR_DAYS), -9999.0, dtype=numpy.float32).tofile(path + '.f32')
+                cache.register(cache.CACHE_DIR, tile_name(year, r, c) + '.f32',
+                               {'url': None, 'etag': None, 'last_modified': None, 'immutable': True})
+            values = numpy.memmap(path + '.f32', dtype=numpy.float32, mode='r+', shape=(TILE * TILE, YEAR_DAYS))
+            values[:, doy] = block.reshape(len(doy), -1).T
+            values.flush()
+            values = None
+            with open(path + '.json.tmp', 'w') as f:
+                json.dump({'months': sorted(months + [yymm])}, f)
+            os.replace(path + '.json.tmp', path + '.json')
+            written += 1
+    return written
+
+#To read the days first to last (day indexes) of the points (lat, lon). It returns the day index of the days and the
+#values with shape (days, points); the points outside of the grid are -9999.0. It raises FileNotFoundError when the
+#index or a tile of the points is missing (e.g. removed from the cache by another process).
+def read(lat, lon, first, last):
+    days = numpy.arange(first, last + 1, dtype=numpy.int64)
+    values = numpy.full((len(days), len(lat)), -9999.0, dtype=numpy.float32)
+    if not len(days):
+        return days, values
+    meta = read_meta()
+    if meta is None:
+        raise FileNotFoundError('The CHIRPS index is missing in ' + index_dir())
+    inside, rows, cols, pos = point_tiles(meta, lat, lon)
+    tiles = {}
+    for k in numpy.flatnonzero(inside).tolist():
+        tiles.setdefault((rows[k], cols[k]), []).append(k)
+
+    years = (days.astype('datetime64[D]').astype('datetime64[Y]').astype(int) + 1970)
+    for year in sorted(set(years.tolist())):
+        sel = numpy.flatnonzero(years == year)
+        start = int(days[sel[0]] - day_index([year * 1000 + 1])[0])
+        for (r, c), pts in tiles.items():
+            path = tile_path(year, r, c)
+            if not os.path.exists(path + '.f32'):
+                raise FileNotFoundError(path + '.f32 is missing in the CHIRPS index.')
+            cache.touch(tile_name(year, r, c) + '.f32')
+            series = numpy.memmap(path + '.f32', dtype=numpy.float32, mode='r', shape=(TILE * TILE, YEAR_DAYS))
+            values[numpy.ix_(sel, pts)] = series[pos[pts], start:start + len(sel)].T  # One contiguous read per pixel
+            series = None
+    return days, values
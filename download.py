@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import os
+import time
+import requests
+from metrics import count, inherit
+from concurrent.futures import ThreadPoolExecutor
+
+#Number of files downloaded at the same time. It can be set with the NASAPCHIRPS_DOWNLOAD_WORKERS environment
+#variable or with set_workers().
+DOWNLOAD_WORKERS = int(os.environ.get('NASAPCHIRPS_DOWNLOAD_WORKERS', 4))
+
+def set_workers(workers=None):
+    global DOWNLOAD_WORKERS
+    if workers is not None:
+        DOWNLOAD_WORKERS = max(1, workers)
+
+#To create a session with a connection pool for the host, large enough for all the download workers.
+def make_session(host, workers=None):
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
+    s = requests.Session()
+    s.mount(host, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=10))
+    return s
+
+#To download a file streaming the chunks to "<path>.part", which is renamed to path only when it is complete.
+#A partial file left by a dropped connection (or by a previous run) is resumed with an HTTP Range request. The
+#validator of the partial file (ETag or Last-Modified) is sent in If-Range so a file changed on the server is
+#downloaded again from the beginning.
+#Dropped connections, timeouts and the answers of a busy server (429 and 5xx) are retried with a growing wait, resuming
+#the partial file. A partial file the server cannot resume (416) is removed and the file is downloaded again.
+#It returns the last response (already closed; status 304 when the server answered "not modified") or None when the
+#server does not have the file or it could not be downloaded.
+def download(s, url, path, headers=None, timeout=80, retries=5):
+    part = path + '.part'
+    name = os.path.basename(path)
+    start = time.time()
+    received = 0
+
+    for attempt in range(retries + 1):
+        req = dict(headers or {})
+        done = os.path.getsize(part) if os.path.exists(part) else 0
+        if done:
+            req.pop('If-None-Match', None)
+            req.pop('If-Modified-Since', None)
+            req['Range'] = 'bytes=' + str(done) + '-'
+            if os.path.exists(part + '.validator'):
+                with open(part + '.validator', 'r') as f:
+                    req['If-Range'] = f.read()
+
+        try:
+            response = s.get(url, headers=req, timeout=timeout, stream=True)
+            if response.status_code == 416:  # The partial file is not valid anymore.
+                response.close()
+                remove_part(part)
+                continue
+            response.raise_for_status()
+
+            if response.status_code == 304:
+                response.close()
+                return response
+
+            if response.status_code == 206:
+                mode = 'ab'
+                expected = int(response.headers['Content-Range'].split('/')[-1])
+            else:
+                mode = 'wb'
+                done = 0
+                expected = int(response.headers.get('Content-Length', -1))
+                validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                if validator:
+                    with open(part + '.validator', 'w') as f:
+                        f.write(validator)
+
+            with open(part, mode) as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    received += len(chunk)
+            response.close()
+
+            if expected >= 0 and os.path.getsize(part) < expected:
+                raise requests.exceptions.ChunkedEncodingError('Connection closed before the end of the file.')
+
+        except requests.exceptions.HTTPError:
+            response.close()
+            if response.status_code != 429 and response.status_code < 500:
+                if response.status_code != 404:  # 404: not published (yet), the callers expect it.
+                    print(name, 'could not be downloaded: HTTP', response.status_code)
+                return None
+            print(name, 'not available now ( HTTP', response.status_code, '). Retrying...')
+            count('http_retries')
+            time.sleep(min(2 ** attempt, 30))
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as err:
+            print(name, 'interrupted (', err, '). Resuming...')
+            count('http_retries')
+            time.sleep(min(2 ** attempt, 30))
+
+        else:
+            break
+    else:
+        print(name, 'could not be downloaded after', retries + 1, 'attempts.')
+        return None
+
+    os.replace(part, path)
+    remove_part(part)
+    count('bytes_downloaded', received)
+    count('files_downloaded')
+    elapsed = max(time.time() - start, 1e-6)
+    print(name, 'downloaded:', round(received / 1024 ** 2, 1), 'MB at', round(received / 1024 ** 2 / elapsed, 2), 'MB/s')
+    return response
+
+#To remove a partial file and its validator.
+def remove_part(part):
+    for f in [part, part + '.validator']:
+        if os.path.exists(f):
+            os.remove(f)
+
+#To run func(job) for all the jobs with the download workers. The results keep the order of the jobs.
+def download_all(func, jobs, workers=None):
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(inherit(func), jobs))
@@ -13,12 +13,46 @@ import threading
 import requests
 import time
 import logging
+import random
+import numpy
 import pandas as pd
-import joblib
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from precstore import day_index, store_open
+from metrics import count, inherit
+import checkpoint
+import wthstore
+import wthio
+from nasapcache import cell_path, read_cell, missing_ranges, merge_cell, cell_rows, cell_header, cell_text
+from nasapregional import (REGIONAL_URL, REGIONAL_MIN_CELLS, group_cells, regional_params, regional_rows,
+                            regional_tav_amp, split_regional)
+
+#Limits of the NASAPOWER client. The number of requests in flight starts at START_THREADS and is adapted between 1 and
+#MAX_THREADS: it grows while the latency stays low and it is cut when the server answers 429/503, times out or slows down.
+#The endpoint can be changed with the NASAPCHIRPS_NASA_URL environment variable.
+NASA_URL = os.environ.get('NASAPCHIRPS_NASA_URL', 'https://power.larc.nasa.gov/api/temporal/daily/point')
+START_THREADS = 5
+MAX_THREADS = 16
+
+#To get the waiting time before retrying a request (exponential backoff with jitter, or the server Retry-After).
+def backoff(attempt, retry_after=None):
+    delay = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
 
 #Function to get the data from the NASAPOWER API v2
-def get_data(user_input, startDate, endDate, nasa_outdir):
+#Failed points go back to a retry queue until the global retry budget (default: half the number of points, at least 20)
+#is used up. The time of every request is written to "<nasa_outdir>/requests.csv".
+#With regional=True, neighbouring cells are requested together through the regional endpoint (see nasapregional.py).
+#The cells without a point response in the cache are also requested for one day, so their header and the layout of
+#their rows are the ones of the point requests.
+#The file of a nasapid is written as soon as all its requests are done and on_ready(nasapid) is called, so the WTH
+#files can be built while the other points are downloaded (see nasachirps_stream).
+#With header=False the header of the files is not used (e.g. an update that only appends rows), so only the days
+#missing in the cache are requested (see nasapcache.missing_ranges).
+def get_data(user_input, startDate, endDate, nasa_outdir, retry_budget=None, regional=False, on_ready=None,
+             header=True):
 
     # Create target Directory if it doesn't exist
     if not os.path.exists(nasa_outdir):
@@ -26,54 +60,239 @@ def get_data(user_input, startDate, endDate, nasa_outdir):
     else:
         print("Directory ", nasa_outdir, " already exists. Data will be added/overwritten")
 
-    def download(q):
-        s = requests.Session()
-        s.mount("https://power.larc.nasa.gov", requests.adapters.HTTPAdapter(max_retries=30))
-        while True:
-            pt = q.get()
-            id = pt[0]
-            logging.info("Requesting data for: %s", id)
-
-            try:
-                response = s.get('https://power.larc.nasa.gov/api/temporal/daily/point', params=pt[1], timeout=80)
-                response.raise_for_status()
-            except:
-                logging.info("Error in point %s with code %s", id, response.status_code)
-            else:
-                write_nasawth(response.text, nasa_outdir, id)
-                logging.info("Data obtained for: %s", id)
-
-            q.task_done()
-            time.sleep(delay)
-
     format = "%(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
-    NUM_THREADS = 5
-    delay = 0  # seconds
-    q = queue.Queue()
-
-    for i in range(NUM_THREADS):
-        t = threading.Thread(target=download, args=(q,))
-        t.daemon = True
-        t.start()
 
     pt = pd.read_csv(user_input)
     pt_nasa = pt.drop_duplicates(subset=['nasapid'])
 
-    try:
-        for index, row in pt_nasa.iterrows():
-            nasa_id = str(int(row['nasapid']))
-            lat_np = round(row['LatNP'], 4)
-            lon_np = round(row['LonNP'], 4)
+    #Only the date ranges missing in the NASAPOWER cache are requested (see nasapcache.py). The files already written by
+    #the run being resumed are not written again (see checkpoint.py).
+    q = queue.PriorityQueue()  # (time of the next attempt, order, attempt, label, url, parameters, handler, nasapids)
+    cells = {}
+    todo = []
+    resumed = set()
+    for index, row in pt_nasa.iterrows():
+        nasa_id = str(int(row['nasapid']))
+        lat_np = round(row['LatNP'], 4)
+        lon_np = round(row['LonNP'], 4)
+        cell = cell_path(nasa_id, lat_np, lon_np, 'T2M', 'AG')
+        cells[nasa_id] = cell
+        if checkpoint.done('nasa_fetch', nasa_id):
+            resumed.add(nasa_id)
+            continue
+        missing = missing_ranges(cell, startDate, endDate, header)
+        if missing:
+            todo.append((nasa_id, lat_np, lon_np, missing))
+    print(len(cells) - len(todo), "of", len(cells), "NASAPOWER points found in the cache.")
+    count('nasa_cache_hits', len(cells) - len(todo))
+    failed = set()
+
+    #To write the requested period of a point and report it.
+    def emit(nasa_id):
+        if nasa_id in resumed:
+            if on_ready is not None:
+                on_ready(nasa_id)
+        elif os.path.exists(cells[nasa_id] + '.txt'):
+            write_nasawth(cell_text(cells[nasa_id], startDate, endDate), nasa_outdir, nasa_id)
+            checkpoint.record('nasa_fetch', nasa_id, [nasa_outdir + "/" + nasa_id + ".WTH"])
+            if on_ready is not None:
+                on_ready(nasa_id)
+
+    #To merge a point response into the cache.
+    def merge_point(nasa_id, lat_np, lon_np, start, end):
+        key = [nasa_id, float(lat_np), float(lon_np), 'T2M', 'AG']
+        return lambda response: merge_cell(cells[nasa_id], key, response.text, start, end)
+
+    #To merge the regional responses of a box into the cache once all the parameters of the box and the point responses
+    #of its new cells are received. It returns the handlers of the regional and of the point responses. The cells
+    #missing in the regional responses fail, so they are requested again.
+    def merge_box(box, n_parts, start, end, new_cells):
+        parts = []
+        received = []
+        def merge():
+            received.append(1)
+            if len(received) < n_parts + len(new_cells):
+                return
+            values = split_regional(parts, box['cells'])
+            for nasa_id, lat_np, lon_np in box['cells']:
+                if nasa_id not in values:
+                    failed.add(nasa_id)
+                    count('nasa_failed')
+                    continue
+                header = cell_header(cells[nasa_id], start, end, means=regional_tav_amp(values[nasa_id]))
+                merge_cell(cells[nasa_id], [nasa_id, float(lat_np), float(lon_np), 'T2M', 'AG'],
+                           '\n'.join(header) + '\n' + regional_rows(values[nasa_id], cell_rows(cells[nasa_id])),
+                           start, end)
+        def part(response):
+            parts.append(response.json())
+            merge()
+        def point(nasa_id, lat_np, lon_np, day):
+            handler = merge_point(nasa_id, lat_np, lon_np, day, day)
+            def point_handler(response):
+                handler(response)
+                merge()
+            return point_handler
+        return part, point
+
+    boxes = []
+    missing_by_id = {x[0]: x[3] for x in todo}
+    if regional:
+        for box in group_cells([x[:3] for x in todo]):
+            if len(box['cells']) >= REGIONAL_MIN_CELLS:
+                boxes.append(box)
+        in_box = set(x[0] for box in boxes for x in box['cells'])
+        print(len(in_box), "NASAPOWER points requested in", len(boxes), "regional boxes.")
+        todo = [x for x in todo if x[0] not in in_box]
+
+    for k, box in enumerate(boxes):
+        ids = [x[0] for x in box['cells']]
+        missing = [r for x in ids for r in missing_by_id[x]]
+        start = min(r[0] for r in missing)  # One request covering the missing days of all the cells of the box
+        end = max(r[1] for r in missing)
+        params = regional_params(box['bbox'], start, end)
+        new_cells = [x for x in box['cells'] if not read_cell(cells[x[0]]).get('headers')]
+        part, point = merge_box(box, len(params), start, end, new_cells)
+        for par in params:
+            q.put((0.0, q.qsize(), 0, 'box ' + str(k), REGIONAL_URL, par, part, ids))
+        for nasa_id, lat_np, lon_np in new_cells:  # Header of the cell (see nasapcache.cell_header)
             loc_param = {'parameters': 'T2M', 'community': 'AG', 'longitude': lon_np, 'latitude': lat_np,
-                         'start': startDate, 'end': endDate, 'format': 'ICASA'}
-            url = [nasa_id, loc_param]
-            q.put(url)
-        q.join()
+                         'start': start, 'end': start, 'format': 'ICASA'}
+            q.put((0.0, q.qsize(), 0, nasa_id, NASA_URL, loc_param, point(nasa_id, lat_np, lon_np, start), ids))
+
+    for nasa_id, lat_np, lon_np, missing in todo:
+        for start, end in missing:
+            loc_param = {'parameters': 'T2M', 'community': 'AG', 'longitude': lon_np, 'latitude': lat_np,
+                         'start': start, 'end': end, 'format': 'ICASA'}
+            q.put((0.0, q.qsize(), 0, nasa_id, NASA_URL, loc_param, merge_point(nasa_id, lat_np, lon_np, start, end),
+                   [nasa_id]))
+
+    #Points found in the cache are ready now; the others when their last request is done.
+    outstanding = {}
+    for item in q.queue:
+        for nasa_id in item[7]:
+            outstanding[nasa_id] = outstanding.get(nasa_id, 0) + 1
+    for nasa_id in cells:
+        if nasa_id not in outstanding:
+            emit(nasa_id)
+
+    if retry_budget is None:
+        retry_budget = max(20, q.qsize() // 2)
+
+    state = {'limit': float(START_THREADS), 'active': 0, 'pending': q.qsize(), 'retries': 0, 'best': None, 'cut': 0.0}
+    cond = threading.Condition()
+    merge_lock = threading.Lock()
+    timing = []
+
+    s = requests.Session()
+    s.mount(NASA_URL.split('/api/')[0], requests.adapters.HTTPAdapter(pool_maxsize=MAX_THREADS, max_retries=3))
+
+    #To lower the number of requests in flight (at most once per second).
+    def slow_down(factor):
+        if time.time() - state['cut'] > 1:
+            state['limit'] = max(1.0, state['limit'] * factor)
+            state['cut'] = time.time()
+
+    def request(item):
+        not_before, order, attempt, id, url, params, handler, ids = item
+        logging.info("Requesting data for: %s", id)
+        t0 = time.time()
+        try:
+            response = s.get(url, params=params, timeout=80)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as err:
+            elapsed = time.time() - t0
+            code = getattr(err.response, 'status_code', None)
+            retry_after = err.response.headers.get('Retry-After') if err.response is not None else None
+            with cond:
+                timing.append([id, attempt, code, round(elapsed, 3)])
+                if code in (429, 503) or code is None:
+                    slow_down(0.5)
+                if state['retries'] < retry_budget:
+                    state['retries'] += 1
+                    count('http_retries')
+                    delay = backoff(attempt, retry_after)
+                    q.put((time.time() + delay, order, attempt + 1, id, url, params, handler, ids))
+                    logging.info("Error in point %s with code %s. Retrying in %.1f s", id, code, delay)
+                else:
+                    state['pending'] -= 1
+                    failed.update(ids)
+                    count('nasa_failed', len(ids))
+                    logging.info("Error in point %s with code %s. Retry budget used up.", id, code)
+        else:
+            elapsed = time.time() - t0
+            count('bytes_downloaded', len(response.content))
+            count('nasa_requests')
+            done = []
+            with merge_lock:
+                try:
+                    handler(response)
+                except Exception as err:  # A malformed response: its points fail and are requested again later.
+                    failed.update(ids)
+                    count('nasa_failed', len(ids))
+                    print('Could not read the NASAPOWER response for', str(id) + ':', repr(err))
+                else:
+                    for nasa_id in ids:
+                        outstanding[nasa_id] -= 1
+                        if outstanding[nasa_id] == 0 and nasa_id not in failed:
+                            done.append(nasa_id)
+            for nasa_id in done:
+                emit(nasa_id)
+            logging.info("Data obtained for: %s", id)
+            with cond:
+                timing.append([id, attempt, response.status_code, round(elapsed, 3)])
+                state['pending'] -= 1
+                if state['best'] is None or elapsed < state['best']:
+                    state['best'] = elapsed
+                if elapsed > 3 * state['best']:
+                    slow_down(0.8)  # The server is slowing down.
+                else:
+                    state['limit'] = min(MAX_THREADS, state['limit'] + 1 / state['limit'])
+
+    def download():
+        while True:
+            with cond:
+                while state['pending'] > 0 and state['active'] >= int(state['limit']):
+                    cond.wait(0.5)
+                if state['pending'] <= 0:
+                    cond.notify_all()
+                    return
+                state['active'] += 1
+            try:
+                item = q.get(timeout=0.5)
+                wait = item[0] - time.time()
+                if wait > 0:  # Not time yet to retry this point.
+                    q.put(item)
+                    time.sleep(min(wait, 0.5))
+                else:
+                    request(item)
+            except queue.Empty:
+                pass
+            finally:
+                with cond:
+                    state['active'] -= 1
+                    cond.notify_all()
+
+    threads = []
+    for i in range(MAX_THREADS):
+        t = threading.Thread(target=inherit(download))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
 
     except KeyboardInterrupt:
         sys.exit(1)
 
+    pd.DataFrame(timing, columns=['nasapid', 'attempt', 'status', 'seconds']).to_csv(nasa_outdir + '/requests.csv', index=False)
+    if timing:
+        logging.info("%d requests, %d retries, mean time %.2f s, final concurrency %d", len(timing), state['retries'],
+                     sum(x[3] for x in timing) / len(timing), int(state['limit']))
+
 #Function to check the NASAP files requested are downloaded in disk.
 def check_files(user_input, nasa_outdir):
     # Getting the number of NASAP files requested.
@@ -94,19 +313,23 @@ def check_files(user_input, nasa_outdir):
         print("All requested data were downloaded successfully.")
         return False
 
+#Error raised when the NASA POWER data of some points could not be obtained. nasa() runs in a thread of the pipeline
+#(see pipeline.py), so it raises it instead of ending the process; the run stops and the command returns 1.
+class NasaPowerError(Exception):
+    pass
+
 #Function to check that all NASAPOWER files requested are downloaded.
-def get_data2(user_input, cf):
+def get_data2(user_input, cf, startDate, endDate, nasa_outdir, regional=False, on_ready=None, header=True):
 
     if cf[2] < cf[1]:
         print(cf[1] - cf[2], "missing file(s):", cf[0])
         pt_m = cf[3].loc[cf[3]['nasapid'].isin(cf[0])]
         missing_pt = os.path.dirname(user_input) + "/missing_pt.csv"
         pt_m.to_csv(missing_pt, index=False)
-        get_data(missing_pt, startDate, endDate, nasa_outdir)
+        get_data(missing_pt, startDate, endDate, nasa_outdir, regional=regional, on_ready=on_ready, header=header)
 
     elif cf[2] > cf[1]:
-        print("Something is wrong with the input file index.")
-        sys.exit(1)
+        raise NasaPowerError("Something is wrong with the input file index.")
     else:
         print("All requested files were downloaded successfully.")
 
@@ -115,119 +338,222 @@ def write_nasawth(dat, out_dir, id):
     with open(out_dir + "/" + id + ".WTH", "w", newline='') as f:
         f.write(dat)
 
-#Function to download the NASA POWER data.
-def nasa(user_input, startDate, endDate, nasa_outdir):
+#Function to download the NASA POWER data. on_ready(nasapid) is called when the file of a nasapid is written.
+#header=False when the header of the files is not used (see get_data).
+def nasa(user_input, startDate, endDate, nasa_outdir, regional=False, on_ready=None, header=True):
     s1 = datetime.now()
-    get_data(user_input, startDate, endDate, nasa_outdir)
+    get_data(user_input, startDate, endDate, nasa_outdir, regional=regional, on_ready=on_ready, header=header)
     cf = check_files(user_input, nasa_outdir) #To check that all files requested were downloaded.
     if cf:
-        get_data2(user_input, cf)
+        get_data2(user_input, cf, startDate, endDate, nasa_outdir, regional, on_ready, header)
         if check_files(user_input, nasa_outdir):
-            print('Program terminated. Please check manually NASAPOWER server response.')
-            sys.exit(1)
+            raise NasaPowerError('Program terminated. Please check manually NASAPOWER server response.\n'
+                                 'The data already obtained are kept: run again with --resume to request only the '
+                                 'missing points.')
 
     e1 = datetime.now()
     print("Execution time getting NASAPOWER data: ", str(e1 - s1))
 
-#Function to merge NASAPOWER and CHIRPS data, including the quality control for SRAD.
-def nasachirps(user_input, nasa_outdir, chirps_input, out_dir):
-
-    df_prec = joblib.load(chirps_input)
-    df_prec = df_prec.sort_index(axis=1)
-    d = df_prec.columns.values.tolist()  # All dates available in CHIRPS
-    ids_ch = df_prec.index.values.tolist()  # All IDs available in CHIRPS
-
-    s1 = '{:>6} {:>9} {:>9} {:>7} {:>5} {:>5} {:>5} {:>5}'
-    hdr1 = s1.format("@ INSI", "LAT", "LONG", "ELEV", "TAV", "AMP", "REFHT", "WNDHT" + "\n")
-    s2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
-    hdr3 = s2.format("@  DATE", "T2M", "TMIN", "TMAX", "TDEW", "RHUM", "RAIN2", "WIND", "SRAD", "RAIN")
-
-    try:
-        pt = pd.read_csv(user_input)
-        if out_dir is None:
-            out_dir = os.path.dirname(user_input) + "/DSSAT"
-
-        # Create target Directory if doesn't exist
-        if not os.path.exists(out_dir):
-            os.mkdir(out_dir)
+#Values of SRAD considered missing in the NASAPOWER files.
+MISSING_SRAD = [b'nan', b'-99', b'-99.0', b'-3596.4']
+
+#Quality control for SRAD. Runs of missing values are found with array operations:
+# - one missing value is the mean of its neighbours (or the neighbour value at the start and at the end),
+# - two missing values are interpolated between the neighbours,
+# - three or more missing values (or two at the end) end the series with the last valid value,
+# - two or more missing values (or a single record) at the start give an empty series.
+#It returns the SRAD column (bytes, see wthio.py) and the number of records to keep.
+def srad_qc(solar):
+    n = len(solar)
+    srad = solar.astype(object)
+    i_srad = numpy.flatnonzero(numpy.isin(solar, MISSING_SRAD))  # To find missing srad values
+    if len(i_srad) == 0:
+        return srad, n
+
+    brk = numpy.flatnonzero(numpy.diff(i_srad) != 1) + 1
+    starts = i_srad[numpy.r_[0, brk]]
+    lengths = numpy.diff(numpy.r_[0, brk, len(i_srad)])
+
+    for i, k in zip(starts.tolist(), lengths.tolist()):
+        if i == 0:
+            if k > 1 or n == 1:
+                return srad, 0
+            srad[0] = solar[1]
+        elif k >= 3 or (k == 2 and i + 2 == n):
+            srad[i] = solar[i - 1]
+            return srad, i + 1
+        elif k == 2:
+            a = float(solar[i - 1])
+            b = float(solar[i + 2])
+            srad[i] = str(round(a + (b - a) / 3, 1)).encode()
+            srad[i + 1] = str(round(a + 2 * (b - a) / 3, 1)).encode()
+        elif i + 1 == n:
+            srad[i] = solar[i - 1]
         else:
-            print("Directory ", out_dir, " already exists. Data will be overwritten")
-
-        if nasa_outdir is None:
-            nasa_outdir = os.path.dirname(user_input) + "/NASAP"
-
-        for index, row in pt.iterrows():
-
-            id = int(row['ID'])
-            lat = round(row['Latitude'], 5)
-            lon = round(row['Longitude'], 5)
-            nasa_id = str(int(row['nasapid']))
-
-            with open(nasa_outdir + "/" + nasa_id + ".WTH", "r") as f1:  # Reading nasap files
-                data = [line for line in f1.readlines() if line.strip()]
-                hdr2 = data[11].split()
-                solar = [sr.split()[8] for sr in data[13:]]  # To get solar radiation values
-                i_srad = [i for i, e in enumerate(solar) if
-                          e == 'nan' or e == '-99' or e == '-99.0' or e == '-3596.4']  # To find missing srad values
-
-                with open(out_dir + "/" + str(id) + ".WTH", "w") as f2:  # Writing requested files
-                    f2.write(data[0] + '\n\n' + hdr1 + s1.format(hdr2[0], lat, lon, hdr2[3], hdr2[4], hdr2[5], hdr2[6],
-                                                                 hdr2[7]) +
-                             '\n\n' + hdr3 + '\n')  # Writing the header
-
-                    for index2, row in enumerate(data[13:]):
-                        c = 0  # Controls when to cutoff the end of weather file. c=1 means, the script stops writing rows.
-                        r = row.split()  # row of values one line at a time
-
-                        # SRAD quality control
-                        if index2 in i_srad:
-                            if ((index2 + 1 in i_srad) and (
-                                    index2 + 2 in i_srad) and index2 == 0):  # Three first consecutive records have srad missing values
-                                break
-                            if ((
-                                    index2 + 1 in i_srad) and index2 == 0):  # Two first consecutive records have srad missing values
-                                break
-                            if (len(data[
-                                    13:]) == 1):  # The first record has srad missing value and there is no more data
-                                break
-                            if ((index2 + 1 in i_srad) and (index2 + 2 in i_srad)):
-                                SRAD2 = solar[index2 - 1]  # Three consecutive records have srad missing values
-                                c = 1
-                            elif ((index2 + 1) in i_srad and (index2 + 2) == len(data[13:])):
-                                SRAD2 = solar[index2 - 1]  # Two last records have srad missing values
-                                c = 1
-                            elif (index2 + 1) in i_srad:  # Two consecutive missing values. First value
-                                SRAD2 = round(float(solar[index2 - 1]) + (
-                                        float(solar[index2 + 2]) - float(solar[index2 - 1])) / 3, 1)
-                            elif (index2 - 1) in i_srad:  # Two consecutive missing values. Second value
-                                SRAD2 = round(float(solar[index2 - 2]) + 2 * (
-                                        float(solar[index2 + 1]) - float(solar[index2 - 2])) / 3, 1)
-                            elif (index2 + 1) == len(data[13:]):  # The last record has a srad missing value
-                                SRAD2 = solar[index2 - 1]
-                            elif (index2 == 0):  # The first record has a srad missing value but the next has valid data
-                                SRAD2 = solar[index2 + 1]
-                            else:
-                                SRAD2 = round((float(solar[index2 - 1]) + float(solar[index2 + 1])) / 2,
-                                              1)  # One consecutive missing value
-                        else:
-                            SRAD2 = r[8]  # To keep the original (no missing) value
-
-                        if (r[0] in d) and (
-                                id in ids_ch):  # Evaluates if date from NASA file (r[0]) is in list of dates available in dates of chirps (d) and if the ID is in the CHIRPS
-                            #                            start4 = datetime.now()
-
-                            RAIN_CHIRPS = df_prec.loc[id, r[0]]
-
-                            if RAIN_CHIRPS == -9999.0:
-                                RAIN = r[6]
-                            else:
-                                RAIN = round(float(RAIN_CHIRPS), 1)
-                        else:
-                            RAIN = r[6]
-
-                        f2.write(s2.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2, RAIN) + '\n')
-                        if c == 1:
-                            break
-
-    except KeyboardInterrupt:
-        sys.exit(1)
+            srad[i] = str(round((float(solar[i - 1]) + float(solar[i + 1])) / 2, 1)).encode()
+
+    return srad, n
+
+#To replace the NASAPOWER rain by the CHIRPS rain of the same day. CHIRPS days are aligned by integer day index and
+#missing CHIRPS values (-9999.0) keep the NASAPOWER value. days are the day indexes of the dates of the rows.
+def merge_rain(rain, days, prec, prec_days):
+    pos = numpy.searchsorted(prec_days, days).clip(0, max(len(prec_days) - 1, 0))
+    found = numpy.flatnonzero(prec_days[pos] == days) if len(prec_days) else numpy.array([], dtype=int)
+    found = found[prec[pos[found]] != -9999.0]
+    rain = rain.astype(object)
+    rain[found] = wthio.value_text(prec[pos[found]]).tolist()
+    return rain
+
+#Header formats of the WTH files.
+s1 = '{:>6} {:>9} {:>9} {:>7} {:>5} {:>5} {:>5} {:>5}'
+hdr1 = s1.format("@ INSI", "LAT", "LONG", "ELEV", "TAV", "AMP", "REFHT", "WNDHT" + "\n")
+s2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
+hdr3 = s2.format("@  DATE", "T2M", "TMIN", "TMAX", "TDEW", "RHUM", "RAIN2", "WIND", "SRAD", "RAIN")
+
+#To get the header of the WTH file of a point (lat, lon) from the header lines of the NASAPOWER file of its nasapid.
+def wth_header(data, lat, lon):
+    hdr2 = wthio.header_values(data, '@ INSI')
+    return (data[0] + '\n\n' + hdr1 + s1.format(hdr2[0], lat, lon, hdr2[3], hdr2[4], hdr2[5], hdr2[6], hdr2[7]) +
+            '\n\n' + hdr3 + '\n')
+
+#CHIRPS data shared by the processes that build the WTH files. Each process maps the same precipitation store
+#(see precstore.py) instead of receiving a pickled copy of the data.
+shared = {}
+
+def init_shared(chirps_input, nasa_outdir, out_dir, store=False):
+    ids, pixel, prec_days, prec = store_open(chirps_input)
+    shared['prec'] = prec
+    shared['prec_days'] = prec_days
+    shared['ids_ch'] = dict(zip(ids.tolist(), pixel.tolist()))  # Column of all the IDs available in CHIRPS
+    shared['nasa_outdir'] = nasa_outdir
+    shared['out_dir'] = out_dir
+    shared['store'] = store
+
+#To build the WTH files of all the IDs that share one NASAPOWER file. The NASAPOWER file is parsed only once.
+#It returns the number of files written or, for a WTH store (see wthstore.py), the list of (ID, header, block) to
+#write, as the store is written by a single process.
+def wth_group(group):
+    nasa_id, pts = group
+    data, cols = wthio.read_wth(shared['nasa_outdir'] + "/" + nasa_id + ".WTH")  # Reading nasap files
+    srad, n = srad_qc(cols[8])
+    days = day_index(wthio.dates(cols[0]))
+
+    stations = []
+    for id, lat, lon in pts:
+        if id in shared['ids_ch']:
+            rain = merge_rain(cols[6], days, shared['prec'][shared['ids_ch'][id]], shared['prec_days'])
+        else:
+            rain = cols[6]
+
+        header = wth_header(data, lat, lon)
+        block = wthio.format_block([x[:n] for x in cols[:8]] + [srad[:n], rain[:n]])
+        if shared['store']:
+            stations.append((str(id), header, block))
+            continue
+        wthio.write_wth(shared['out_dir'] + "/" + str(id) + ".WTH", header, block)  # Writing requested files
+
+    return stations if shared['store'] else len(pts)
+
+#To group the IDs by nasapid: {nasapid: [(ID, Latitude, Longitude), ...]}.
+def wth_groups(pt):
+    groups = {}
+    for index, row in pt.iterrows():
+        nasa_id = str(int(row['nasapid']))
+        groups.setdefault(nasa_id, []).append((int(row['ID']), round(row['Latitude'], 5), round(row['Longitude'], 5)))
+    return groups
+
+#Size of the queue of nasapids ready to be built and number of groups being built at the same time by each worker
+#process in the streaming mode. With a WTH store, the WTH files are committed every STORE_COMMIT nasapids.
+STREAM_QUEUE = 1000
+STREAM_INFLIGHT = 4
+STORE_COMMIT = 500
+
+#Function to merge NASAPOWER and CHIRPS data, including the quality control for SRAD, as a stream. The nasapids whose
+#NASAPOWER file is written (see get_data) arrive through the "ready" queue, ended by None. Once the CHIRPS store is
+#complete (the "chirps_ready" event), the WTH files of the IDs of every nasapid are built as soon as it arrives. The
+#groups being built are limited to STREAM_INFLIGHT per worker, so a full "ready" queue makes the downloads wait instead
+#of piling up work in memory. The nasapids whose WTH files were written by the run being resumed are skipped (see
+#checkpoint.py). With store=True the WTH files are written to the store of out_dir (see wthstore.py) by this process.
+def nasachirps_stream(user_input, nasa_outdir, chirps_input, out_dir, ready, chirps_ready, workers=None, store=False):
+    pt = pd.read_csv(user_input)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    groups = wth_groups(pt)
+    n_pt = len(pt)
+    state = {'written': 0}
+
+    #The nasapids that arrive before the CHIRPS store is ready wait in a list (only their names).
+    waiting = []
+    while not chirps_ready.is_set():
+        try:
+            nasa_id = ready.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        waiting.append(nasa_id)
+        if nasa_id is None:
+            break
+    chirps_ready.wait()
+
+    def arrivals():
+        for nasa_id in waiting:
+            yield nasa_id
+        if None not in waiting:
+            for nasa_id in iter(ready.get, None):
+                yield nasa_id
+
+    con = wthstore.connect(out_dir) if store else None
+    committed = []  # nasapids written to the store since the last commit
+
+    #The nasapids are recorded as done (see checkpoint.py) once their files are written or committed.
+    def commit():
+        con.commit()
+        for nasa_id in committed:
+            checkpoint.record('wth_build', nasa_id)
+        del committed[:]
+
+    def written(nasa_id, result, resumed=False):
+        if resumed:
+            n = result
+        elif store:
+            for id, header, block in result:
+                wthstore.put(con, id, header, block)
+            n = len(result)
+            committed.append(nasa_id)
+            if len(committed) >= STORE_COMMIT:
+                commit()
+        else:
+            n = result
+            checkpoint.record('wth_build', nasa_id, [out_dir + "/" + str(x[0]) + ".WTH" for x in groups[nasa_id]])
+        state['written'] += n
+        print('WTH files of nasapid', nasa_id, 'written:', state['written'], 'of', n_pt, 'points.')
+
+    if workers is None:
+        workers = os.cpu_count()
+    initargs = (chirps_input, nasa_outdir, out_dir, store)
+
+    if workers <= 1:
+        init_shared(*initargs)
+        for nasa_id in arrivals():
+            if nasa_id in groups and checkpoint.done('wth_build', nasa_id):
+                written(nasa_id, len(groups[nasa_id]), resumed=True)
+            elif nasa_id in groups:
+                written(nasa_id, wth_group((nasa_id, groups[nasa_id])))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_shared, initargs=initargs) as ex:
+            running = {}
+            for nasa_id in arrivals():
+                if nasa_id not in groups:
+                    continue
+                if checkpoint.done('wth_build', nasa_id):
+                    written(nasa_id, len(groups[nasa_id]), resumed=True)
+                    continue
+                if len(running) >= workers * STREAM_INFLIGHT:
+                    done, pending = wait(running, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        written(running.pop(f), f.result())
+                running[ex.submit(wth_group, (nasa_id, groups[nasa_id]))] = nasa_id
+            for f in as_completed(running):
+                written(running[f], f.result())
+    if store:
+        commit()
+        con.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os, sys
+import json
+import time
+import uuid
+import cProfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+#Metrics of the stages of the get/update pipelines. Every stage writes one JSON line to METRICS_FILE with its wall and
+#CPU time (of the process and of its finished worker processes, so it includes the stages running at the same time),
+#the peak RSS of the process so far, its counters (bytes downloaded, cache hits, HTTP retries...) and, when the number
+#of points is given, the points per second. The stages listed in PROFILE are run under cProfile and the statistics are written to
+#"<PROFILE_DIR>/<run>_<stage>.prof". 'all' profiles every stage but the whole runs ("get" and "update"). Only one
+#stage at a time is profiled: a stage started while another one is profiled is skipped with a warning, and its record
+#has "profile_skipped" (the profiled stage).
+#Nothing is written when METRICS_FILE is None and no stage is profiled. The settings are changed with set_metrics().
+METRICS_FILE = None
+PROFILE = []
+PROFILE_DIR = None
+RUN_ID = uuid.uuid4().hex[:8]
+lock = threading.Lock()
+local = threading.local()  # Counters of the stages open in each thread
+profiling = []  # Only one stage at a time can be profiled; the others are skipped with a warning.
+
+#Stages of the pipelines.
+STAGES = ['chirps_download', 'chirps_extract', 'prec_merge', 'nasa_fetch', 'wth_build', 'wth_merge']
+RUN_STAGES = ['get', 'update']
+
+def set_metrics(metrics_file=None, profile=None, profile_dir=None):
+    global METRICS_FILE, PROFILE, PROFILE_DIR
+    if metrics_file is not None:
+        METRICS_FILE = os.path.abspath(metrics_file)
+    if profile is not None:
+        PROFILE = [x.strip() for x in profile.split(',') if x.strip()]
+    if profile_dir is not None:
+        PROFILE_DIR = os.path.abspath(profile_dir)
+    elif PROFILE_DIR is None:
+        PROFILE_DIR = os.path.dirname(METRICS_FILE) if METRICS_FILE else os.getcwd()
+
+def active():
+    return getattr(local, 'stages', [])
+
+#To add n to a counter of the stages open in the current thread (the stage and the stages that contain it).
+def count(name, n=1):
+    with lock:
+        for counters in active():
+            counters[name] = counters.get(name, 0) + n
+
+#To wrap a function that runs in another thread (download workers, branches of the pipeline) so its counters go to
+#the stages open in the thread that creates it.
+def inherit(func):
+    stages = list(active())
+    def wrapper(*args, **kwargs):
+        local.stages = stages
+        try:
+            return func(*args, **kwargs)
+        finally:
+            local.stages = []
+    return wrapper
+
+def peak_rss_mb():
+    if resource is None:
+        return None, None
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and in KB on Linux.
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+def write_record(record):
+    if METRICS_FILE is None:
+        return
+    with lock:
+        with open(METRICS_FILE, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+#To measure a stage. info (e.g. points=1000, days=365) is written with the record; the number of points can also be
+#set inside the stage with record['points'] = n.
+@contextmanager
+def stage(name, **info):
+    record = {'run': RUN_ID, 'stage': name, 'start': datetime.now().isoformat(timespec='seconds')}
+    record.update(info)
+    counters = {}
+    outer = active()
+    local.stages = outer + [counters]
+    t0 = time.time()
+    c0 = os.times()
+    prof = None
+    if name in PROFILE or ('all' in PROFILE and name not in RUN_STAGES):
+        with lock:
+            other = list(profiling)
+            if not other:
+                profiling.append(name)
+        if other:
+            print('The stage', name, 'is not profiled: the stage', other[0], 'is being profiled.')
+            record['profile_skipped'] = other[0]
+        else:
+            prof = cProfile.Profile()
+            prof.enable()
+    try:
+        yield record
+    except BaseException as err:
+        record['error'] = type(err).__name__
+        raise
+    finally:
+        local.stages = outer
+        if prof is not None:
+            prof.disable()
+            profiling.remove(name)
+            if not os.path.exists(PROFILE_DIR):
+                os.makedirs(PROFILE_DIR)
+            prof.dump_stats(PROFILE_DIR + '/' + RUN_ID + '_' + name + '.prof')
+        c1 = os.times()
+        wall = time.time() - t0
+        record['wall_s'] = round(wall, 3)
+        record['cpu_s'] = round(c1.user + c1.system - c0.user - c0.system, 3)
+        record['cpu_children_s'] = round(c1.children_user + c1.children_system - c0.children_user - c0.children_system, 3)
+        record['peak_rss_mb'], record['peak_rss_children_mb'] = peak_rss_mb()
+        with lock:
+            record['counters'] = dict(counters)
+        if record.get('points'):
+            record['points_per_s'] = round(record['points'] / max(wall, 1e-6), 1)
+        write_record(record)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy
+from datetime import datetime, timedelta
+import cache
+
+#Incremental cache of NASAPOWER responses shared across runs. Each cell is stored under
+#"<cache dir>/nasap/<nasapid>_<key hash>" with the key (nasapid, LatNP, LonNP, parameters, community):
+# - .json: the key, the date ranges (YYYYMMDD, inclusive) already stored and the ICASA headers of the last responses by
+#   the range they were requested for ("YYYYMMDD-YYYYMMDD"),
+# - .txt: the data rows of all the stored days, sorted by date.
+#Only the missing sub-ranges of a request are downloaded and merged into the stored series. The header of a range
+#(TAV, AMP and dates depend on it) is the one of a response for that range: the server computes TAV and AMP from its
+#unrounded values, so they cannot be rebuilt from the stored rows. A range whose header is needed and not stored is
+#requested as a whole (see missing_ranges); only the updates of an archive, which append rows and never use the header,
+#request just the missing days. Otherwise the header is the last one with TAV, AMP and dates computed from the stored
+#rows of the range (or from unrounded values, see cell_header).
+HEADERS_KEPT = 16
+lock = threading.Lock()
+
+#Values of SRAD considered missing (the last days of a series may not have SRAD yet).
+MISSING_SRAD = ['nan', '-99', '-99.0', '-3596.4']
+
+def cell_path(nasa_id, lat_np, lon_np, parameters, community):
+    key = json.dumps([nasa_id, float(lat_np), float(lon_np), parameters, community])
+    return cache.CACHE_DIR + '/nasap/' + nasa_id + '_' + hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def read_cell(path):
+    try:
+        with open(path + '.json', 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'ranges': [], 'headers': {}}
+
+#To get the sub-ranges of [start, end] (YYYYMMDD strings) that are not stored yet for a cell. A cell without headers
+#(e.g. written by an older version) is requested again, and so is the whole range when header is True and the header
+#of the range is not stored.
+def missing_ranges(path, start, end, header=True):
+    cell = read_cell(path)
+    if not cell.get('headers') or (header and start + '-' + end not in cell['headers']):
+        return [(start, end)]
+    dt_s = datetime.strptime(start, '%Y%m%d')
+    dt_e = datetime.strptime(end, '%Y%m%d')
+    missing = []
+    for s, e in sorted(cell['ranges']):
+        s = datetime.strptime(str(s), '%Y%m%d')
+        e = datetime.strptime(str(e), '%Y%m%d')
+        if e < dt_s or s > dt_e:
+            continue
+        if s > dt_s:
+            missing.append((dt_s, s - timedelta(days=1)))
+        dt_s = max(dt_s, e + timedelta(days=1))
+    if dt_s <= dt_e:
+        missing.append((dt_s, dt_e))
+    return [(s.strftime('%Y%m%d'), e.strftime('%Y%m%d')) for s, e in missing]
+
+#To add a range to a list of ranges, joining the ranges that overlap or touch.
+def add_range(ranges, start, end):
+    merged = []
+    for s, e in sorted(ranges + [[int(start), int(end)]]):
+        if merged:
+            last = datetime.strptime(str(merged[-1][1]), '%Y%m%d') + timedelta(days=1)
+            if int(last.strftime('%Y%m%d')) >= s:
+                merged[-1][1] = max(merged[-1][1], e)
+                continue
+        merged.append([s, e])
+    return merged
+
+#To split an ICASA response into its header lines and its data rows (only rows for the rows of a regional response).
+def split_icasa(text):
+    lines = [line for line in text.splitlines() if line.strip()]
+    for i, line in enumerate(lines):
+        if line.startswith('@') and 'DATE' in line:
+            return lines[:i + 1], lines[i + 1:]
+    if lines and lines[0].split()[0].isdigit():
+        return [], lines
+    return lines, []
+
+#To merge a response for [start, end] into the stored series of a cell. The days at the end of the response without
+#SRAD are kept but not recorded as stored, so they are requested again in the next run. The header of the response is
+#kept for its range (the HEADERS_KEPT last ones); responses without header are rows of a regional response (see
+#nasapregional.py). The rows of a cell without headers (written by an older version) are replaced.
+def merge_cell(path, key, text, start, end):
+    header, rows = split_icasa(text)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with lock, cache.file_lock(path):  # Other processes (e.g. shards) share the cache.
+        cell = read_cell(path)
+        data = {}
+        if header and not cell.get('headers'):
+            cell['ranges'] = []
+        elif os.path.exists(path + '.txt'):
+            with open(path + '.txt', 'r') as f:
+                data = {line.split()[0]: line for line in f.read().splitlines() if line.strip()}
+        for row in rows:
+            data[row.split()[0]] = row
+
+        valid = [row.split()[0] for row in rows if row.split()[8] not in MISSING_SRAD]
+        if valid:
+            last = datetime.strptime(valid[-1], '%Y%j').strftime('%Y%m%d')
+            cell['ranges'] = add_range(cell['ranges'], start, min(end, last))
+        cell['key'] = key
+        if header:
+            headers = cell.get('headers', {})
+            headers.pop(start + '-' + end, None)
+            headers[start + '-' + end] = header  # The last one at the end
+            cell['headers'] = dict(list(headers.items())[-HEADERS_KEPT:])
+
+        with open(path + '.txt.tmp', 'w') as f:
+            f.write('\n'.join(data[d] for d in sorted(data)) + '\n')
+        os.replace(path + '.txt.tmp', path + '.txt')
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(cell, f)
+        os.replace(path + '.json.tmp', path + '.json')
+
+#To get the TAV (mean temperature) and the AMP (range of the monthly mean temperatures) of the ICASA rows (T2M is the
+#second column, missing values as for SRAD). It returns -99.0 for both when there is no temperature.
+def tav_amp(rows):
+    cols = [row.split() for row in rows]
+    t2m = numpy.array([float(x[1]) for x in cols if x[1] not in MISSING_SRAD])
+    months = numpy.array([datetime.strptime(x[0], '%Y%j').month for x in cols if x[1] not in MISSING_SRAD])
+    if not len(t2m):
+        return -99.0, -99.0
+    monthly = [t2m[months == m].mean() for m in numpy.unique(months)]
+    return t2m.mean(), max(monthly) - min(monthly)
+
+#To replace some values of a line of fixed-width values {position: text}, keeping the end of each value in its place.
+def set_values(line, values):
+    spans = [m.span() for m in re.finditer(r'\S+', line)]
+    for k in sorted(values, reverse=True):
+        s, e = spans[k]
+        text = values[k].rjust(e - s)
+        line = line[:e - len(text)] + text + line[e:]
+    return line
+
+#To get the stored rows of a cell for [start, end] (YYYYMMDD strings, default: all).
+def cell_rows(path, start='19000101', end='29991231'):
+    dt_s = datetime.strptime(start, '%Y%m%d').strftime('%Y%j')
+    dt_e = datetime.strptime(end, '%Y%m%d').strftime('%Y%j')
+    with open(path + '.txt', 'r') as f:
+        return [line for line in f.read().splitlines() if line.strip() and dt_s <= line.split()[0] <= dt_e]
+
+#To get the ICASA header lines of a cell for [start, end] (YYYYMMDD strings): the header of a response for that range,
+#otherwise the last header with the TAV and AMP of the stored rows of the range (or means, (TAV, AMP)) and its dates.
+#It returns None when the cell has no header.
+def cell_header(path, start, end, rows=None, means=None):
+    headers = read_cell(path).get('headers', {})
+    if start + '-' + end in headers:
+        return headers[start + '-' + end]
+    if not headers:
+        return None
+    name, header = list(headers.items())[-1]
+    first, last = name.split('-')
+    tav, amp = means or tav_amp(cell_rows(path, start, end) if rows is None else rows)
+    result = []
+    for k, line in enumerate(header):
+        if k and header[k - 1].startswith('@ INSI'):
+            line = set_values(line, {4: '{:.1f}'.format(tav), 5: '{:.1f}'.format(amp)})
+        elif line.startswith('!'):
+            line = re.sub(first + '(.*?)' + last, start + r'\g<1>' + end, line, count=1)
+        result.append(line)
+    return result
+
+#To render the stored series of a cell for [start, end] (YYYYMMDD strings) as an ICASA text.
+def cell_text(path, start, end):
+    rows = cell_rows(path, start, end)
+    return '\n'.join(cell_header(path, start, end, rows) + rows) + '\n'
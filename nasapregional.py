@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import os
+import re
+import math
+import numpy
+from datetime import datetime
+
+#Regional batch mode for NASAPOWER. Neighbouring cells are grouped in boxes that fit the limits of the regional
+#endpoint, each box is requested once (one request per group of parameters) and the response is split back into the
+#ICASA data rows of each cell, written with the layout of the rows of a point response of the cell. The header of a
+#cell always comes from a point response (see getnasap.get_data and nasapcache.cell_header), so the WTH files are the
+#same as in point mode. The endpoint can be changed with the NASAPCHIRPS_REGIONAL_URL environment variable.
+REGIONAL_URL = os.environ.get('NASAPCHIRPS_REGIONAL_URL', 'https://power.larc.nasa.gov/api/temporal/daily/regional')
+REGIONAL_MIN_SPAN = 2.0  # Smallest side of a regional box (degrees)
+REGIONAL_MAX_SPAN = 10.0  # Largest side of a regional box (degrees)
+REGIONAL_MAX_PARAMETERS = 1  # Parameters per regional request
+REGIONAL_MIN_CELLS = 4  # Boxes with fewer cells are requested point by point
+
+#NASAPOWER parameters of each ICASA column (DATE T2M TMIN TMAX TDEW RH2M RAIN WIND SRAD).
+ICASA_PARAMETERS = ['T2M', 'T2M_MIN', 'T2M_MAX', 'T2MDEW', 'RH2M', 'PRECTOTCORR', 'WS2M', 'ALLSKY_SFC_SW_DWN']
+MISSING_VALUES = ['nan', '-99', '-99.0', '-999', '-999.0']
+
+#To group the cells [(nasapid, LatNP, LonNP), ...] in boxes that fit in REGIONAL_MAX_SPAN. Cells are put in tiles of
+#the grid and each box is the bounding box of its cells, at least REGIONAL_MIN_SPAN wide.
+def group_cells(cells):
+    tile = REGIONAL_MAX_SPAN - 1.0  # Margin for the half cell around the centers
+    tiles = {}
+    for nasa_id, lat, lon in cells:
+        tiles.setdefault((math.floor(lat / tile), math.floor(lon / tile)), []).append((nasa_id, lat, lon))
+
+    boxes = []
+    for members in tiles.values():
+        lats = [x[1] for x in members]
+        lons = [x[2] for x in members]
+        bbox = []
+        for lo, hi, limit in [(min(lats), max(lats), 90.0), (min(lons), max(lons), 180.0)]:
+            pad = max(0.5, (REGIONAL_MIN_SPAN - (hi - lo)) / 2)
+            bbox += [max(-limit, lo - pad), min(limit, hi + pad)]
+        boxes.append({'cells': members, 'bbox': bbox})
+    return boxes
+
+#To get the parameters of the regional requests of a box, one per group of REGIONAL_MAX_PARAMETERS parameters.
+def regional_params(bbox, start, end, community='AG'):
+    params = []
+    for i in range(0, len(ICASA_PARAMETERS), REGIONAL_MAX_PARAMETERS):
+        params.append({'parameters': ','.join(ICASA_PARAMETERS[i:i + REGIONAL_MAX_PARAMETERS]), 'community': community,
+                       'latitude-min': round(bbox[0], 4), 'latitude-max': round(bbox[1], 4),
+                       'longitude-min': round(bbox[2], 4), 'longitude-max': round(bbox[3], 4),
+                       'start': start, 'end': end, 'format': 'JSON'})
+    return params
+
+#To get the layout of ICASA rows: the width and the decimals of every column, from the rows of a point response (the
+#decimals of a column are those of its first value that is not missing).
+def row_format(rows):
+    spans = [m.span() for m in re.finditer(r'\S+', rows[0])]
+    widths = [e - (spans[k - 1][1] if k else 0) for k, (s, e) in enumerate(spans)]
+    decimals = [None] * len(spans)
+    for row in rows:
+        for k, v in enumerate(row.split()[:len(spans)]):
+            if decimals[k] is None and v not in MISSING_VALUES:
+                decimals[k] = len(v.split('.')[1]) if '.' in v else 0
+        if None not in decimals:
+            break
+    return widths, [1 if x is None else x for x in decimals]
+
+#To write the ICASA rows of one cell from its daily values {parameter: {YYYYMMDD: value or None when missing}} with the
+#layout of the rows of a point response (see row_format).
+def regional_rows(values, rows):
+    widths, decimals = row_format(rows)
+    lines = []
+    for d in sorted(values.get('T2M', {})):
+        row = [datetime.strptime(d, '%Y%m%d').strftime('%Y%j').rjust(widths[0])]
+        for k, p in enumerate(ICASA_PARAMETERS, 1):
+            v = values.get(p, {}).get(d)
+            row.append(('-99' if v is None else '{:.{}f}'.format(v, decimals[k])).rjust(widths[k]))
+        lines.append(''.join(row))
+    return '\n'.join(lines) + '\n'
+
+#To get the TAV (mean temperature) and the AMP (range of the monthly mean temperatures) of the daily values of a cell,
+#as the point responses have them (from the values, not from the rounded ICASA rows).
+def regional_tav_amp(values):
+    t2m = {d: v for d, v in values.get('T2M', {}).items() if v is not None}
+    if not t2m:
+        return -99.0, -99.0
+    dates = sorted(t2m)
+    temps = numpy.array([t2m[d] for d in dates], dtype=float)
+    months = numpy.array([d[4:6] for d in dates])
+    monthly = [temps[months == m].mean() for m in numpy.unique(months)]
+    return temps.mean(), max(monthly) - min(monthly)
+
+#To split the regional responses (GeoJSON) of a box into the daily values of each cell. Each cell takes the grid point
+#of the response closest to (LatNP, LonNP). It returns {nasapid: {parameter: {YYYYMMDD: value or None when missing}}}.
+def split_regional(responses, cells):
+    points = {}
+    fill_value = -999.0
+    for resp in responses:
+        fill_value = resp.get('header', {}).get('fill_value', fill_value)
+        for feature in resp['features']:
+            lon, lat = feature['geometry']['coordinates'][:2]
+            points.setdefault((round(lat, 4), round(lon, 4)), {}).update(feature['properties']['parameter'])
+
+    keys = list(points)
+    coords = numpy.array(keys, dtype=float).reshape(-1, 2)
+    values = {}
+    for nasa_id, lat, lon in cells:
+        if not keys:
+            break
+        k = keys[int(numpy.argmin((coords[:, 0] - lat) ** 2 + (coords[:, 1] - lon) ** 2))]
+        if abs(k[0] - lat) > 0.5 or abs(k[1] - lon) > 0.625:
+            continue  # The cell is not in the response.
+        values[nasa_id] = {p: {d: None if v == fill_value else v for d, v in x.items()} for p, x in points[k].items()}
+    return values
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import numpy
+
+#Writer of CHIRPS-like NetCDF files (classic format), used for the spatial subsets of CHIRPS and by the benchmarks.
+#It needs only NumPy, so the files can be written without the NetCDF library.
+
+#NetCDF classic format codes.
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_TYPES = {'c': (2, 1, 'S1'), 'i': (4, 4, '>i4'), 'f': (5, 4, '>f4'), 'd': (6, 8, '>f8')}  # code, size and dtype of each type
+
+def nc_name(name):
+    b = name.encode()
+    return struct.pack('>i', len(b)) + b + b'\0' * (-len(b) % 4)
+
+#To encode a list of attributes [(name, type, value), ...]. Text attributes are of type 'c'.
+def nc_attrs(attrs):
+    if not attrs:
+        return struct.pack('>ii', 0, 0)
+    out = struct.pack('>ii', NC_ATTRIBUTE, len(attrs))
+    for name, t, value in attrs:
+        code, size, dtype = NC_TYPES[t]
+        data = value.encode() if t == 'c' else numpy.asarray(value, dtype=dtype).reshape(-1).tobytes()
+        out += nc_name(name) + struct.pack('>ii', code, len(data) // size) + data + b'\0' * (-len(data) % 4)
+    return out
+
+#To write a classic NetCDF file (64-bit offset format) with the layout of the CHIRPS daily files: dimensions
+#time x latitude x longitude, "time" in days since 1980-1-1 and "precip" as float32 with -9999 as fill value.
+#lat and lon are the pixel centers (latitude ascending, as in CHIRPS) and bands yields one (lat x lon) array per day,
+#so the file is written one band at a time. The coordinates are float32 as in CHIRPS or float64 with coord_type='d'.
+def write_nc(path, times, lat, lon, bands, units='days since 1980-1-1 0:0:0', title='CHIRPS', coord_type='f'):
+    dims = [('time', len(times)), ('latitude', len(lat)), ('longitude', len(lon))]
+    fill = [('_FillValue', 'f', -9999.0), ('missing_value', 'f', -9999.0)]
+    variables = [('time', [0], [('units', 'c', units), ('calendar', 'c', 'gregorian'), ('axis', 'c', 'T')], 'i'),
+                 ('latitude', [1], [('units', 'c', 'degrees_north'), ('axis', 'c', 'Y')], coord_type),
+                 ('longitude', [2], [('units', 'c', 'degrees_east'), ('axis', 'c', 'X')], coord_type),
+                 ('precip', [0, 1, 2], [('units', 'c', 'mm/day')] + fill, 'f')]
+    sizes = [numpy.prod([dims[d][1] for d in var[1]]) * NC_TYPES[var[3]][1] for var in variables]
+
+    def header(begins):
+        out = b'CDF\x02' + struct.pack('>i', 0)
+        out += struct.pack('>ii', NC_DIMENSION, len(dims)) + b''.join(nc_name(n) + struct.pack('>i', k) for n, k in dims)
+        out += nc_attrs([('Conventions', 'c', 'CF-1.6'), ('title', 'c', title)])
+        out += struct.pack('>ii', NC_VARIABLE, len(variables))
+        for (name, dimids, attrs, t), size, begin in zip(variables, sizes, begins):
+            out += nc_name(name) + struct.pack('>i', len(dimids)) + b''.join(struct.pack('>i', d) for d in dimids)
+            out += nc_attrs(attrs) + struct.pack('>iIq', NC_TYPES[t][0], min(size, 2 ** 32 - 1), begin)
+        return out
+
+    offset = len(header([0] * len(variables)))
+    begins = list(numpy.cumsum([offset] + sizes[:-1]))
+    with open(path + '.tmp', 'wb') as f:
+        f.write(header(begins))
+        f.write(numpy.asarray(times, dtype='>i4').tobytes())
+        f.write(numpy.asarray(lat, dtype=NC_TYPES[coord_type][2]).tobytes())
+        f.write(numpy.asarray(lon, dtype=NC_TYPES[coord_type][2]).tobytes())
+        for band in bands:
+            f.write(numpy.asarray(band, dtype='>f4').tobytes())
+    os.replace(path + '.tmp', path)
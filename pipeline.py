@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import threading
+from metrics import inherit
+
+#To run a graph of tasks {name: (function, [names of the tasks it depends on])}. Every task starts in its own thread
+#as soon as all its dependencies are done, so the independent branches (e.g. NASAPOWER and CHIRPS) run at the same
+#time. When a task fails, no other task is started and the error is raised again in the calling thread.
+#It returns {name: result of the task}.
+def run_graph(tasks):
+    for name, (func, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise ValueError('Task ' + name + ' depends on the unknown task ' + dep)
+
+    cond = threading.Condition()
+    results = {}
+    errors = []
+    running = set()
+    pending = dict(tasks)
+
+    def run(name, func):
+        try:
+            result = func()
+        except BaseException as err:  # sys.exit() in a task also stops the pipeline.
+            with cond:
+                errors.append(err)
+                running.discard(name)
+                cond.notify_all()
+        else:
+            with cond:
+                results[name] = result
+                running.discard(name)
+                cond.notify_all()
+
+    with cond:
+        while True:
+            if errors:
+                raise errors[0]
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    running.add(name)
+                    t = threading.Thread(target=inherit(run), args=(name, func), name=name)
+                    t.daemon = True
+                    t.start()
+            if not running:
+                if pending:
+                    raise ValueError('Circular dependencies between the tasks: ' + ', '.join(pending))
+                return results
+            cond.wait(0.5)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import numpy
+from datetime import datetime, timedelta
+
+#Precipitation store. A directory with:
+# - ids.npy: the ID of each point (int64),
+# - pixel.npy: the column of each point (int64). Points in the same CHIRPS pixel share a column, so each series is
+#   read and stored once,
+# - meta.json: the day index of the first day ("day0", days since 1970-01-01), the number of days, of points and of
+#   columns ("npixels"),
+# - prec.f32: the float32 values, one row of all the columns per day.
+#The rows are days, so new days are appended at the end of prec.f32 without rewriting it, and the columns x days matrix
+#is a zero-copy transposed view of the memory map. Missing days are stored as -9999.0.
+
+#To convert dates in DSSAT format ('%Y%j') into an integer day index (days since 1970-01-01).
+def day_index(dates):
+    dates = numpy.asarray(dates, dtype=numpy.int64)
+    years = (dates // 1000 - 1970).astype('datetime64[Y]')
+    return years.astype('datetime64[D]').astype(numpy.int64) + dates % 1000 - 1
+
+#To convert a day index into a datetime.
+def index_date(day):
+    return datetime(1970, 1, 1) + timedelta(days=int(day))
+
+def read_meta(path):
+    with open(path + '/meta.json', 'r') as f:
+        return json.load(f)
+
+def write_meta(path, meta):
+    with open(path + '/meta.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '/meta.json.tmp', path + '/meta.json')
+
+#To create an empty store for the points ids. pixel is the column of each point (default: one column per point).
+def store_create(path, ids, pixel=None):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if pixel is None:
+        pixel = numpy.arange(len(ids))
+    numpy.save(path + '/ids.npy', numpy.asarray(ids, dtype=numpy.int64))
+    numpy.save(path + '/pixel.npy', numpy.asarray(pixel, dtype=numpy.int64))
+    open(path + '/prec.f32', 'wb').close()
+    write_meta(path, {'day0': None, 'ndays': 0, 'npoints': len(ids), 'npixels': int(max(pixel, default=-1)) + 1})
+
+#To append the values of the days (day indexes, sorted) with shape (days, columns). Days already in the store are
+#skipped and the days between the end of the store and the first new day are filled with -9999.0.
+def store_append(path, days, values):
+    meta = read_meta(path)
+    days = numpy.asarray(days, dtype=numpy.int64)
+    if meta['day0'] is None:
+        meta['day0'] = int(days[0]) if len(days) else None
+    if meta['day0'] is None:
+        return
+    end = meta['day0'] + meta['ndays']  # Index of the first day not in the store
+    new = days >= end
+    if not new.any():
+        return
+
+    block = numpy.full((int(days[new].max()) - end + 1, meta['npixels']), -9999.0, dtype=numpy.float32)
+    block[days[new] - end] = values[new]
+    with open(path + '/prec.f32', 'r+b') as f:
+        f.seek(meta['ndays'] * meta['npixels'] * 4)  # Values of an interrupted append are overwritten.
+        f.write(block.tobytes())
+        f.truncate()
+    meta['ndays'] += len(block)
+    write_meta(path, meta)
+
+#To open a store. It returns the IDs, the column of each ID, the day index of each day and the columns x days matrix
+#(read-only memory map). The series of the i-th point is prec[pixel[i]].
+def store_open(path):
+    meta = read_meta(path)
+    ids = numpy.load(path + '/ids.npy')
+    pixel = numpy.load(path + '/pixel.npy')
+    days = numpy.arange(meta['ndays'], dtype=numpy.int64) + (meta['day0'] or 0)
+    if meta['ndays'] == 0 or meta['npixels'] == 0:  # An empty file cannot be mapped.
+        return ids, pixel, days, numpy.zeros((meta['npixels'], meta['ndays']), dtype=numpy.float32)
+    prec = numpy.memmap(path + '/prec.f32', dtype=numpy.float32, mode='r', shape=(meta['ndays'], meta['npixels']))
+    return ids, pixel, days, prec.T
+
+#To move a store to path, replacing the store there.
+def store_move(src, path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(src, path)
+
+#To get the list of the files of a store.
+def store_files(path):
+    return [path + '/ids.npy', path + '/pixel.npy', path + '/meta.json', path + '/prec.f32']
+
+#To get the last day of a store as a datetime (None when the store is empty).
+def store_last_date(path):
+    meta = read_meta(path)
+    if not meta['ndays']:
+        return None
+    return index_date(meta['day0'] + meta['ndays'] - 1)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+import os, sys
+import re
+import json
+import time
+import queue
+import threading
+import requests
+import numpy
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from osgeo import gdal
+from osgeo.gdalconst import *
+import wthio
+from chirps import CHIRPS_URL, nc_dates, read_points
+from cache import cache_get
+from download import make_session, download_all
+from precstore import day_index, index_date
+from nasapcache import cell_path, missing_ranges, merge_cell, cell_header
+from getnasap import NASA_URL, backoff, srad_qc, merge_rain, wth_header
+
+#Local HTTP service that returns the WTH file of a single point for a date range, without the startup of a run:
+#   GET /wth?lat=-1.14&lon=34.47&start=20200101&end=20201231 (optional: nasapid, latnp and lonnp of the CSV of the
+#   points, otherwise the NASAPOWER cell of the point; id, the name of the file)
+#   GET /metrics (JSON: requests, latency, batches and caches)
+#The service keeps warm what a run opens again every time:
+# - the NASAPOWER series of the last POWER_CACHE cells, parsed, on top of the NASAPOWER cache of the runs (see
+#   nasapcache.py), so only the days missing there are requested,
+# - the last RASTER_CACHE CHIRPS files open, with their dates. The files are the global NetCDF files of the download
+#   cache of the runs (see cache.py), so a point anywhere is served from the same files. Preliminary files and the
+#   corrected months not published yet are checked again on the server after CHECK_TTL seconds.
+#The requests that arrive within BATCH_WAIT seconds are served together (up to BATCH_MAX): every NASAPOWER cell is
+#fetched once and every CHIRPS file is read once for all their pixels. The WTH files are built with the SRAD QC and the
+#rain merge of nasachirps, so they are the same as the files of a "get" run.
+POWER_CACHE = 1024
+RASTER_CACHE = 512  # About 40 years of monthly files
+BATCH_WAIT = 0.02
+BATCH_MAX = 64
+CHECK_TTL = 3600
+REQUEST_TIMEOUT = 600
+POWER_RETRIES = 5
+READ_TILE = 128  # Pixels of a batch closer than this are read in one window (see read_rain).
+
+lock = threading.Lock()
+stats = {'requests': 0, 'errors': 0, 'batches': 0, 'batched_requests': 0, 'power_hits': 0, 'power_misses': 0,
+         'power_requests': 0, 'raster_hits': 0, 'raster_misses': 0}
+latencies = deque(maxlen=1000)  # Seconds of the last requests
+power = OrderedDict()  # Cell path: (mtime of the series, columns)
+rasters = OrderedDict()  # File path: (mtime, dataset, day index of the bands)
+checked = {}  # CHIRPS file name: (time of the check, path or None when it is not on the server)
+pending = queue.Queue()  # (query, future)
+
+def tally(name, n=1):
+    with lock:
+        stats[name] += n
+
+#To get the NASAPOWER cell (nasapid, LatNP, LonNP) of a point: the values of the query or the nearest point of the
+#MERRA-2 grid (0.5 x 0.625 degrees) with its position in the grid (row-major, from the south-west corner) as nasapid.
+#It raises KeyError or ValueError when the nasapid of the query comes without a valid latnp and lonnp.
+def power_cell(query, lat, lon):
+    if 'nasapid' in query:
+        cell = str(int(query['nasapid'])), round(float(query['latnp']), 4), round(float(query['lonnp']), 4)
+        if not (-90 <= cell[1] <= 90 and -180 <= cell[2] <= 180):
+            raise ValueError('latnp/lonnp out of range')
+        return cell
+    row = int(round(lat / 0.5))
+    col = int(round(lon / 0.625))
+    return str((row + 180) * 576 + (col + 288) + 1), round(row * 0.5, 4), round(col * 0.625, 4)
+
+#To get the NASAPOWER series of a cell for [start, end] (YYYYMMDD) as the path of the cell in the cache and the
+#columns of its rows (see wthio.py); the header depends on the range of each request (see nasapcache.cell_header).
+#The days missing in the NASAPOWER cache are requested first. It returns None when they could not be downloaded.
+def power_series(s, nasa_id, lat_np, lon_np, start, end):
+    cell = cell_path(nasa_id, lat_np, lon_np, 'T2M', 'AG')
+    for a, b in missing_ranges(cell, start, end):
+        params = {'parameters': 'T2M', 'community': 'AG', 'longitude': lon_np, 'latitude': lat_np,
+                  'start': a, 'end': b, 'format': 'ICASA'}
+        for attempt in range(POWER_RETRIES + 1):
+            try:
+                response = s.get(NASA_URL, params=params, timeout=80)
+                response.raise_for_status()
+                break
+            except requests.exceptions.RequestException as err:
+                retry_after = err.response.headers.get('Retry-After') if err.response is not None else None
+                time.sleep(backoff(attempt, retry_after))
+        else:
+            return None
+        tally('power_requests')
+        merge_cell(cell, [nasa_id, float(lat_np), float(lon_np), 'T2M', 'AG'], response.text, a, b)
+    if not os.path.exists(cell + '.txt'):
+        return None
+
+    mtime = os.path.getmtime(cell + '.txt')
+    with lock:
+        entry = power.get(cell)
+        if entry is not None and entry[0] == mtime:
+            power.move_to_end(cell)
+    if entry is None or entry[0] != mtime:
+        tally('power_misses')
+        with open(cell + '.txt', 'rb') as f:
+            cols = wthio.parse_block(f.read(), 9)  # DATE T2M TMIN TMAX TDEW RH2M RAIN WIND SRAD
+        entry = (mtime, cols)
+        with lock:
+            power[cell] = entry
+            while len(power) > POWER_CACHE:
+                power.popitem(last=False)
+    else:
+        tally('power_hits')
+
+    mtime, cols = entry
+    dates = wthio.dates(cols[0])
+    sel = (dates >= int(datetime.strptime(start, '%Y%m%d').strftime('%Y%j'))) & \
+          (dates <= int(datetime.strptime(end, '%Y%m%d').strftime('%Y%j')))
+    return cell, [x[sel] for x in cols]
+
+#To get a CHIRPS file of the download cache (see get_correc_nc and get_prelim_nc). The files that are not on the
+#server and the preliminary files (they change) are checked again after CHECK_TTL seconds.
+def chirps_file(s, url, name, immutable):
+    with lock:
+        entry = checked.get(name)
+    if entry is not None:
+        when, path = entry
+        if path is not None and immutable and os.path.exists(path):
+            return path
+        if time.time() - when < CHECK_TTL and (path is None or os.path.exists(path)):
+            return path
+    path = cache_get(s, url, name, immutable=immutable)
+    with lock:
+        checked[name] = (time.time(), path)
+    return path
+
+def corrected_file(s, yymm):
+    nc_name = 'chirps-v2.0.' + yymm[:4] + '.' + yymm[4:] + '.days_p05.nc'
+    return chirps_file(s, CHIRPS_URL + '/global_daily/netcdf/p05/by_month/' + nc_name, 'chirps/by_month/' + nc_name, True)
+
+def prelim_file(s, year):
+    nc_name = 'chirps-v2.0.' + str(year) + '.days_p05.nc'
+    return chirps_file(s, CHIRPS_URL + '/prelim/global_daily/fixed/netcdf/' + nc_name, 'chirps/prelim/' + nc_name, False)
+
+#To get an open CHIRPS file and the day index of its bands. A file changed since it was opened is opened again.
+def open_raster(path):
+    mtime = os.path.getmtime(path)
+    with lock:
+        entry = rasters.get(path)
+        if entry is not None and entry[0] == mtime:
+            rasters.move_to_end(path)
+            stats['raster_hits'] += 1
+            return entry[1], entry[2]
+    tally('raster_misses')
+    dsi = gdal.Open(path, GA_ReadOnly)
+    if dsi is None:
+        print('Could not open NetCDF file', path)
+        return None, None
+    entry = (mtime, dsi, day_index(nc_dates(dsi)))
+    with lock:
+        rasters[path] = entry
+        while len(rasters) > RASTER_CACHE:
+            rasters.popitem(last=False)
+    return entry[1], entry[2]
+
+#To get the CHIRPS files of [dt_s, dt_e] as (path, first day index used): the corrected months available, then the
+#preliminary years for the days after the last corrected day (see precmerge).
+def chirps_files(s, dt_s, dt_e):
+    months = []
+    month = dt_s.replace(day=1)
+    while month <= dt_e:
+        months.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    files = [(path, None) for path in download_all(lambda m: corrected_file(s, m.strftime('%Y%m')), months)
+             if path is not None]
+    days = open_raster(files[-1][0])[1] if files else None
+    dt_s_p = dt_s if days is None or not len(days) else index_date(int(days[-1])) + timedelta(days=1)
+    if dt_s_p > dt_e:
+        return files
+    first = int(day_index([dt_s_p.strftime('%Y%j')])[0])
+    years = list(range(dt_s_p.year, dt_e.year + 1))
+    return files + [(path, first) for path in download_all(lambda y: prelim_file(s, y), years) if path is not None]
+
+#To read the CHIRPS precipitation of the points (lat, lon) from the files each of them needs (jobs: list of the
+#(path, first day index) of each point). Every file is read once for all the points that need it, in windows of
+#READ_TILE pixels. It returns the (prec, prec_days) of each point.
+def read_rain(points, jobs):
+    parts = [[] for _ in points]
+    needs = OrderedDict()
+    for k, files in enumerate(jobs):
+        for path, first in files:
+            needs.setdefault(path, []).append((k, first))
+    for path, users in needs.items():
+        dsi, days = open_raster(path)
+        if dsi is None:
+            continue
+        gt = dsi.GetGeoTransform()
+        ks = numpy.array([k for k, _ in users])
+        px = ((numpy.array([points[k][1] for k in ks]) - gt[0]) / gt[1]).astype(int)
+        py = ((numpy.array([points[k][0] for k in ks]) - gt[3]) / gt[5]).astype(int)
+        values = numpy.empty((len(days), len(ks)))
+        tiles = {}
+        for i, key in enumerate(zip((px // READ_TILE).tolist(), (py // READ_TILE).tolist())):
+            tiles.setdefault(key, []).append(i)
+        for sel in tiles.values():
+            values[:, sel] = read_points(dsi, px[sel], py[sel])
+        for i, (k, first) in enumerate(users):
+            keep = slice(None) if first is None else days >= first
+            parts[k].append((days[keep], values[keep, i]))
+    rain = []
+    for part in parts:
+        if not part:
+            rain.append((numpy.array([]), numpy.array([], dtype=numpy.int64)))
+            continue
+        prec_days = numpy.concatenate([x[0] for x in part])
+        prec = numpy.concatenate([x[1] for x in part])
+        order = numpy.argsort(prec_days, kind='stable')
+        rain.append((prec[order], prec_days[order]))
+    return rain
+
+#To read the query of a WTH request. It raises ValueError when it is not valid.
+def parse_query(query):
+    lat = round(float(query['lat']), 5)
+    lon = round(float(query['lon']), 5)
+    dt_s = datetime.strptime(query['start'], '%Y%m%d')
+    dt_e = datetime.strptime(query['end'], '%Y%m%d')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or dt_s > dt_e:
+        raise ValueError('lat/lon out of range or start after end')
+    return lat, lon, dt_s, dt_e
+
+#To serve a batch of requests [(query, future)]: the NASAPOWER cells and the CHIRPS files are fetched once for the
+#batch and the WTH file of every point is built as in wth_group. An error in a request (its query, its NASAPOWER cell,
+#its CHIRPS files or its WTH file) is set on its own future, so the other requests of the batch are still served.
+def serve_batch(s, batch):
+    tally('batches')
+    tally('batched_requests', len(batch))
+    todo = []
+    for query, future in batch:
+        try:
+            lat, lon, dt_s, dt_e = parse_query(query)
+            todo.append((future, power_cell(query, lat, lon), (lat, lon, dt_s, dt_e)))
+        except (KeyError, ValueError) as err:
+            future.set_exception(err)
+    if not todo:
+        return
+    futures, cells, points = zip(*todo)
+    ranges = {}
+    for cell, (lat, lon, dt_s, dt_e) in zip(cells, points):
+        r = ranges.setdefault(cell, [dt_s, dt_e])
+        r[0], r[1] = min(r[0], dt_s), max(r[1], dt_e)
+
+    #The errors are returned as results, so download_all gets the results of the other cells and points.
+    def cell_series(c):
+        try:
+            return power_series(s, c[0], c[1], c[2], ranges[c][0].strftime('%Y%m%d'), ranges[c][1].strftime('%Y%m%d'))
+        except Exception as err:
+            return err
+    def point_files(p):
+        try:
+            return chirps_files(s, p[2], p[3])
+        except Exception as err:
+            return err
+    series = dict(zip(ranges, download_all(cell_series, list(ranges))))
+    jobs = [point_files(p) for p in points]
+    rain = read_rain(points, [[] if isinstance(x, Exception) else x for x in jobs])
+
+    for future, cell, (lat, lon, dt_s, dt_e), files, (prec, prec_days) in zip(futures, cells, points, jobs, rain):
+        try:
+            for err in [series[cell], files]:
+                if isinstance(err, Exception):
+                    raise err
+            if series[cell] is None:
+                raise LookupError('NASAPOWER data not available for nasapid ' + cell[0])
+            path, cols = series[cell]
+            dates = wthio.dates(cols[0])
+            sel = (dates >= int(dt_s.strftime('%Y%j'))) & (dates <= int(dt_e.strftime('%Y%j')))
+            cols = [x[sel] for x in cols]
+            header = cell_header(path, dt_s.strftime('%Y%m%d'), dt_e.strftime('%Y%m%d'),
+                                 [(a + b' ' + b).decode() for a, b in zip(cols[0], cols[1])])  # TAV and AMP of the range
+            if header is None:
+                raise LookupError('NASAPOWER data not available for nasapid ' + cell[0])
+            data = [x + '\n' for x in header]
+            srad, n = srad_qc(cols[8])
+            rain_col = merge_rain(cols[6], day_index(wthio.dates(cols[0])), prec, prec_days) if len(prec) else cols[6]
+            block = wthio.format_block([x[:n] for x in cols[:8]] + [srad[:n], rain_col[:n]])
+            future.set_result(wth_header(data, lat, lon) + block.decode())
+        except Exception as err:
+            future.set_exception(err)
+
+#To serve the requests in batches: the first request waits BATCH_WAIT seconds for others.
+def batcher():
+    s = make_session(CHIRPS_URL)
+    s.mount(NASA_URL.split('/api/')[0], requests.adapters.HTTPAdapter(pool_maxsize=16, max_retries=3))
+    while True:
+        batch = [pending.get()]
+        deadline = time.time() + BATCH_WAIT
+        while len(batch) < BATCH_MAX:
+            try:
+                batch.append(pending.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        try:
+            serve_batch(s, batch)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+
+#To get the metrics of the service.
+def metrics():
+    with lock:
+        result = dict(stats)
+        times = sorted(latencies)
+        result['power_cache'] = len(power)
+        result['raster_cache'] = len(rasters)
+    result['mean_batch'] = round(result['batched_requests'] / max(result['batches'], 1), 2)
+    if times:
+        result['latency_ms'] = {'mean': round(1000 * sum(times) / len(times), 1),
+                                'p50': round(1000 * times[len(times) // 2], 1),
+                                'p95': round(1000 * times[min(len(times) - 1, int(len(times) * 0.95))], 1),
+                                'max': round(1000 * times[-1], 1)}
+    return result
+
+class WTHHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type='text/plain', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            return self.send(200, json.dumps(metrics()).encode(), 'application/json')
+        if url.path != '/wth':
+            return self.send(404, b'Not found')
+
+        t0 = time.time()
+        tally('requests')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            lat, lon, dt_s, dt_e = parse_query(query)
+            power_cell(query, lat, lon)
+        except (KeyError, ValueError) as err:
+            tally('errors')
+            return self.send(400, ('Expected lat, lon, start and end (YYYYMMDD), and latnp and lonnp with nasapid: ' +
+                                   str(err)).encode())
+        future = Future()
+        pending.put((query, future))
+        try:
+            text = future.result(timeout=REQUEST_TIMEOUT)
+        except LookupError as err:
+            tally('errors')
+            return self.send(404, str(err).encode())
+        except Exception as err:
+            tally('errors')
+            return self.send(500, str(err).encode())
+        with lock:
+            latencies.append(time.time() - t0)
+        #The ID goes in the header as the file name, so only letters, digits, '_', '.' and '-' are kept.
+        name = re.sub(r'[^\w.-]', '_', query.get('id', 'point'), flags=re.ASCII) + '.WTH'
+        self.send(200, text.encode(), headers={'Content-Disposition': 'attachment; filename="' + name + '"'})
+
+#To run the service until it is stopped (Ctrl+C).
+def serve(host='127.0.0.1', port=8080, power_cache=None, raster_cache=None):
+    global POWER_CACHE, RASTER_CACHE
+    if power_cache is not None:
+        POWER_CACHE = power_cache
+    if raster_cache is not None:
+        RASTER_CACHE = raster_cache
+    threading.Thread(target=batcher, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), WTHHandler)
+    server.daemon_threads = True
+    print('Serving WTH files on http://' + host + ':' + str(server.server_address[1]) + '/wth?lat=..&lon=..&start=YYYYMMDD&end=YYYYMMDD')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
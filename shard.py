@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os, sys
+import re
+import json
+import shutil
+import numpy
+import pandas as pd
+from datetime import datetime
+import wthstore
+
+#Sharded runs. The points are split into N shards that can run on different machines with a shared filesystem:
+# - every shard has its own CSV and workspace ("<folder of in_file>/shards/shard_III_of_NNN/points.csv" and its
+#   "temp" folder), so the shards never touch each other's temporary data,
+# - the WTH files of a shard are written to "<out_dir>/shard_III_of_NNN" with a manifest (shard.json),
+# - merge() checks that every shard finished and moves their WTH files to out_dir with a manifest (manifest.json), or
+#   copies their stores (see wthstore.py) into the store of out_dir.
+#The points of a nasapid are always in the same shard, so each NASA POWER cell is requested once, and the nasapids are
+#ordered along a Z-order curve of their NASA POWER cells, so each shard covers a compact area (and few CHIRPS tiles).
+
+#To parse a shard as 'i/N' (1 <= i <= N). It returns (i, N).
+def parse_shard(shard):
+    m = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', str(shard))
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise ValueError('The shard must be i/N with 1 <= i <= N (e.g. 3/16), not ' + str(shard))
+    return int(m.group(1)), int(m.group(2))
+
+def shard_name(i, n):
+    return 'shard_{:03d}_of_{:03d}'.format(i, n)
+
+#To get the position of the NASA POWER cells (LatNP, LonNP) along a Z-order curve.
+def zorder(lat, lon):
+    row = numpy.round((numpy.asarray(lat) + 90) / 0.5).astype(numpy.int64)
+    col = numpy.round((numpy.asarray(lon) + 180) / 0.625).astype(numpy.int64)
+    key = numpy.zeros(len(row), dtype=numpy.int64)
+    for bit in range(10):  # 361 rows and 577 columns fit in 10 bits
+        key |= ((row >> bit) & 1) << (2 * bit + 1)
+        key |= ((col >> bit) & 1) << (2 * bit)
+    return key
+
+#To split the points into n shards. It returns the shard (1 to n) of each point.
+#The nasapids are sorted along the Z-order curve and cut into n runs of about the same number of points.
+def split_points(pt, n):
+    cells = pt.groupby('nasapid', sort=False).agg(lat=('LatNP', 'first'), lon=('LonNP', 'first'), size=('ID', 'size'))
+    cells = cells.iloc[numpy.lexsort((cells.index.to_numpy(), zorder(cells['lat'], cells['lon'])))]
+    start = cells['size'].cumsum().to_numpy() - cells['size'].to_numpy()  # Points before each nasapid
+    shard = numpy.minimum(start * n // max(len(pt), 1), n - 1) + 1
+    return pt['nasapid'].map(dict(zip(cells.index, shard))).to_numpy()
+
+#To write the CSV of shard i of n in its own workspace. It returns the path of the CSV.
+def shard_file(in_file, i, n):
+    in_file = os.path.abspath(in_file)
+    pt = pd.read_csv(in_file, dtype=str)  # The values are copied as they are.
+    sel = split_points(pt.astype({'nasapid': int, 'LatNP': float, 'LonNP': float}), n) == i
+    shard_dir = os.path.dirname(in_file) + '/shards/' + shard_name(i, n)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    pt[sel].to_csv(shard_dir + '/points.csv.tmp', index=False)
+    os.replace(shard_dir + '/points.csv.tmp', shard_dir + '/points.csv')
+    return shard_dir + '/points.csv'
+
+#To write the CSVs of all the shards. It returns the list of paths.
+def plan(in_file, n):
+    files = [shard_file(in_file, i, n) for i in range(1, n + 1)]
+    for i, path in enumerate(files, 1):
+        pt = pd.read_csv(path)
+        print(shard_name(i, n) + ':', len(pt), 'points,', pt['nasapid'].nunique(), 'nasapids, latitude',
+              pt['Latitude'].min(), 'to', pt['Latitude'].max(), ', longitude', pt['Longitude'].min(), 'to', pt['Longitude'].max())
+        print('    ' + path)
+    return files
+
+#To write the manifest of a finished shard.
+def write_shard_manifest(shard_out, shard_csv, i, n, info):
+    manifest = {'shard': i, 'shards': n, 'points_file': shard_csv,
+                'ids': pd.read_csv(shard_csv)['ID'].astype(str).tolist(),
+                'finished': datetime.now().isoformat(timespec='seconds')}
+    manifest.update(info)
+    with open(shard_out + '/shard.json.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(shard_out + '/shard.json.tmp', shard_out + '/shard.json')
+
+#To run the shard (i, n) of a 'get' or 'update' job. run(in_file, out_dir) runs the job for the points of the shard.
+def run_shard(run, in_file, out_dir, shard, **info):
+    i, n = shard
+    shard_csv = shard_file(in_file, i, n)
+    shard_out = os.path.abspath(out_dir) + '/' + shard_name(i, n)
+    if os.path.exists(shard_out + '/shard.json'):
+        os.remove(shard_out + '/shard.json')  # The shard is finished again only when this run ends.
+    print('Running', shard_name(i, n), 'with', len(pd.read_csv(shard_csv)), 'points.')
+    run(shard_csv, shard_out)
+    write_shard_manifest(shard_out, shard_csv, i, n, info)
+
+#To merge the shards of out_dir into out_dir. It exits when a shard is missing or not finished.
+#The IDs without WTH file are listed in the manifest.
+def merge(out_dir):
+    out_dir = os.path.abspath(out_dir)
+    dirs = sorted(x for x in os.listdir(out_dir) if re.match(r'^shard_\d+_of_\d+$', x) and os.path.isdir(out_dir + '/' + x))
+    if not dirs:
+        print('No shards found in', out_dir)
+        sys.exit(1)
+    counts = set(int(x.split('_')[-1]) for x in dirs)
+    if len(counts) > 1:
+        print('Shards of different splits in', out_dir + ':', ', '.join(dirs))
+        sys.exit(1)
+    n = counts.pop()
+
+    manifests = []
+    for i in range(1, n + 1):
+        path = out_dir + '/' + shard_name(i, n) + '/shard.json'
+        if not os.path.exists(path):
+            manifests.append(None)
+            continue
+        with open(path, 'r') as f:
+            manifests.append(json.load(f))
+    unfinished = [shard_name(i, n) for i, m in enumerate(manifests, 1) if m is None]
+    if unfinished:
+        print('Shards missing or not finished:', ', '.join(unfinished))
+        sys.exit(1)
+
+    missing = []
+    files = 0
+    for i, m in enumerate(manifests, 1):
+        shard_out = out_dir + '/' + shard_name(i, n)
+        if wthstore.is_store(shard_out):
+            stored = set(wthstore.merge_into(out_dir, shard_out))
+            files += len(stored)
+            missing += [id for id in m['ids'] if id not in stored]
+            continue
+        for id in m['ids']:
+            if os.path.exists(shard_out + '/' + id + '.WTH'):
+                os.replace(shard_out + '/' + id + '.WTH', out_dir + '/' + id + '.WTH')
+                files += 1
+            elif os.path.exists(out_dir + '/' + id + '.WTH'):
+                files += 1  # Moved by a previous merge that was interrupted.
+            else:
+                missing.append(id)
+
+    first = manifests[0]
+    manifest = {'shards': n, 'mode': first.get('mode'), 'start': first.get('start'), 'end': first.get('end'),
+                'points': sum(len(m['ids']) for m in manifests), 'files': files, 'missing': missing,
+                'shard_finished': [m['finished'] for m in manifests],
+                'merged': datetime.now().isoformat(timespec='seconds')}
+    with open(out_dir + '/manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(out_dir + '/manifest.json.tmp', out_dir + '/manifest.json')
+    for i in range(1, n + 1):
+        shutil.rmtree(out_dir + '/' + shard_name(i, n))
+
+    print(files, 'WTH files of', n, 'shards merged in', out_dir)
+    if missing:
+        print(len(missing), 'points without WTH file:', ', '.join(missing[:20]) + (' ...' if len(missing) > 20 else ''))
+    return manifest
@@ -0,0 +1,17 @@
+import os, sys
+import pytest
+
+#The modules of the tool are imported from the folder of the package, as in __main__.py, and the mock servers from
+#bench (see bench/mockserver.py).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, ROOT + '/bench']
+
+import cache
+
+#To run every test with an empty download cache of its own.
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    old = cache.CACHE_DIR
+    cache.set_cache(str(tmp_path / 'cache'))
+    yield cache.CACHE_DIR
+    cache.set_cache(old)
@@ -0,0 +1,65 @@
+import numpy
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta
+
+pytest.importorskip('osgeo.gdal')
+import CHIRPS
+from precstore import store_open, day_index
+
+GT = (30.0, 0.05, 0.0, 0.0, 0.0, -0.05)  # A p05 grid of 40 x 40 pixels
+SIZE = 40
+
+#To write the points (lat, lon) as the CSV of a run.
+def points_file(tmp_path, lat, lon):
+    pd.DataFrame({'ID': numpy.arange(1, len(lat) + 1), 'Latitude': lat, 'Longitude': lon}).to_csv(
+        tmp_path / 'points.csv', index=False)
+    return str(tmp_path / 'points.csv')
+
+#To get random daily values (days x rows x columns, rows from north to south) for the days of a month.
+def month_values(first, size, seed):
+    days = [first + timedelta(days=k) for k in range(((first + timedelta(days=32)).replace(day=1) - first).days)]
+    values = numpy.random.default_rng(seed).exponential(5, (len(days), size, size)).astype(numpy.float32)
+    return days, values
+
+#To extract the points of in_file from the files of in_nc_dir. It returns the days x points values.
+def extract(in_file, in_nc_dir, outprec):
+    CHIRPS.chirps_extract(in_file, in_nc_dir, outprec)
+    ids, pixel, days, prec = store_open(outprec)
+    return days, prec[pixel].T
+
+def test_subset_gives_the_values_of_the_full_grid(tmp_path):
+    rng = numpy.random.default_rng(0)
+    lat, lon = -rng.uniform(0.4, 1.2, 30), 30 + rng.uniform(0.6, 1.5, 30)
+    lat[1], lon[1] = lat[0] - 0.001, lon[0] + 0.001  # Two points in the same pixel
+    in_file = points_file(tmp_path, lat, lon)
+    days, values = month_values(datetime(2020, 1, 1), SIZE, 1)
+    CHIRPS.write_subset(str(tmp_path / 'full/corr_chirps_202001.nc'), days, values, GT, (0, 0, SIZE, SIZE))
+    window = CHIRPS.points_window(in_file, GT, SIZE, SIZE)
+    x0, y0, x1, y1 = window
+    assert (x1 - x0) * (y1 - y0) < SIZE * SIZE
+    CHIRPS.write_subset(str(tmp_path / 'subset/corr_chirps_202001.nc'), days, values[:, y0:y1, x0:x1], GT, window)
+
+    full_days, full = extract(in_file, str(tmp_path / 'full'), str(tmp_path / 'prec_full'))
+    subset_days, subset = extract(in_file, str(tmp_path / 'subset'), str(tmp_path / 'prec_subset'))
+    px, py = CHIRPS.grid_pixels(GT, lat, lon)
+    assert full_days.tolist() == subset_days.tolist() == day_index([int(x.strftime('%Y%j')) for x in days]).tolist()
+    assert (full == values[:, py, px]).all()
+    assert (subset == full).all()
+
+def test_files_with_different_grids(tmp_path):
+    coarse = (30.0, 0.25, 0.0, 0.0, 0.0, -0.25)  # A p25 grid of 8 x 8 pixels over the same area
+    lat = numpy.array([-0.51, -0.69, -1.01, -1.26])
+    lon = numpy.array([30.51, 30.69, 31.01, 30.51])  # The first two points share a p25 pixel, not a p05 pixel.
+    in_file = points_file(tmp_path, lat, lon)
+    jan_days, jan = month_values(datetime(2020, 1, 1), 8, 2)
+    feb_days, feb = month_values(datetime(2020, 2, 1), SIZE, 3)
+    CHIRPS.write_subset(str(tmp_path / 'nc/corr_chirps_202001.nc'), jan_days, jan, coarse, (0, 0, 8, 8))
+    CHIRPS.write_subset(str(tmp_path / 'nc/corr_chirps_202002.nc'), feb_days, feb, GT, (0, 0, SIZE, SIZE))
+
+    days, values = extract(in_file, str(tmp_path / 'nc'), str(tmp_path / 'prec'))
+    cx, cy = CHIRPS.grid_pixels(coarse, lat, lon)
+    px, py = CHIRPS.grid_pixels(GT, lat, lon)
+    assert (values[:len(jan_days)] == jan[:, cy, cx]).all()
+    assert (values[len(jan_days):] == feb[:, py, px]).all()
+    assert (values[len(jan_days):, 0] != values[len(jan_days):, 1]).any()
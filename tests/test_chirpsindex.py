@@ -0,0 +1,76 @@
+import os
+import numpy
+import pytest
+import cache
+import chirpsindex
+from precstore import day_index
+
+GT = [30.0, 0.05, 0.0, 0.0, 0.0, -0.05]
+XSIZE, YSIZE = 64, 40  # 2 x 2 tiles, the last ones partial
+LAT = numpy.array([-0.5, -1.7, 5.0])  # The third point is outside of the grid.
+LON = numpy.array([30.5, 32.0, 30.5])
+
+#The bands of a monthly CHIRPS file as the index reads them (the values of day d are d * 1000 + pixel number).
+class MonthFile:
+    RasterXSize, RasterYSize = XSIZE, YSIZE
+
+    def __init__(self, ndays):
+        self.grid = (numpy.arange(ndays)[:, None, None] * 1000 +
+                     numpy.arange(XSIZE * YSIZE).reshape(YSIZE, XSIZE)).astype(numpy.float32)
+
+    def GetGeoTransform(self):
+        return tuple(GT)
+
+    def GetRasterBand(self, band):
+        grid = self.grid[band - 1]
+        return type('Band', (), {'ReadAsArray': lambda s, x0, y0, w, h: grid[y0:y0 + h, x0:x0 + w]})()
+
+#To add the months (YYYYMM: number of days) to the index for the points.
+def add_months(months):
+    files = {}
+    for yymm, ndays in months.items():
+        files[yymm] = MonthFile(ndays)
+        first = numpy.datetime64(yymm[:4] + '-' + yymm[4:] + '-01').astype(numpy.int64)  # Day index of the 1st
+        chirpsindex.add_month(files[yymm], first + numpy.arange(ndays), yymm, LAT, LON)
+    return files
+
+@pytest.fixture(autouse=True)
+def no_pinned_files(monkeypatch):
+    monkeypatch.setattr(cache, 'pinned', set())
+
+def test_read_the_series_of_the_points():
+    files = add_months({'202001': 31, '202002': 29})
+    assert chirpsindex.indexed_months(LAT, LON, ['202001', '202002', '202003']) == ['202001', '202002']
+    first = int(day_index([2020025])[0])
+    days, values = chirpsindex.read(LAT, LON, first, first + 9)
+    assert days.tolist() == list(range(first, first + 10))
+    expected = numpy.concatenate([files['202001'].grid[24:, [10, 34], [10, 40]],
+                                  files['202002'].grid[:3, [10, 34], [10, 40]]])
+    assert (values[:, :2] == expected).all()
+    assert (values[:, 2] == -9999.0).all()
+
+def test_read_raises_on_a_missing_tile():
+    add_months({'202001': 31})
+    os.remove(chirpsindex.tile_path('2020', 1, 1) + '.f32')
+    assert chirpsindex.indexed_months(LAT, LON, ['202001']) == []
+    first = int(day_index([2020001])[0])
+    with pytest.raises(FileNotFoundError):
+        chirpsindex.read(LAT, LON, first, first + 30)
+    assert (chirpsindex.read(LAT[:1], LON[:1], first, first + 30)[1][:, 0] ==
+            numpy.arange(31) * 1000 + 10 * XSIZE + 10).all()  # The other tile is still read.
+
+def test_read_raises_without_index():
+    with pytest.raises(FileNotFoundError):
+        chirpsindex.read(LAT, LON, 0, 10)
+
+def test_pinned_tiles_are_not_evicted():
+    add_months({'202001': 31})
+    chirpsindex.pin_months(LAT[:1], LON[:1], ['202001'])  # Only the tile of the first point
+    cache.set_cache(cache_size=0)
+    try:
+        open(cache.CACHE_DIR + '/other', 'wb').close()
+        cache.register(cache.CACHE_DIR, 'other', {'url': None, 'etag': None, 'last_modified': None, 'immutable': True})
+    finally:
+        cache.set_cache(cache_size=cache.parse_size('50G'))
+    assert os.path.exists(chirpsindex.tile_path('2020', 0, 0) + '.f32')
+    assert not os.path.exists(chirpsindex.tile_path('2020', 1, 1) + '.f32')
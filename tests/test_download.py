@@ -0,0 +1,105 @@
+import io
+import os
+import pytest
+import requests
+import download as download_module
+import cache
+from download import download
+from mockserver import start_server
+
+GRID = {'lat0': -5.0, 'lon0': 30.0, 'nrows': 20, 'ncols': 20}
+NAME = 'chirps-v2.0.2020.01.days_p05.nc'
+
+#A mock server and the URL and the content of one of its CHIRPS files.
+@pytest.fixture
+def server(tmp_path):
+    server = start_server(str(tmp_path / 'server'), GRID)
+    server.file_url = server.url + '/products/CHIRPS-2.0/global_daily/netcdf/p05/by_month/' + NAME
+    response = requests.get(server.file_url)
+    server.content, server.etag = response.content, response.headers['ETag']
+    server.counts.clear()
+    yield server
+    server.shutdown()
+
+#To leave a partial download of the first n bytes of the file, with the validator of the server copy.
+def write_part(path, content, n, validator):
+    with open(path + '.part', 'wb') as f:
+        f.write(content[:n])
+    with open(path + '.part.validator', 'w') as f:
+        f.write(validator)
+
+def test_download_resumes_a_partial_file(server, tmp_path):
+    path = str(tmp_path / NAME)
+    write_part(path, server.content, 1000, server.etag)
+    with requests.Session() as s:
+        response = download(s, server.file_url, path)
+    assert response.status_code == 206
+    assert open(path, 'rb').read() == server.content
+    assert server.counts['bytes_sent'] == len(server.content) - 1000  # Only the missing bytes
+    assert not os.path.exists(path + '.part') and not os.path.exists(path + '.part.validator')
+
+def test_download_starts_again_when_the_file_changed(server, tmp_path):
+    path = str(tmp_path / NAME)
+    write_part(path, b'x' * 1000, 1000, '"old"')  # If-Range does not match: the server sends the whole file.
+    with requests.Session() as s:
+        response = download(s, server.file_url, path)
+    assert response.status_code == 200
+    assert open(path, 'rb').read() == server.content
+
+def test_download_starts_again_when_the_range_is_not_satisfiable(server, tmp_path):
+    path = str(tmp_path / NAME)
+    write_part(path, server.content + b'x', len(server.content) + 1, server.etag)  # 416, the part is removed.
+    with requests.Session() as s:
+        response = download(s, server.file_url, path)
+    assert response.status_code == 200
+    assert open(path, 'rb').read() == server.content
+    assert server.counts['bytes_sent'] == len(server.content)
+
+#A session that answers the first requests with the given HTTP errors, as a busy server does.
+class FlakySession(requests.Session):
+    def __init__(self, codes):
+        super().__init__()
+        self.codes = list(codes)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        if self.codes:
+            response = requests.Response()
+            response.status_code, response.url, response.raw = self.codes.pop(0), url, io.BytesIO(b'')
+            return response
+        return super().get(url, **kwargs)
+
+def test_download_retries_a_busy_server(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_module.time, 'sleep', lambda x: None)
+    path = str(tmp_path / NAME)
+    write_part(path, server.content, 1000, server.etag)
+    with FlakySession([503, 429, 500]) as s:
+        response = download(s, server.file_url, path)
+        assert s.calls == 4
+    assert response.status_code == 206  # The partial file is still resumed.
+    assert open(path, 'rb').read() == server.content
+
+def test_download_gives_up_on_a_missing_file(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_module.time, 'sleep', lambda x: None)
+    with FlakySession([404]) as s:
+        assert download(s, server.file_url, str(tmp_path / NAME)) is None
+        assert s.calls == 1
+    with FlakySession([503] * 10) as s:
+        assert download(s, server.file_url, str(tmp_path / NAME), retries=2) is None
+        assert s.calls == 3
+
+def test_cache_get_revalidates_a_mutable_file(server):
+    with requests.Session() as s:
+        path = cache.cache_get(s, server.file_url, 'chirps/' + NAME)
+        sent = server.counts['bytes_sent']
+        assert cache.cache_get(s, server.file_url, 'chirps/' + NAME) == path  # 304: the cached copy is used.
+    assert server.counts['bytes_sent'] == sent
+    assert server.counts['by_month'] == 2
+    assert open(path, 'rb').read() == server.content
+
+def test_cache_get_does_not_revalidate_an_immutable_file(server):
+    with requests.Session() as s:
+        path = cache.cache_get(s, server.file_url, 'chirps/' + NAME, immutable=True)
+        assert cache.cache_get(s, server.file_url, 'chirps/' + NAME, immutable=True) == path
+    assert server.counts['by_month'] == 1
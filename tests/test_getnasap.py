@@ -0,0 +1,93 @@
+import numpy
+import pytest
+import wthio
+from precstore import day_index
+from getnasap import srad_qc, merge_rain
+
+S2 = '{:>7} {:>5} {:>5} {:>5} {:>5} {:>5} {:>6} {:>6} {:>6} {:>6}'
+
+#The rows of a WTH file as the first version of nasachirps wrote them, one row at a time: SRAD quality control and
+#CHIRPS rain ({YYYYDDD: float32 value}).
+def reference_rows(rows, prec):
+    solar = [x.split()[8] for x in rows]
+    i_srad = [i for i, e in enumerate(solar) if e == 'nan' or e == '-99' or e == '-99.0' or e == '-3596.4']
+    lines = []
+    for index2, row in enumerate(rows):
+        c = 0
+        r = row.split()
+        if index2 in i_srad:
+            if (index2 + 1 in i_srad) and (index2 + 2 in i_srad) and index2 == 0:
+                break
+            if (index2 + 1 in i_srad) and index2 == 0:
+                break
+            if len(rows) == 1:
+                break
+            if (index2 + 1 in i_srad) and (index2 + 2 in i_srad):
+                SRAD2 = solar[index2 - 1]
+                c = 1
+            elif (index2 + 1) in i_srad and (index2 + 2) == len(rows):
+                SRAD2 = solar[index2 - 1]
+                c = 1
+            elif (index2 + 1) in i_srad:
+                SRAD2 = round(float(solar[index2 - 1]) + (float(solar[index2 + 2]) - float(solar[index2 - 1])) / 3, 1)
+            elif (index2 - 1) in i_srad:
+                SRAD2 = round(float(solar[index2 - 2]) + 2 * (float(solar[index2 + 1]) - float(solar[index2 - 2])) / 3, 1)
+            elif (index2 + 1) == len(rows):
+                SRAD2 = solar[index2 - 1]
+            elif index2 == 0:
+                SRAD2 = solar[index2 + 1]
+            else:
+                SRAD2 = round((float(solar[index2 - 1]) + float(solar[index2 + 1])) / 2, 1)
+        else:
+            SRAD2 = r[8]
+        if r[0] in prec:
+            RAIN = r[6] if prec[r[0]] == -9999.0 else round(float(prec[r[0]]), 1)
+        else:
+            RAIN = r[6]
+        lines.append(S2.format(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7], SRAD2, RAIN) + '\n')
+        if c == 1:
+            break
+    return ''.join(lines)
+
+#The same rows through the vectorized functions, as wth_group builds them.
+def vectorized_rows(rows, prec):
+    cols = wthio.parse_block(''.join(x + '\n' for x in rows).encode(), 9)
+    prec_dates = sorted(prec)
+    srad, n = srad_qc(cols[8])
+    rain = merge_rain(cols[6], day_index(wthio.dates(cols[0])), numpy.array([prec[x] for x in prec_dates]),
+                      day_index(prec_dates))
+    return wthio.format_block([x[:n] for x in cols[:8]] + [srad[:n], rain[:n]]).decode()
+
+def icasa_rows(srad):
+    rng = numpy.random.default_rng(len(srad))
+    rows = []
+    for k, v in enumerate(srad):
+        t = rng.uniform(15, 30, 4).round(1)
+        rows.append('{:>7}{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}{:>8.1f}{:>8}'.format(
+            2020001 + k, t[0], t[1], t[2], t[3], rng.uniform(40, 90), rng.exponential(3), rng.uniform(0, 5), v))
+    return rows
+
+#SRAD series with the missing values of every case of the quality control.
+SRAD_CASES = {'none': ['20.1', '18.4', '22.7', '19.9', '21.0'],
+              'one inside': ['20.1', '-99', '22.7', '19.9', '21.0'],
+              'two inside': ['20.1', '-99', 'nan', '19.9', '21.0'],
+              'three inside': ['20.1', '18.4', '-99', '-99', '-99', '19.9'],
+              'two at the end': ['20.1', '18.4', '22.7', '-99', '-99'],
+              'one at the end': ['20.1', '18.4', '22.7', '19.9', '-99'],
+              'one at the start': ['-99', '18.4', '22.7', '19.9', '21.0'],
+              'two at the start': ['-99', '-99', '22.7', '19.9', '21.0'],
+              'single missing record': ['-99'],
+              'several groups': ['20.1', '-3596.4', '22.7', '-99.0', '-99.0', '19.9', '-99', '21.0', '-99', '-99', '-99']}
+
+@pytest.mark.parametrize('case', sorted(SRAD_CASES))
+def test_vectorized_rows_are_the_rows_of_the_first_version(case):
+    rows = icasa_rows(SRAD_CASES[case])
+    dates = [x.split()[0] for x in rows]
+    values = numpy.random.default_rng(1).exponential(4, len(dates)).astype(numpy.float32)
+    values[::3] = -9999.0  # Missing CHIRPS days keep the NASAPOWER rain.
+    prec = dict(zip(dates[1:], values[1:]))  # The first day is not in CHIRPS.
+    assert vectorized_rows(rows, prec) == reference_rows(rows, prec)
+
+def test_rows_without_chirps_keep_the_nasapower_rain():
+    rows = icasa_rows(SRAD_CASES['none'])
+    assert vectorized_rows(rows, {}) == reference_rows(rows, {})
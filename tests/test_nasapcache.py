@@ -0,0 +1,53 @@
+import math
+from datetime import datetime, timedelta
+from nasapcache import cell_path, missing_ranges, merge_cell, cell_text
+
+KEY = ['100001', -3.0, 30.625, 'T2M', 'AG']
+
+#To write the ICASA response of NASAPOWER for [start, end], with TAV (mean T2M) and AMP (range of the monthly means)
+#of the range as the server gives them: from the unrounded values, while the rows have one decimal.
+def icasa(start, end):
+    dt_s = datetime.strptime(start, '%Y%m%d')
+    days = [dt_s + timedelta(days=k) for k in range((datetime.strptime(end, '%Y%m%d') - dt_s).days + 1)]
+    t2m = [round(24 + 6 * math.sin(2 * math.pi * d.timetuple().tm_yday / 365.25), 1) + 0.049 for d in days]
+    months = {}
+    for d, t in zip(days, t2m):
+        months.setdefault(d.month, []).append(t)
+    monthly = [sum(x) / len(x) for x in months.values()]
+    lines = ['$WEATHER DATA : NASA POWER',
+             '! Location: Latitude -3.0 Longitude 30.625',
+             '! Dates (UTC): ' + start + ' - ' + end,
+             '@ INSI   WTHLAT  WTHLONG  WELEV   TAV   AMP  REFHT  WNDHT',
+             '  NASA   -3.000   30.625  100.0 {:>5.1f} {:>5.1f}    2.0    2.0'.format(sum(t2m) / len(t2m),
+                                                                                   max(monthly) - min(monthly)),
+             '@  DATE    T2M   TMIN   TMAX   TDEW   RH2M   RAIN   WIND   SRAD']
+    for d, t in zip(days, t2m):
+        lines.append('{:>7} {:>6.1f}  18.00  30.00  20.00  70.00   0.00   2.00  20.00'.format(d.strftime('%Y%j'), t))
+    return '\n'.join(lines) + '\n'
+
+#To get the ICASA text of a cell for [start, end] as get_data does: the missing ranges are requested first. It returns
+#the text and the ranges requested.
+def fetch(path, start, end, header=True):
+    requested = missing_ranges(path, start, end, header)
+    for a, b in requested:
+        merge_cell(path, KEY, icasa(a, b), a, b)
+    return cell_text(path, start, end), requested
+
+def test_header_of_the_range_after_merging_two_ranges():
+    path = cell_path(*KEY)
+    assert fetch(path, '20150101', '20151231') == (icasa('20150101', '20151231'), [('20150101', '20151231')])
+    assert fetch(path, '20150101', '20151231') == (icasa('20150101', '20151231'), [])
+
+    #Only the new days when the header is not used (the update of an archive)
+    assert fetch(path, '20150101', '20160110', header=False)[1] == [('20160101', '20160110')]
+    assert missing_ranges(path, '20150101', '20160110', header=False) == []
+    assert fetch(path, '20150101', '20151231') == (icasa('20150101', '20151231'), [])  # Not the header of the update
+
+def test_header_of_a_range_is_the_one_of_a_fresh_request():
+    path = cell_path(*KEY)
+    fetch(path, '20150101', '20151231')
+    #The TAV and AMP of the stored rows (one decimal) are not the ones of the server.
+    assert cell_text(path, '20150201', '20150430') != icasa('20150201', '20150430')
+    assert fetch(path, '20150201', '20150430') == (icasa('20150201', '20150430'), [('20150201', '20150430')])
+    assert fetch(path, '20150101', '20160110') == (icasa('20150101', '20160110'), [('20150101', '20160110')])
+    assert fetch(path, '20150201', '20150430') == (icasa('20150201', '20150430'), [])
@@ -0,0 +1,64 @@
+import os
+import json
+from nasapcache import cell_path, merge_cell, cell_rows, cell_header, cell_text
+from nasapregional import regional_rows, regional_tav_amp, split_regional
+
+KEY = ['100001', -3.0, 30.625, 'T2M', 'AG']
+
+#Point responses of NASAPOWER for the cell: one day (the header requested for a new cell) and the three days.
+POINT_HEADER = '''$WEATHER DATA : NASA LaRC POWER Daily Data
+! Location: Latitude -3.0000 Longitude 30.6250 Elevation 1134.2 meters
+! Dates (UTC): {} - {}
+!
+@ INSI   WTHLAT  WTHLONG  WELEV   TAV   AMP  REFHT  WNDHT
+  NASA   -3.000   30.625 1134.2 {}    2.0    2.0
+@  DATE     T2M    TMIN    TMAX    TDEW    RH2M    RAIN    WIND    SRAD
+'''
+POINT_ROWS = ['2020030    24.3    18.2    31.0    19.9    76.4     0.0     1.6    21.3',
+              '2020031    25.1    19.0    32.2    20.3    71.9    12.5     2.1    18.8',
+              '2020032    22.6    17.4    29.5    19.6    80.2     3.0     1.9     -99']
+POINT_DAY = POINT_HEADER.format('20200130', '20200130', '24.3   0.0') + POINT_ROWS[0] + '\n'
+POINT_DAYS = POINT_HEADER.format('20200130', '20200201', '24.0   2.1') + '\n'.join(POINT_ROWS) + '\n'
+
+#Regional responses (one per parameter) with the same days at a neighbour and at the grid point of the cell.
+PARAMETERS = {'T2M': [24.31, 25.08, 22.6], 'T2M_MIN': [18.2, 19.04, 17.38], 'T2M_MAX': [31.02, 32.2, 29.47],
+              'T2MDEW': [19.9, 20.33, 19.61], 'RH2M': [76.44, 71.9, 80.18], 'PRECTOTCORR': [0.0, 12.47, 3.01],
+              'WS2M': [1.61, 2.1, 1.88], 'ALLSKY_SFC_SW_DWN': [21.34, 18.79, -999.0]}
+DAYS = ['20200130', '20200131', '20200201']
+
+def regional(parameter):
+    features = []
+    for lat, lon, k in [(-3.0, 30.625, 0.0), (-3.5, 30.625, 1.0)]:
+        values = dict(zip(DAYS, [v + k if v != -999.0 else v for v in PARAMETERS[parameter]]))
+        features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat, 1134.2]},
+                         'properties': {'parameter': {parameter: values}}})
+    return {'type': 'FeatureCollection', 'header': {'fill_value': -999.0}, 'features': features}
+
+def test_regional_rows_give_the_point_response():
+    path = cell_path(*KEY)
+    merge_cell(path, KEY, POINT_DAY, '20200130', '20200130')
+    values = split_regional([regional(p) for p in PARAMETERS], [(KEY[0], KEY[1], KEY[2])])
+    header = cell_header(path, '20200130', '20200201', means=regional_tav_amp(values[KEY[0]]))
+    text = '\n'.join(header) + '\n' + regional_rows(values[KEY[0]], cell_rows(path))
+    merge_cell(path, KEY, text, '20200130', '20200201')
+    assert cell_text(path, '20200130', '20200201') == POINT_DAYS
+
+def test_regional_requests_give_the_files_of_point_requests(tmp_path, monkeypatch):
+    from mockserver import start_server, server_env
+    from synth import make_points
+    import cache, getnasap
+    server = start_server(str(tmp_path / 'server'), {'lat0': -5.0, 'lon0': 30.0, 'nrows': 60, 'ncols': 60})
+    env = server_env(server.url)
+    monkeypatch.setattr(getnasap, 'NASA_URL', env['NASAPCHIRPS_NASA_URL'])
+    monkeypatch.setattr(getnasap, 'REGIONAL_URL', env['NASAPCHIRPS_REGIONAL_URL'])
+    make_points(str(tmp_path / 'points.csv'), 40, {'lat0': -5.0, 'lon0': 30.0, 'nrows': 60, 'ncols': 60})
+
+    files = {}
+    for regional in [False, True]:
+        cache.set_cache(str(tmp_path / ('cache_' + str(regional))))
+        out = str(tmp_path / ('nasap_' + str(regional)))
+        getnasap.get_data(str(tmp_path / 'points.csv'), '20200110', '20200305', out, regional=regional)
+        files[regional] = {x: open(out + '/' + x).read() for x in os.listdir(out) if x.endswith('.WTH')}
+    server.shutdown()
+    assert len(files[False]) >= 4
+    assert files[True] == files[False]
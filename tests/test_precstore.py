@@ -0,0 +1,48 @@
+import numpy
+from datetime import datetime
+import precstore
+from precstore import day_index, index_date, store_create, store_append, store_open, store_last_date
+
+def test_day_index_of_dssat_dates():
+    days = day_index([1970001, 2020001, 2020366, 2021001])
+    assert days.tolist() == [0, 18262, 18627, 18628]
+    assert index_date(days[2]) == datetime(2020, 12, 31)
+
+def test_store_round_trip_with_gap_fill(tmp_path):
+    path = str(tmp_path / 'prec')
+    ids = [11, 12, 13]
+    store_create(path, ids, pixel=[0, 1, 0])  # The first and the third points are in the same pixel.
+    assert store_last_date(path) is None
+    assert store_open(path)[3].shape == (2, 0)
+
+    d0 = int(day_index([2020001])[0])
+    first = numpy.arange(6, dtype=numpy.float32).reshape(3, 2)
+    store_append(path, [d0, d0 + 1, d0 + 2], first)
+    second = numpy.array([[7, 8], [9, 10]], dtype=numpy.float32)
+    store_append(path, [d0 + 2, d0 + 5], second)  # d0 + 2 is already stored; d0 + 3 and d0 + 4 are missing.
+
+    read_ids, pixel, days, prec = store_open(path)
+    assert read_ids.tolist() == ids and pixel.tolist() == [0, 1, 0]
+    assert days.tolist() == list(range(d0, d0 + 6))
+    assert prec.shape == (2, 6)
+    assert prec[pixel[2]].tolist() == [0, 2, 4, -9999.0, -9999.0, 9]
+    assert prec[pixel[1]].tolist() == [1, 3, 5, -9999.0, -9999.0, 10]
+    assert store_last_date(path) == datetime(2020, 1, 6)
+
+def test_store_append_overwrites_an_interrupted_append(tmp_path):
+    path = str(tmp_path / 'prec')
+    store_create(path, [1])
+    d0 = int(day_index([2020001])[0])
+    store_append(path, [d0], numpy.array([[1]], dtype=numpy.float32))
+    with open(path + '/prec.f32', 'ab') as f:
+        f.write(numpy.float32(99).tobytes() + b'\x00\x00')  # Values written without their meta.json update
+    store_append(path, [d0 + 1], numpy.array([[2]], dtype=numpy.float32))
+    assert store_open(path)[3].tolist() == [[1, 2]]
+    assert len(open(path + '/prec.f32', 'rb').read()) == 8
+
+def test_store_move_replaces_the_store(tmp_path):
+    old, new = str(tmp_path / 'prec'), str(tmp_path / 'prec.new')
+    store_create(old, [1])
+    store_create(new, [1, 2])
+    precstore.store_move(new, old)
+    assert store_open(old)[0].tolist() == [1, 2]
@@ -0,0 +1,57 @@
+import numpy
+import wthio
+
+HEADER = ('*WEATHER DATA : NASAPOWER + CHIRPS\n'
+          '\n'
+          '@ INSI      LAT     LONG  ELEV   TAV   AMP REFHT WNDHT\n'
+          '    UFLC   -1.525   32.475  1200  22.1   2.6   2.0   2.0\n'
+          '@  DATE  T2M  TMIN  TMAX  TDEW  RHUM  RAIN2   WIND   SRAD   RAIN\n')
+
+#To get the columns and the formatted block of n rows (dates are consecutive numbers from start).
+def wth_rows(n, start=2020001):
+    cols = [numpy.arange(start, start + n).astype(bytes)]
+    cols += [wthio.value_text(numpy.linspace(10, 30, n) + k) for k in range(8)]
+    cols += [wthio.value_text(numpy.linspace(-1, 1, n) ** 2)]
+    return cols, wthio.format_block(cols)
+
+def test_write_and_read_give_the_same_file(tmp_path):
+    cols, block = wth_rows(40)
+    path = str(tmp_path / 'UFLC.WTH')
+    wthio.write_wth(path, HEADER, block)
+    header, read = wthio.read_wth(path)
+    assert ''.join(header) == HEADER.replace('\n\n', '\n')  # Blank lines are dropped.
+    assert wthio.header_values(header) == ['UFLC', '-1.525', '32.475', '1200', '22.1', '2.6', '2.0', '2.0']
+    assert len(read) == 10 and all((r == c).all() for r, c in zip(read, cols))
+    assert wthio.format_block(read) == block
+    assert open(path, 'rb').read() == HEADER.encode() + block
+    assert wthio.dates(read[0])[-1] == 2020040
+
+def test_blocks_that_are_not_fixed_width_are_split_on_blanks():
+    block = b'2020001 1.0 2.5\n2020002 10.25 3\n'
+    cols = wthio.parse_block(block, 3)
+    assert wthio.parse_fixed(block, 3) is None
+    assert [c.tolist() for c in cols] == [[b'2020001', b'2020002'], [b'1.0', b'10.25'], [b'2.5', b'3']]
+
+def test_format_block_writes_values_wider_than_their_column():
+    block = wthio.format_block([[b'2020001'], [b'123456']], widths=[7, 5])
+    assert block == '{:>7} {:>5}\n'.format('2020001', '123456').encode()
+
+def test_rows_after_a_date():
+    block = wth_rows(10)[1]
+    rows = block.splitlines(True)
+    assert wthio.rows_after(block, None) == block
+    assert wthio.rows_after(block, '2020004') == b''.join(rows[4:])
+    assert wthio.rows_after(block, b'2020010') == b''
+    assert wthio.rows_after(block, '2019365') == block
+
+def test_last_date(tmp_path):
+    path = str(tmp_path / 'UFLC.WTH')
+    open(path, 'wb').close()
+    assert wthio.last_date(path) is None  # Empty file
+    wthio.write_wth(path, HEADER, b'')
+    assert wthio.last_date(path) is None  # Only the header
+    wthio.write_wth(path, HEADER, wth_rows(3)[1])
+    assert wthio.last_date(path) == '2020003'
+    wthio.write_wth(path, HEADER, wth_rows(400)[1] + b'\n\n')
+    assert wthio.last_date(path) == '2020400'
+    assert wthio.last_date(path, block=40) == '2020400'  # The end of the file is read again with a larger block.
@@ -0,0 +1,69 @@
+import wthio
+import wthstore
+
+HEADER = ('*WEATHER DATA : NASAPOWER + CHIRPS\n'
+          '@ INSI      LAT     LONG  ELEV   TAV   AMP REFHT WNDHT\n'
+          '    UFLC   -1.525   32.475  1200  22.1   2.6   2.0   2.0\n'
+          '@  DATE  T2M  TMIN  TMAX  TDEW  RHUM  RAIN2   WIND   SRAD   RAIN\n')
+
+#To get the formatted rows of the dates (YYYYDDD).
+def rows(dates):
+    return b''.join('{:>7}  24.1  18.2  30.3  17.6  70.4    1.2    2.3   20.5    3.4\n'.format(x).encode()
+                    for x in dates)
+
+def test_put_append_and_read(tmp_path):
+    con = wthstore.connect(str(tmp_path / 'out'))
+    with con:
+        wthstore.put(con, '1', HEADER, rows(range(2020001, 2020011)))
+        wthstore.put(con, '2', HEADER, b'')
+    assert wthstore.last_dates(con) == {'1': '2020010', '2': None}
+
+    with con:
+        assert wthstore.append(con, '1', rows(range(2020008, 2020016))) == 5  # The first 3 rows are already stored.
+        assert wthstore.append(con, '1', rows(range(2020001, 2020016))) == 0
+        assert wthstore.append(con, '2', rows([2020001])) == 1
+        assert wthstore.append(con, '3', rows([2020001])) is None
+    assert wthstore.read(con, '1') == HEADER + rows(range(2020001, 2020016)).decode()
+    assert wthstore.read(con, '2') == HEADER + rows([2020001]).decode()
+    assert wthstore.read(con, '3') is None
+    assert wthstore.last_dates(con) == {'1': '2020015', '2': '2020001'}
+    assert con.execute("SELECT first_date, rows FROM stations WHERE id = '1'").fetchone() == ('2020001', 15)
+    con.close()
+
+def test_put_replaces_the_rows(tmp_path):
+    con = wthstore.connect(str(tmp_path / 'out'))
+    wthstore.put(con, '1', HEADER, rows(range(2020001, 2020011)))
+    wthstore.append(con, '1', rows([2020011]))
+    wthstore.put(con, '1', HEADER, rows([2021001]))
+    assert wthstore.read(con, '1') == HEADER + rows([2021001]).decode()
+    con.close()
+
+def test_export_writes_the_wth_files(tmp_path):
+    store_dir, out_dir = str(tmp_path / 'store'), str(tmp_path / 'wth')
+    con = wthstore.connect(store_dir)
+    with con:
+        wthstore.put(con, '1', HEADER, rows(range(2020001, 2020004)))
+        wthstore.put(con, '2', HEADER, rows([2020001]))
+    con.close()
+    assert wthstore.export(store_dir, out_dir, ids=[1, 3]) == ['3']
+    assert open(out_dir + '/1.WTH').read() == HEADER + rows(range(2020001, 2020004)).decode()
+    assert wthstore.export(store_dir, out_dir) == []
+    header, cols = wthio.read_wth(out_dir + '/2.WTH')
+    assert ''.join(header) == HEADER and cols[0].tolist() == [b'2020001']
+
+def test_merge_store_appends_the_new_rows_to_the_wth_files(tmp_path):
+    in_dir, new_dir, out_dir = str(tmp_path / 'hist'), str(tmp_path / 'new'), str(tmp_path / 'out')
+    tmp_path.joinpath('hist').mkdir()
+    wthio.write_wth(in_dir + '/1.WTH', HEADER, rows(range(2020001, 2020006)))
+    wthio.write_wth(in_dir + '/2.WTH', HEADER, rows(range(2020001, 2020006)))
+    new = wthstore.connect(new_dir)
+    with new:
+        wthstore.put(new, '1', HEADER, rows(range(2020004, 2020009)))
+        wthstore.put(new, '4', HEADER, rows([2020004]))  # Not in the historical files
+    new.close()
+    assert wthstore.merge_store(in_dir, new_dir, out_dir, ids=['2']) == 1
+    con = wthstore.connect(out_dir)
+    assert wthstore.read(con, '1') == HEADER + rows(range(2020001, 2020009)).decode()
+    assert wthstore.read(con, '2') == HEADER + rows(range(2020001, 2020006)).decode()
+    assert wthstore.read(con, '4') is None
+    con.close()
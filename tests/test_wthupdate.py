@@ -0,0 +1,86 @@
+import json
+import os
+from datetime import datetime
+import wthio
+import wthstore
+from wthupdate import rollback, mergeWTH, hist_last_dates, update_cohorts, archive_last_dates
+
+HEADER = ('*WEATHER DATA : NASAPOWER + CHIRPS\n'
+          '@ INSI      LAT     LONG  ELEV   TAV   AMP REFHT WNDHT\n'
+          '    UFLC   -1.525   32.475  1200  22.1   2.6   2.0   2.0\n'
+          '@  DATE  T2M  TMIN  TMAX  TDEW  RHUM  RAIN2   WIND   SRAD   RAIN\n')
+
+#To get the formatted rows of the dates (YYYYDDD).
+def rows(dates):
+    return b''.join('{:>7}  24.1  18.2  30.3  17.6  70.4    1.2    2.3   20.5    3.4\n'.format(x).encode()
+                    for x in dates)
+
+#To write the historical WTH files ({name: dates}) and the files of the update ({name: dates}).
+def archive(tmp_path, hist, new):
+    for name, files in [('hist', hist), ('new', new)]:
+        tmp_path.joinpath(name).mkdir()
+        for wth_file, dates in files.items():
+            wthio.write_wth(str(tmp_path / name / wth_file), HEADER, rows(dates))
+    return str(tmp_path / 'hist'), str(tmp_path / 'new')
+
+def test_merge_appends_only_the_new_rows(tmp_path):
+    hist, new = archive(tmp_path, {'1.WTH': range(2020001, 2020011), '2.WTH': range(2020001, 2020006)},
+                        {'1.WTH': range(2020006, 2020016)})
+    out = str(tmp_path / 'out')
+    mergeWTH(hist, new, out, ['1.WTH', '2.WTH', '3.WTH'])
+    assert open(out + '/1.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020016))
+    assert open(out + '/2.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020006))  # Copied as it is
+    assert sorted(os.listdir(out)) == ['1.WTH', '2.WTH']
+    assert open(hist + '/1.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020011))
+
+def test_merge_in_place(tmp_path):
+    hist, new = archive(tmp_path, {'1.WTH': range(2020001, 2020011), '2.WTH': range(2020001, 2020006)},
+                        {'1.WTH': range(2020006, 2020016), '2.WTH': range(2020006, 2020008)})
+    mergeWTH(hist, new, hist, ['1.WTH', '2.WTH'])
+    assert open(hist + '/1.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020016))
+    assert open(hist + '/2.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020008))
+    assert not os.path.exists(hist + '/.update_journal')
+
+#To leave the files of hist as an in-place update interrupted after its first append leaves them.
+def interrupt_update(hist):
+    with open(hist + '/.update_journal', 'w') as f:
+        for wth_file in ['1.WTH', '2.WTH']:
+            f.write(json.dumps({'file': wth_file, 'size': os.path.getsize(hist + '/' + wth_file)}) + '\n')
+        f.write('{"file": "3.W')  # The journal itself was being written.
+    with open(hist + '/1.WTH', 'ab') as f:
+        f.write(rows(range(2020011, 2020014))[:-20])
+
+def test_rollback_of_an_interrupted_update(tmp_path):
+    hist, new = archive(tmp_path, {'1.WTH': range(2020001, 2020011), '2.WTH': range(2020001, 2020006)}, {})
+    before = {x: open(hist + '/' + x, 'rb').read() for x in os.listdir(hist)}
+    interrupt_update(hist)
+    rollback(hist)
+    assert {x: open(hist + '/' + x, 'rb').read() for x in os.listdir(hist)} == before  # The journal is removed too.
+    rollback(hist)  # Nothing to undo
+
+def test_merge_in_place_after_an_interrupted_update(tmp_path):
+    hist, new = archive(tmp_path, {'1.WTH': range(2020001, 2020011)}, {'1.WTH': range(2020006, 2020016)})
+    tmp_path.joinpath('hist', '2.WTH').write_bytes(HEADER.encode() + rows(range(2020001, 2020006)))
+    interrupt_update(hist)
+    mergeWTH(hist, new, hist, ['1.WTH'])
+    assert open(hist + '/1.WTH', 'rb').read() == HEADER.encode() + rows(range(2020001, 2020016))
+
+def test_cohorts_after_an_interrupted_update(tmp_path):
+    hist, new = archive(tmp_path, {'1.WTH': range(2020001, 2020011), '2.WTH': range(2020001, 2020006),
+                                   '3.WTH': range(2020001, 2020101), '4.WTH': []}, {})
+    interrupt_update(hist)
+    wth_files = ['1.WTH', '2.WTH', '3.WTH', '4.WTH']
+    lasts = archive_last_dates(hist, hist, wth_files)
+    assert lasts == {'1.WTH': '2020010', '2.WTH': '2020005', '3.WTH': '2020100', '4.WTH': None}
+    assert not os.path.exists(hist + '/.update_journal')
+    cohorts = update_cohorts(lasts, datetime(2020, 4, 30))
+    assert cohorts == [['20200106', ['2', '1']], ['20200410', ['3']]]
+    assert update_cohorts(lasts, datetime(2020, 1, 8)) == [['20200106', ['2']]]  # 1.WTH is up to date.
+
+def test_last_dates_of_a_store(tmp_path):
+    con = wthstore.connect(str(tmp_path / 'hist'))
+    with con:
+        wthstore.put(con, '1', HEADER, rows(range(2020001, 2020011)))
+        wthstore.put(con, '2', HEADER, b'')
+    con.close()
+    assert hist_last_dates(str(tmp_path / 'hist'), ['1.WTH', '2.WTH']) == {'1.WTH': '2020010', '2.WTH': None}
@@ -8,121 +8,178 @@
 
 import os, sys
 import argparse
-import shutil
+import queue
+import threading
 import pandas as pd
 from datetime import datetime, date, timedelta
 from chirps import *
-import joblib
-from getnasap import nasa, nasachirps
-
-#Select requested (.WTH) files from historical repository and copy them to a new folder.
-def sel_wthfiles(in_file, in_dir, outdir_hist):
+from precstore import store_last_date, store_files
+from getnasap import nasa, nasachirps_stream, STREAM_QUEUE
+from metrics import stage
+from pipeline import run_graph
+import checkpoint
+import wthstore
+from wthupdate import mergeWTH, archive_last_dates, update_cohorts
+
+#Select requested (.WTH) files from historical repository (WTH files or a store, see wthstore.py). It returns the list
+#of files found.
+def sel_wthfiles(in_file, in_dir):
     pt = pd.read_csv(in_file)
     Id = pt.loc[:, "ID"]
     sel_files = [str(x) + ".WTH" for x in Id.to_list()] #Convert the array into a list of string elements.
-    all_files = [file for file in os.listdir(in_dir)] #To get the filenames (without extension) from the "in_dir" folder
-
-    # Create target Directory if it doesn't exist
-    if not os.path.exists(outdir_hist):
-        os.mkdir(outdir_hist)
+    if wthstore.is_store(in_dir):
+        con = wthstore.connect(in_dir)
+        all_files = set(x + ".WTH" for x in wthstore.last_dates(con))
+        con.close()
+    else:
+        all_files = set(os.listdir(in_dir)) #To get the filenames from the "in_dir" folder
 
-    ##Look for filenames in a list and then copy them to a different folder.
-    for index, wth_file in enumerate(sel_files):
+    found = []
+    for wth_file in sel_files:
         if wth_file in all_files:
-            shutil.copy2(in_dir + "/" + wth_file, outdir_hist + "/" + wth_file) #To copy the corresponding file into the local directory.
+            found.append(wth_file)
         else:
             print(wth_file, " NO FOUND")
-
-#Merge data
-def mergeWTH(in_dir1, in_dir2, out_dir):
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
-
-    wth_dir2 = os.listdir(in_dir2)
-
-    for wth_file1 in os.listdir(in_dir1):
-        if wth_file1.endswith(".WTH"):
-            if wth_file1 in wth_dir2:
-                #To make a copy of the first file
-                shutil.copy(in_dir1 + "/" + wth_file1, out_dir + "/" + wth_file1)
-                #To open a second file
-                with open(in_dir2 + "/" + wth_file1, "r") as wth2:
-                    data2 = [line for line in wth2.readlines() if line.strip()][4:]
-
-                #To open the copied file and append the second file
-                with open(out_dir + "/" + wth_file1, "r+") as wth1:
-                    data1 = [line for line in wth1.readlines() if line.strip()]
-                    wth1.writelines(data2)
-            else:
-                print("The file ", wth_file1, " will not be updated.")
-
-def update_wth(in_file, in_dir, out_dir):
+    return found
+
+#To write the CSV of the points of a cohort in its workspace. It returns the path of the CSV.
+def cohort_file(in_file, ids, workspace):
+    pt = pd.read_csv(in_file, dtype=str)  # The values are copied as they are.
+    if not os.path.exists(workspace):
+        os.makedirs(workspace)
+    pt[pd.read_csv(in_file)['ID'].astype(str).isin(ids).to_numpy()].to_csv(workspace + '/points.csv', index=False)
+    return workspace + '/points.csv'
+
+#To build the WTH files of the points of in_file for [dt_s, dt_e] in update_dir. The NASA POWER and the CHIRPS branches
+#do not depend on each other and run at the same time (see pipeline.py). Once the CHIRPS data are ready, the WTH files
+#of each nasapid are built as soon as its NASA POWER data arrive (see nasachirps_stream).
+def update_cohort(in_file, dt_s, dt_e, workspace, update_dir, memory_budget=None, workers=None, regional=False,
+                  subset=False, store=False, index=False):
+    n_pt = len(pd.read_csv(in_file))
+    dt_st = dt_s.strftime('%Y%m%d')
+    dt_ed = dt_e.strftime('%Y%m%d')
+    nasa_outdir = workspace + '/nasap'
+    out_cor_nc = workspace + '/in_nc_cor'
+    out_pre_nc = workspace + '/in_nc_pre'
+    outdir_prec = workspace + '/prec'
+    ready = queue.Queue(maxsize=STREAM_QUEUE)  # nasapids with their NASA POWER file written
+    chirps_ready = threading.Event()
+
+    #Getting and processing corrected data
+    def chirps_corrected():
+        if checkpoint.done('chirps'):
+            return
+        print('Getting corrected data from CHIRPS server...')
+        with stage('chirps_download', dataset='corrected'):
+            get_correc(dt_s, dt_e, out_cor_nc, in_file, subset, index)
+
+        print('Processing CHIRPS data...')
+        with stage('chirps_extract', dataset='corrected', points=n_pt):
+            chirps_auto(in_file, out_cor_nc, outdir_prec + '/prec_corr', memory_budget)
+
+    #Getting and processing preliminary data after the latest day available in prec corrected data.
+    def chirps_preliminary():
+        if checkpoint.done('chirps'):
+            chirps_ready.set()
+            return
+        lastday_corr = store_last_date(outdir_prec + '/prec_corr')
+        dt_s_p = dt_s if lastday_corr is None else lastday_corr + timedelta(days=1)
+
+        print('Getting preliminary data from CHIRPS server...')
+        with stage('chirps_download', dataset='preliminary'):
+            get_prelim(dt_s_p, dt_e, out_pre_nc, in_file, subset)
+        print('CHIRPS netCDF files in disk.')
+
+        with stage('chirps_extract', dataset='preliminary', points=n_pt):
+            chirps_auto(in_file, out_pre_nc, outdir_prec + '/prec_prelim', memory_budget)
+
+        #Merging corrected and preliminary precipitation data.
+        with stage('prec_merge', points=n_pt):
+            precmerge(outdir_prec)
+        print('CHIRPS processing data are complete.')
+        checkpoint.record('chirps', files=store_files(outdir_prec + '/prec'))
+        chirps_ready.set()
+
+    # Getting NASA POWER data for the update period. Only the rows are appended to the archive, so the header of the
+    # range is not needed and only the days missing in the NASA POWER cache are requested.
+    def nasa_branch():
+        print('Getting NASA POWER data...')
+        with stage('nasa_fetch', points=n_pt):
+            nasa(in_file, dt_st, dt_ed, nasa_outdir, regional, ready.put, header=False)
+        ready.put(None)
+
+    #Fusing NASA POWER and CHIRPS with QC on SRAD, point by point.
+    def wth_build():
+        print('Building the WTH files...')
+        with stage('wth_build', points=n_pt):
+            nasachirps_stream(in_file, nasa_outdir, outdir_prec + '/prec', update_dir, ready, chirps_ready, workers, store)
+
+    run_graph({'chirps_corrected': (chirps_corrected, []),
+               'chirps_preliminary': (chirps_preliminary, ['chirps_corrected']),
+               'nasa': (nasa_branch, []),
+               'wth_build': (wth_build, [])})
+
+#Each step is measured as a stage (see metrics.py). The last date of every historical file is read and the files are
+#updated by cohorts of files with about the same missing range (see update_cohorts): each cohort gets only the CHIRPS
+#months and the NASA POWER days of its range (the cache keeps what the cohorts share) and every file gets only the rows
+#it lacks, so files behind the others are not left with gaps.
+#With resume=True, an interrupted update with the same inputs continues from its last checkpoint (see checkpoint.py)
+#with the dates and cohorts of the interrupted update.
+#With store=True, or when in_dir has a store, the updated WTH files are written to the store of out_dir (see
+#wthstore.py): the new rows are appended in one transaction and historical WTH files are converted into the store.
+#With index=True, the corrected CHIRPS months are read from the CHIRPS index of the cache (see chirpsindex.py).
+def update_wth(in_file, in_dir, out_dir, memory_budget=None, workers=None, regional=False, subset=False, resume=False,
+               store=False, index=False):
     s1 = datetime.now()
 
-    os.chdir(in_dir)
-    tempdir = os.path.dirname(in_file) + '/temp'
-    if os.path.exists(tempdir):
-        shutil.rmtree(tempdir)
-        os.mkdir(tempdir)
-    else:
-        os.mkdir(tempdir)
-
-    outdir_hist = tempdir + '/historical'
-    #Select files from historical dataset
-    print('Selecting WTH files from repository...')
-    sel_wthfiles(in_file, in_dir, outdir_hist)
-
-    #get one file from the folder and get the latest date available.
-    with open(os.listdir(outdir_hist)[1], "r") as f1:  # Reading wth files
-        data = [line.split() for line in f1.readlines() if line.strip()]
-
-    last_date = data[-1][0] #Get the latest date in file.
-    dt_s = datetime.strptime(last_date, '%Y%j') + timedelta(days=1) #Add one day to the latest date.
-    dt_st = dt_s.strftime('%Y%m%d') #The start date for the update.
-
-    dt_e = datetime.today() - timedelta(days=4) #Four days before today because of SRAD latency.
-    dt_ed = dt_e.strftime('%Y%m%d') #The end date in format for the update.
-
-    #Getting corrected data
-    out_cor_nc = tempdir + '/in_nc_cor'
-    print('Getting corrected data from CHIRPS server...')
-    get_correc_nc(dt_s, dt_e, out_cor_nc)
-
-    #Run chirps for corrected data
-    outdir_prec = tempdir + '/prec_pkl'
-    print('Processing CHIRPS data...')
-    chirps2(in_file, out_cor_nc, outdir_prec + '/prec_corr.pkl')
-
-    #Getting the latest day available in prec corrected data.
-    df = joblib.load(outdir_prec + '/prec_corr.pkl')
-    lastday_corr = df.columns[-1]
-    dt_s_p = datetime.strptime(lastday_corr, '%Y%j') + timedelta(days=1)
-
-    #Getting preliminary data
-    out_pre_nc = tempdir + '/in_nc_pre'
-    print('Getting preliminary data from CHIRPS server...')
-    get_prelim_nc(dt_s_p, dt_e, out_pre_nc)
-    print('CHIRPS netCDF files in disk.')
-
-    #Run chirps for preliminary data
-    chirps2(in_file, out_pre_nc, outdir_prec + '/prec_prelim.pkl')
-
-    #Merging corrected and preliminary precipitation data.
-    precpkl(outdir_prec)
-    print('CHIRPS processing data are complete.')
-
-    # Getting NASA POWER data for the update period
-    nasa_outdir = tempdir + '/nasap'
-    print('Getting NASA POWER data...')
-    nasa(in_file, dt_st, dt_ed, nasa_outdir)
-
-    #Fusing NASA POWER and CHIRPS with QC on SRAD.
-    update_dir = tempdir + '/update'
-    print('Building the WTH files...')
-    nasachirps(in_file, nasa_outdir, outdir_prec + '/prec.pkl', update_dir)
-
-    #Merging historical with latest data.
-    mergeWTH(outdir_hist, update_dir, out_dir)
+    in_file, in_dir, out_dir = [os.path.abspath(x) for x in [in_file, in_dir, out_dir]]
+    n_pt = len(pd.read_csv(in_file))
+    store = store or wthstore.is_store(in_dir)
+    with stage('update', points=n_pt) as record:
+        os.chdir(in_dir)
+        tempdir = os.path.dirname(in_file) + '/temp'
+
+        #Select files from historical dataset
+        print('Selecting WTH files from repository...')
+        wth_files = sel_wthfiles(in_file, in_dir)
+
+        dt_e = datetime.today() - timedelta(days=4) #Four days before today because of SRAD latency.
+        dt_ed = dt_e.strftime('%Y%m%d') #The end date in format for the update.
+
+        #The last date of every file and the cohorts of files to update, once the appends of an interrupted in-place
+        #update are undone (see mergeWTH).
+        lasts = archive_last_dates(in_dir, out_dir, wth_files, store)
+        key = {'mode': 'update', 'in_file': checkpoint.checksum(in_file), 'in_dir': in_dir, 'out_dir': out_dir,
+               'regional': regional, 'subset': subset, 'store': store, 'index': index}
+        info = checkpoint.start(tempdir, key, resume, end=dt_ed,
+                                cohorts=update_cohorts(lasts, datetime.strptime(dt_ed, '%Y%m%d')))
+        dt_e = datetime.strptime(info['end'], '%Y%m%d')
+        cohorts = info['cohorts']
+        if cohorts:
+            record['days'] = (dt_e - datetime.strptime(cohorts[0][0], '%Y%m%d')).days + 1
+        record['cohorts'] = len(cohorts)
+        update_dir = tempdir + '/update'
+
+        try:
+            for dt_st, ids in cohorts:
+                print('Updating', len(ids), 'WTH files from', dt_st, 'to', info['end'] + '...')
+                checkpoint.scope('cohort_' + dt_st + '/')
+                workspace = tempdir + '/cohort_' + dt_st
+                update_cohort(cohort_file(in_file, ids, workspace), datetime.strptime(dt_st, '%Y%m%d'), dt_e, workspace,
+                              update_dir, memory_budget, workers, regional, subset, store, index)
+            checkpoint.scope()
+
+            #Merging historical with latest data.
+            if not checkpoint.done('wth_merge'):
+                with stage('wth_merge', points=len(wth_files)):
+                    if store:
+                        wthstore.merge_store(in_dir, update_dir, out_dir, [x[:-4] for x in wth_files])
+                    else:
+                        mergeWTH(in_dir, update_dir, out_dir, wth_files)
+                checkpoint.record('wth_merge', files=[wthstore.store_path(out_dir)] if store else
+                                  [out_dir + "/" + x for x in wth_files])
+        finally:
+            checkpoint.finish()
 
     e1 = datetime.now()
     print("Time of execution for the update is: ", str(e1-s1))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import re
+import numpy
+
+#Reading and writing of WTH files (DSSAT) and of the ICASA files of NASAPOWER with NumPy. A file is a header (the lines
+#up to the "@  DATE" line) and a block of data rows with one value per column. The block is read in one pass into one
+#array per column: fixed-width rows (the usual case) are cut by position from a byte matrix, other rows are split on
+#blanks. The values are kept as bytes (their text), so a WTH file written from them is the same as the original text;
+#dates() and values() give the typed columns. Whole blocks of rows are formatted at once by format_block().
+
+#Widths of the columns of the WTH files (DATE, T2M, TMIN, TMAX, TDEW, RHUM, RAIN2, WIND, SRAD, RAIN).
+WTH_WIDTHS = [7, 5, 5, 5, 5, 5, 6, 6, 6, 6]
+
+#To split the bytes of a WTH or ICASA file into its header (up to the "@  DATE" line) and its block of data rows.
+def split_wth(data):
+    m = re.search(rb'^@[^\n]*DATE[^\n]*\n?', data, re.M)
+    if m is None:
+        return data, b''
+    return data[:m.end()], data[m.end():]
+
+#To get the columns of a block of rows in one pass. It returns one array of bytes per column (ncol columns; the extra
+#values of a row are ignored).
+def parse_block(block, ncol):
+    cols = parse_fixed(block, ncol)
+    if cols is not None:
+        return cols
+    rows = [x.split()[:ncol] for x in block.splitlines() if x.strip()]
+    cols = numpy.array(rows, dtype=bytes).reshape(-1, ncol).T
+    return [cols[k] for k in range(ncol)]
+
+#To cut the columns of a block of fixed-width rows (all the rows of the same length, with right-aligned values that end
+#at the same positions). It returns None when the rows are not fixed-width.
+def parse_fixed(block, ncol):
+    end = block.find(b'\n') + 1
+    if end <= 0 or len(block) % end != 0:
+        return None
+    rows = numpy.frombuffer(block, dtype=numpy.uint8).reshape(-1, end)
+    blank = rows <= 32  # Spaces, tabs and line ends
+    if not blank[:, -1].all():
+        return None
+    ends = numpy.flatnonzero(~blank[0, :-1] & blank[0, 1:]) + 1  # Ends of the values of the first row
+    if len(ends) < ncol or not ((~blank[:, :-1] & blank[:, 1:]).sum(axis=1) == len(ends)).all() \
+            or not (blank[:, ends].all() and not blank[:, ends - 1].any()):
+        return None
+    starts = numpy.r_[0, ends[:-1]]
+    return [numpy.char.lstrip(numpy.ascontiguousarray(rows[:, s:e]).view('S' + str(e - s)).ravel())
+            for s, e in zip(starts[:ncol].tolist(), ends[:ncol].tolist())]
+
+#To read a WTH or ICASA file. It returns the lines of the header without blank lines (as str, ending with a new line)
+#and the columns of the data rows (one per name of the "@  DATE" line).
+def read_wth(path):
+    with open(path, 'rb') as f:
+        return parse_wth(f.read())
+
+#To parse the bytes of a WTH or ICASA file (see read_wth).
+def parse_wth(data):
+    header, block = split_wth(data)
+    header = [x + '\n' for x in header.decode().splitlines() if x.strip()]
+    names = header[-1].split() if header and header[-1].startswith('@') and 'DATE' in header[-1] else []
+    return header, parse_block(block, max(len(names) - 1, 1))  # "@" and "DATE" are two words
+
+#To get the values of the line after the line starting with the given name (e.g. the site of "@ INSI").
+def header_values(header, name='@ INSI'):
+    for k, line in enumerate(header[:-1]):
+        if line.startswith(name):
+            return header[k + 1].split()
+    return None
+
+#To get a column of dates (YYYYDDD) as integers.
+def dates(col):
+    return numpy.asarray(col, dtype=numpy.int64)
+
+#To get a column of values as floats.
+def values(col):
+    return numpy.asarray(col, dtype=float)
+
+#To get the text of values (floats) rounded to the given decimals, as str(round(value, decimals)) would write them.
+def value_text(values, decimals=1):
+    return numpy.round(numpy.asarray(values, dtype=numpy.float64), decimals).astype(bytes)
+
+#To format the rows of the columns (arrays of bytes or str) with right-aligned values of the given widths separated by
+#one space, as '{:>7} {:>5} ...'.format would. It returns the bytes of the block with a new line after every row.
+def format_block(cols, widths=WTH_WIDTHS):
+    cols = [numpy.asarray(c).astype(bytes) for c in cols]
+    n = len(cols[0]) if cols else 0
+    if n == 0:
+        return b''
+    if any(numpy.char.str_len(c).max() > w for c, w in zip(cols, widths)):
+        #A value wider than its column makes its row longer, so the rows are formatted one by one.
+        fmt = ' '.join('{:>' + str(w) + '}' for w in widths) + '\n'
+        return ''.join(map(fmt.format, *[c.astype(str) for c in cols])).encode()
+
+    #Every row has the same length: the block is written as a byte matrix.
+    rows = numpy.empty((n, sum(widths) + len(widths)), dtype=numpy.uint8)
+    pos = 0
+    for c, w in zip(cols, widths):
+        rows[:, pos:pos + w] = numpy.char.rjust(c, w).astype('S' + str(w)).view(numpy.uint8).reshape(n, w)
+        rows[:, pos + w] = ord(' ')
+        pos += w + 1
+    rows[:, -1] = ord('\n')
+    return rows.tobytes()
+
+#To write a WTH file with its header (str) and the block of rows (bytes, see format_block).
+def write_wth(path, header, block):
+    with open(path, 'wb') as f:
+        f.write(header.encode())
+        f.write(block)
+
+#To get the data rows of a block after the date last (YYYYDDD; all of them when last is None). The rows are in date
+#order, so the first row after last is found by bisection and only the dates of a few rows are read.
+def rows_after(block, last):
+    rows = [x for x in block.splitlines(True) if x.strip()]
+    last = b'' if last is None else last.encode() if isinstance(last, str) else last
+    lo, hi = 0, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if rows[mid].split(None, 1)[0] > last:
+            hi = mid
+        else:
+            lo = mid + 1
+    return b''.join(rows[lo:])
+
+#To get the last date (YYYYDDD) of a WTH file reading only the end of the file. It is None for a file without data rows
+#(only a header, or empty).
+def last_date(wth_file, block=4096):
+    with open(wth_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - block))
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if size > block and len(lines) < 2:
+        return last_date(wth_file, block * 4)
+    last = lines[-1].split()[0].decode() if lines else ''
+    return last if last.isdigit() else None
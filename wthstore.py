@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os
+import zlib
+import shutil
+import sqlite3
+from wthio import split_wth, rows_after
+
+#Store of WTH files in a single SQLite file ("<out_dir>/WTH.db") instead of one file per point:
+# - stations: the header of the WTH file of each ID (the lines up to the "@  DATE" line) and its first and last dates,
+# - chunks: the data rows of each ID in blocks of consecutive days (zlib compressed text), indexed by ID and date.
+#The rows are given and kept as blocks of bytes (see wthio.py).
+#An update appends one block per ID without rewriting the historical rows, in a single transaction, so an interrupted
+#update leaves the store as it was. export() writes the standard WTH files of the IDs needed.
+STORE_NAME = 'WTH.db'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stations (id TEXT PRIMARY KEY, header TEXT NOT NULL, first_date TEXT, last_date TEXT,
+                                     rows INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS chunks (id TEXT NOT NULL, first_date TEXT NOT NULL, last_date TEXT NOT NULL,
+                                   rows INTEGER NOT NULL, data BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS chunks_id ON chunks (id, first_date);
+'''
+
+def store_path(out_dir):
+    return out_dir + '/' + STORE_NAME
+
+#To know if a folder has a store.
+def is_store(out_dir):
+    return os.path.exists(store_path(out_dir))
+
+#To open (or create) the store of a folder.
+def connect(out_dir):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    con = sqlite3.connect(store_path(out_dir), timeout=600)
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.executescript(SCHEMA)
+    return con
+
+#To get the first date, the last date and the number of rows of a block of data rows (None, None, 0 when empty).
+def block_dates(block):
+    block = block.strip()
+    if not block:
+        return None, None, 0
+    return (block.split(None, 1)[0].decode(), block.rsplit(b'\n', 1)[-1].split(None, 1)[0].decode(),
+            block.count(b'\n') + 1)
+
+def add_chunk(con, id, block):
+    first, last, rows = block_dates(block)
+    if rows:
+        con.execute('INSERT INTO chunks VALUES (?, ?, ?, ?, ?)', (id, first, last, rows, zlib.compress(block, 1)))
+
+#To write the WTH file of an ID (header and block of data rows), replacing the one in the store.
+def put(con, id, header, block):
+    con.execute('DELETE FROM chunks WHERE id = ?', (id,))
+    con.execute('INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?)', (id, header) + block_dates(block))
+    add_chunk(con, id, block)
+
+#To append the data rows (a block) of an ID after its last date. The rows not after the last date are skipped.
+#It returns the number of rows appended (None when the ID is not in the store).
+def append(con, id, block):
+    station = con.execute('SELECT last_date FROM stations WHERE id = ?', (id,)).fetchone()
+    if station is None:
+        return None
+    if station[0] is not None:
+        block = rows_after(block, station[0])
+    first, last, rows = block_dates(block)
+    if rows:
+        add_chunk(con, id, block)
+        con.execute('UPDATE stations SET first_date = COALESCE(first_date, ?), last_date = ?, rows = rows + ? WHERE id = ?',
+                    (first, last, rows, id))
+    return rows
+
+#To get the text of the WTH file of an ID (None when it is not in the store).
+def read(con, id):
+    station = con.execute('SELECT header FROM stations WHERE id = ?', (id,)).fetchone()
+    if station is None:
+        return None
+    chunks = con.execute('SELECT data FROM chunks WHERE id = ? ORDER BY first_date', (id,))
+    return station[0] + ''.join(zlib.decompress(x[0]).decode() for x in chunks)
+
+#To get the last date of every ID: {ID: last date ('%Y%j') or None}.
+def last_dates(con):
+    return dict(con.execute('SELECT id, last_date FROM stations'))
+
+#To write the WTH files of the IDs (default: all) of the store of store_dir to out_dir. It returns the IDs not found.
+def export(store_dir, out_dir, ids=None):
+    con = connect(store_dir)
+    if ids is None:
+        ids = [x[0] for x in con.execute('SELECT id FROM stations ORDER BY id')]
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    missing = []
+    for id in ids:
+        text = read(con, str(id))
+        if text is None:
+            missing.append(str(id))
+            continue
+        with open(out_dir + "/" + str(id) + ".WTH", "w") as f:
+            f.write(text)
+    con.close()
+    print(len(ids) - len(missing), 'WTH files written to', out_dir)
+    if missing:
+        print(len(missing), 'IDs not in the store:', ', '.join(missing[:20]) + (' ...' if len(missing) > 20 else ''))
+    return missing
+
+#To copy the stations of the store of src_dir into the store of out_dir (replacing the same IDs).
+#It returns the IDs copied.
+def merge_into(out_dir, src_dir):
+    con = connect(out_dir)
+    con.execute('ATTACH DATABASE ? AS src', (store_path(src_dir),))
+    with con:
+        con.execute('DELETE FROM chunks WHERE id IN (SELECT id FROM src.stations)')
+        con.execute('INSERT OR REPLACE INTO stations SELECT * FROM src.stations')
+        con.execute('INSERT INTO chunks SELECT * FROM src.chunks')
+    ids = [x[0] for x in con.execute('SELECT id FROM src.stations')]
+    con.execute('DETACH DATABASE src')
+    con.close()
+    return ids
+
+#To append the rows of the store of new_dir after the last date of each ID of the historical WTH files of in_dir (a
+#store or WTH files) and write the result in the store of out_dir. Historical WTH files are converted into the store,
+#a historical store is copied (or updated in place when out_dir is in_dir). The historical WTH files of the IDs of ids
+#without new rows (already up to date) are converted as they are. It returns the number of IDs updated.
+def merge_store(in_dir, new_dir, out_dir, ids=()):
+    new = connect(new_dir)
+    new_ids = set(x[0] for x in new.execute('SELECT id FROM stations'))
+    in_place = os.path.realpath(in_dir) == os.path.realpath(out_dir)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if is_store(in_dir) and not in_place:
+        shutil.copyfile(store_path(in_dir), store_path(out_dir) + '.tmp')
+        os.replace(store_path(out_dir) + '.tmp', store_path(out_dir))
+
+    con = connect(out_dir)
+    updated = 0
+    with con:  # One transaction: an interrupted merge does not change the store.
+        for id in sorted(new_ids | set(ids)):
+            if not is_store(in_dir) and os.path.exists(in_dir + "/" + id + ".WTH"):
+                with open(in_dir + "/" + id + ".WTH", "rb") as f:
+                    header, block = split_wth(f.read())
+                put(con, id, header.decode(), rows_after(block, b''))  # Without blank lines
+            if id not in new_ids:
+                continue
+            header, block = split_wth(read(new, id).encode())
+            if append(con, id, block) is None:
+                print("The file ", id + ".WTH", " is not in the historical repository.")
+            else:
+                updated += 1
+    con.close()
+    new.close()
+    return updated
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+from datetime import datetime, timedelta
+import wthstore
+from wthio import last_date, split_wth, rows_after
+
+#Update of an archive of WTH files: the last date of every file, the cohorts of files that lack the same days, and the
+#append of the new rows (see update_wth.py, which builds the new rows of each cohort).
+
+#To undo the appends of an update interrupted in the middle. The journal keeps the size of each file before the update.
+def rollback(out_dir):
+    journal = out_dir + "/.update_journal"
+    if os.path.exists(journal):
+        print("Rolling back an interrupted update in", out_dir)
+        with open(journal, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # The journal was not complete, so no file was modified yet.
+                wth_file = out_dir + "/" + entry['file']
+                if os.path.exists(wth_file) and os.path.getsize(wth_file) > entry['size']:
+                    os.truncate(wth_file, entry['size'])
+        os.remove(journal)
+
+#Merge data
+#The new rows (the days after the last date of each historical file) are appended at the end of the files without
+#reading the historical rows. When out_dir is in_dir1, the files are updated in place: the original size of every file
+#is first written to a journal, so an interrupted update is rolled back on the next run. Otherwise each historical file
+#is copied once to out_dir under a temporary name, extended and renamed. The historical files of wth_files without new
+#rows (already up to date) are copied as they are.
+def mergeWTH(in_dir1, in_dir2, out_dir, wth_files=()):
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    in_place = os.path.realpath(in_dir1) == os.path.realpath(out_dir)
+    rollback(out_dir)
+
+    wth_dir1 = set(os.listdir(in_dir1))
+    wth_dir2 = set(x for x in os.listdir(in_dir2) if x.endswith(".WTH")) if os.path.exists(in_dir2) else set()
+    updates = {}
+    for wth_file2 in sorted(wth_dir2 | set(wth_files)):
+        if wth_file2 not in wth_dir1:
+            print("The file ", wth_file2, " is not in the historical repository.")
+        elif wth_file2 in wth_dir2:
+            #To get the rows of the update after the last date of the historical file
+            last = last_date(in_dir1 + "/" + wth_file2)
+            with open(in_dir2 + "/" + wth_file2, "rb") as wth2:
+                updates[wth_file2] = rows_after(split_wth(wth2.read())[1], last)
+        elif not in_place:
+            updates[wth_file2] = b''
+
+    if in_place:
+        with open(out_dir + "/.update_journal", "w") as f:
+            for wth_file in updates:
+                f.write(json.dumps({'file': wth_file, 'size': os.path.getsize(out_dir + "/" + wth_file)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    for wth_file, data2 in updates.items():
+        target = out_dir + "/" + wth_file
+        if not in_place:
+            target = out_dir + "/" + wth_file + ".tmp"
+            shutil.copyfile(in_dir1 + "/" + wth_file, target)
+        with open(target, "ab") as wth1:
+            wth1.write(data2)
+            wth1.flush()
+            os.fsync(wth1.fileno())
+        if not in_place:
+            os.replace(target, out_dir + "/" + wth_file)
+
+    if in_place:
+        os.remove(out_dir + "/.update_journal")
+
+#Files whose first missing day is within COHORT_DAYS of the first missing day of a cohort are updated with it.
+COHORT_DAYS = 31
+
+#To get the last date (YYYYDDD) of every historical WTH file, from the store of in_dir or from the end of each file.
+#It is None for a file without data rows.
+def hist_last_dates(in_dir, wth_files):
+    if wthstore.is_store(in_dir):
+        con = wthstore.connect(in_dir)
+        lasts = wthstore.last_dates(con)
+        con.close()
+        return {x: lasts[x[:-4]] for x in wth_files}
+    lasts = {}
+    for wth_file in wth_files:
+        lasts[wth_file] = last_date(in_dir + "/" + wth_file)
+    return lasts
+
+#To group the WTH files into cohorts by their missing range (from the day after their last date to dt_e). A cohort
+#starts at the first missing day of its files; the files whose first missing day is up to COHORT_DAYS later join it,
+#so a few days of difference do not make another pass, and only the rows they lack are appended (see mergeWTH).
+#It returns [[start (YYYYMMDD), [IDs]]] sorted by start date.
+def update_cohorts(lasts, dt_e):
+    starts = {}
+    current = []
+    for wth_file, last in lasts.items():
+        if last is None:
+            print(wth_file, " has no data to update.")
+            continue
+        dt_s = datetime.strptime(last, '%Y%j') + timedelta(days=1)
+        if dt_s > dt_e:
+            current.append(wth_file)
+        else:
+            starts.setdefault(dt_s, []).append(wth_file[:-4])
+    if current:
+        print(len(current), 'WTH files are already up to date.')
+
+    cohorts = []
+    for dt_s in sorted(starts):
+        if cohorts and dt_s - cohorts[-1][0] <= timedelta(days=COHORT_DAYS):
+            cohorts[-1][1].extend(starts[dt_s])
+        else:
+            cohorts.append([dt_s, list(starts[dt_s])])
+    for dt_s, ids in cohorts:
+        print('Cohort from', dt_s.strftime('%Y-%m-%d') + ':', len(ids), 'WTH files.')
+    return [[dt_s.strftime('%Y%m%d'), ids] for dt_s, ids in cohorts]
+
+#To get the last date of every historical WTH file (see hist_last_dates), once the appends of an interrupted in-place
+#update of out_dir are undone.
+def archive_last_dates(in_dir, out_dir, wth_files, store=False):
+    if not store and os.path.exists(out_dir):
+        rollback(out_dir)
+    return hist_last_dates(in_dir, wth_files)